@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+    Deterministic synthetic references and read sets for benchmarking
+
+    The same arguments and seed always produce byte for byte the same files
+    so results from different commits are comparable.
+
+        generate.py ref ref.fa --length 1000000 --contigs 4
+        generate.py reads reads.fastq --reference ref.fa --count 10000 --length 250
+        generate.py reads reads.sff --reference ref.fa --count 1000 --format sff
+'''
+from argparse import ArgumentParser
+import binascii
+import random
+import struct
+import string
+
+BASES = 'ACGT'
+# Every byte value as the 4 bases its 2 bit pairs stand for
+BYTE_BASES = [''.join( [BASES[(b >> s) & 3] for s in (6, 4, 2, 0)] ) for b in range( 256 )]
+COMPLEMENT = string.maketrans( 'ACGT', 'TGCA' )
+
+# sff layout as written by 454 instruments
+SFF_FLOW_CHARS = 'TACG'
+SFF_KEY = 'TCAG'
+SFF_HEADER = struct.Struct( '>4s4sQIIHHHB' )
+SFF_READ_HEADER = struct.Struct( '>2HI4H' )
+
+def random_sequence( rng, length ):
+    '''
+        @param rng - random.Random
+        @param length - Number of bases
+        @return random ACGT string
+    '''
+    nbytes = (length + 3) // 4
+    if nbytes == 0:
+        return ''
+    data = binascii.unhexlify( '{0:0{1}x}'.format(rng.getrandbits( 8 * nbytes ), 2 * nbytes) )
+    return ''.join( [BYTE_BASES[ord( c )] for c in data] )[:length]
+
+def reference_contigs( length, contigs=1, seed=0 ):
+    '''
+        @param length - Total number of bases split evenly between contigs
+        @param contigs - Number of contigs
+        @param seed - Random seed
+        @return list of (name, sequence)
+    '''
+    rng = random.Random( seed )
+    sizes = [length // contigs + (1 if i < length % contigs else 0) for i in range( contigs )]
+    return [('contig{0}'.format(i + 1), random_sequence( rng, size ))
+        for i, size in enumerate( sizes )]
+
+def write_fasta( path, records, width=70 ):
+    '''
+        @param path - Output path
+        @param records - Iterable of (name, sequence)
+        @return path
+    '''
+    with open( path, 'w' ) as fh:
+        for name, seq in records:
+            fh.write( '>' + name + '\n' )
+            for i in range( 0, len( seq ), width ):
+                fh.write( seq[i:i + width] + '\n' )
+    return path
+
+def read_fasta( path ):
+    '''
+        @return list of (name, sequence) of a fasta file
+    '''
+    records = []
+    with open( path ) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith( '>' ):
+                records.append( (line[1:].split()[0], []) )
+            elif line:
+                records[-1][1].append( line )
+    return [(name, ''.join( seq )) for name, seq in records]
+
+def sample_reads( contigs, count, length, seed=0, error_rate=0.01 ):
+    '''
+        Sample reads from random positions and strands of contigs with
+        substitution errors
+
+        @param contigs - list of (name, sequence) to sample from
+        @param count - Number of reads
+        @param length - Read length(shortened for shorter contigs)
+        @param seed - Random seed
+        @param error_rate - Chance of each base being substituted
+        @return generator of (name, sequence, qualities as phred scores)
+    '''
+    rng = random.Random( seed )
+    total = sum( [len( seq ) for name, seq in contigs] )
+    for i in xrange( count ):
+        # Contigs are picked in proportion to their length
+        pick = rng.randrange( total )
+        for name, seq in contigs:
+            if pick < len( seq ):
+                break
+            pick -= len( seq )
+        size = min( length, len( seq ) )
+        start = rng.randrange( len( seq ) - size + 1 )
+        read = list( seq[start:start + size] )
+        quals = [rng.randint( 30, 40 ) for b in read]
+        for j in range( size ):
+            if rng.random() < error_rate:
+                read[j] = rng.choice( BASES.replace( read[j], '' ) )
+                quals[j] = rng.randint( 2, 20 )
+        read = ''.join( read )
+        if rng.random() < 0.5:
+            read = read.translate( COMPLEMENT )[::-1]
+            quals.reverse()
+        yield ('read{0}'.format(i + 1), read, quals)
+
+def write_fastq( path, reads ):
+    '''
+        @param path - Output path
+        @param reads - Iterable of (name, sequence, qualities)
+        @return number of reads written
+    '''
+    n = 0
+    with open( path, 'w' ) as fh:
+        for name, seq, quals in reads:
+            fh.write( '@{0}\n{1}\n+\n{2}\n'.format(
+                name, seq, ''.join( [chr( q + 33 ) for q in quals] )
+            ))
+            n += 1
+    return n
+
+def _pad( data ):
+    return data + '\0' * (-len( data ) % 8)
+
+def sff_flows( bases, number_of_flows ):
+    '''
+        Flowgram and flow index of bases for SFF_FLOW_CHARS
+
+        @return (flowgram values, flow index per base)
+    '''
+    values = [0] * number_of_flows
+    index = []
+    i = 0
+    last = 0
+    for flow in range( number_of_flows ):
+        c = SFF_FLOW_CHARS[flow % len( SFF_FLOW_CHARS )]
+        n = 0
+        while i < len( bases ) and bases[i] == c:
+            index.append( flow + 1 - last if n == 0 else 0 )
+            n += 1
+            i += 1
+        if n:
+            last = flow + 1
+        values[flow] = n * 100
+    if i != len( bases ):
+        raise ValueError( "{0} flows are not enough for {1} bases".format(number_of_flows, len( bases )) )
+    return values, index
+
+def write_sff( path, reads ):
+    '''
+        Write reads as an sff with the key sequence in front of every read
+        and clipped off with clip_qual_left
+
+        @param path - Output path
+        @param reads - list of (name, sequence, qualities)
+        @return number of reads written
+    '''
+    reads = list( reads )
+    longest = max( [len( seq ) for name, seq, quals in reads] + [0] ) + len( SFF_KEY )
+    # Every base needs at most a full cycle of flows
+    number_of_flows = len( SFF_FLOW_CHARS ) * longest
+    header_length = SFF_HEADER.size + number_of_flows + len( SFF_KEY )
+    header_length += -header_length % 8
+    with open( path, 'wb' ) as fh:
+        fh.write( _pad( SFF_HEADER.pack( '.sff', '\0\0\0\1', 0, 0, len( reads ),
+            header_length, len( SFF_KEY ), number_of_flows, 1 ) +
+            (SFF_FLOW_CHARS * longest)[:number_of_flows] + SFF_KEY ) )
+        for name, seq, quals in reads:
+            bases = SFF_KEY + seq
+            quals = [40] * len( SFF_KEY ) + list( quals )
+            read_header_length = SFF_READ_HEADER.size + len( name )
+            read_header_length += -read_header_length % 8
+            fh.write( _pad( SFF_READ_HEADER.pack( read_header_length, len( name ),
+                len( bases ), len( SFF_KEY ) + 1, 0, 0, 0 ) + name ) )
+            values, index = sff_flows( bases, number_of_flows )
+            fh.write( _pad( struct.pack( '>{0}H'.format(number_of_flows), *values ) +
+                struct.pack( '{0}B'.format(len( index )), *index ) + bases +
+                struct.pack( '{0}B'.format(len( quals )), *quals ) ) )
+    return len( reads )
+
+def main( argv=None ):
+    args = parse_args( argv )
+    if args.command == 'ref':
+        write_fasta( args.output, reference_contigs( args.length, args.contigs, args.seed ) )
+    else:
+        reads = sample_reads( read_fasta( args.reference ), args.count, args.length,
+            args.seed, args.error_rate )
+        if args.format == 'sff':
+            write_sff( args.output, reads )
+        else:
+            write_fastq( args.output, reads )
+
+def parse_args( argv=None ):
+    parser = ArgumentParser( description='Generate deterministic synthetic data' )
+    sub = parser.add_subparsers( dest='command' )
+
+    ref = sub.add_parser( 'ref', help='Random reference fasta' )
+    ref.add_argument( 'output', help='Fasta file to write' )
+    ref.add_argument( '--length', type=int, default=1000000, help='Total bases[Default: 1000000]' )
+    ref.add_argument( '--contigs', type=int, default=1, help='Number of contigs[Default: 1]' )
+    ref.add_argument( '--seed', type=int, default=0, help='Random seed[Default: 0]' )
+
+    reads = sub.add_parser( 'reads', help='Reads sampled from a reference' )
+    reads.add_argument( 'output', help='Read file to write' )
+    reads.add_argument( '--reference', required=True, help='Fasta to sample reads from' )
+    reads.add_argument( '--count', type=int, default=10000, help='Number of reads[Default: 10000]' )
+    reads.add_argument( '--length', type=int, default=250, help='Read length[Default: 250]' )
+    reads.add_argument( '--format', choices=('fastq', 'sff'), default='fastq', help='Read format[Default: fastq]' )
+    reads.add_argument( '--error-rate', type=float, default=0.01, help='Substitution rate[Default: 0.01]' )
+    reads.add_argument( '--seed', type=int, default=1, help='Random seed[Default: 1]' )
+
+    return parser.parse_args( argv )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+'''
+    Time pyBWA against synthetic data and raw bwa
+
+    Benchmarks the bwa package of the checkout this lives in, not an
+    installed one, and writes the results as json so runs from different
+    commits can be compared:
+
+        run_benchmarks.py --output before.json
+        git checkout other-branch
+        run_benchmarks.py --output after.json --compare before.json
+'''
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE
+import json
+import logging
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+THIS_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.dirname( THIS_DIR ) )
+
+from bwa import bwa, seqio, cache
+import generate
+
+# Bump whenever the format of the results changes
+RESULTS_VERSION = 2
+
+class BenchmarkFailed( Exception ):
+    ''' The benchmarked call did not succeed so its time means nothing '''
+    pass
+
+def expect( func, expected ):
+    '''
+        @return func wrapped to raise BenchmarkFailed unless it returns
+            expected
+    '''
+    def checked( ):
+        value = func()
+        if value != expected:
+            raise BenchmarkFailed( "returned {0!r} instead of {1!r}".format(value, expected) )
+        return value
+    return checked
+
+def git_commit( ):
+    ''' @return commit of the checkout being benchmarked or None '''
+    p = Popen( ['git', 'rev-parse', 'HEAD'], stdout=PIPE, stderr=PIPE, cwd=THIS_DIR )
+    out, err = p.communicate()
+    if p.returncode != 0:
+        return None
+    return out.strip()
+
+def make_data( workdir, args ):
+    '''
+        Generate the benchmark data set into workdir
+
+        @return dictionary of the generated paths
+    '''
+    refdir = os.path.join( workdir, 'refs' )
+    readdir = os.path.join( workdir, 'reads' )
+    os.makedirs( refdir )
+    os.makedirs( readdir )
+    contigs = generate.reference_contigs( args.ref_length, args.contigs, args.seed )
+    for name, seq in contigs:
+        generate.write_fasta( os.path.join( refdir, name + '.fa' ), [(name, seq)] )
+    ref = generate.write_fasta( os.path.join( workdir, 'ref.fa' ), contigs )
+
+    fastq = os.path.join( readdir, 'reads.fastq' )
+    generate.write_fastq( fastq, generate.sample_reads( contigs, args.reads,
+        args.read_length, args.seed + 1 ) )
+    sff = os.path.join( readdir, 'reads.sff' )
+    generate.write_sff( sff, generate.sample_reads( contigs, args.sff_reads,
+        args.sff_read_length, args.seed + 2 ) )
+    return {'refdir': refdir, 'readdir': readdir, 'ref': ref, 'fastq': fastq, 'sff': sff}
+
+def timeit( func, repeat, setup=None ):
+    '''
+        Run func repeat times calling setup untimed before each run
+
+        @return dictionary of the run times in seconds, best and median and
+            what func returned on the last run
+    '''
+    runs = []
+    value = None
+    for i in range( repeat ):
+        if setup is not None:
+            setup()
+        start = time.time()
+        value = func()
+        runs.append( time.time() - start )
+    ordered = sorted( runs )
+    return {
+        'runs': runs,
+        'best': ordered[0],
+        'median': ordered[len( ordered ) // 2],
+        'value': value
+    }
+
+def run_cmd( cmd, stdout=None ):
+    ''' Run cmd discarding stderr and return its exit status '''
+    with open( os.devnull, 'w' ) as null:
+        if stdout is None:
+            return Popen( cmd, stdout=null, stderr=null ).wait()
+        with open( stdout, 'wb' ) as fh:
+            return Popen( cmd, stdout=fh, stderr=null ).wait()
+
+def benchmarks( data, workdir, args ):
+    '''
+        @return list of (name, func, setup) to time
+    '''
+    bwa_path = args.bwa or bwa.which_bwa()
+    out = lambda name: os.path.join( workdir, name )
+    ref = data['ref']
+    threads = str( args.threads )
+
+    def remove( *paths ):
+        def setup( ):
+            for path in paths:
+                if os.path.exists( path ):
+                    os.unlink( path )
+        return setup
+
+    def index_ref( ):
+        return bwa.index_ref( ref, bwa_path, store=False )
+
+    def mem_run( ):
+        return bwa.BWAMem( ref, data['fastq'], t=threads, bwa_path=bwa_path ).run( out( 'mem.sam' ) )
+
+    def ensure_indexed( ):
+        if not bwa.is_indexed( ref ):
+            bwa.index_ref( ref, bwa_path, store=False )
+
+    return [
+        ('reads_in_file fastq', lambda: seqio.reads_in_file( data['fastq'] ), None),
+        ('reads_in_file sff', lambda: seqio.reads_in_file( data['sff'] ), None),
+        ('sffs_to_fastq', lambda: seqio.sffs_to_fastq( [data['sff']], out( 'sff.fastq' ) ),
+            remove( out( 'sff.fastq' ) )),
+        ('compile_reads', lambda: bwa.compile_reads( data['readdir'], out( 'reads.fastq' ) ),
+            remove( out( 'reads.fastq' ), out( 'sff.reads.fastq' ) )),
+        ('compile_refs', lambda: bwa.compile_refs( data['refdir'], bwa_path, False, out( 'reference.fa' ) ),
+            remove( out( 'reference.fa' ), out( 'reference.fa' + bwa.SOURCES_EXT ) )),
+        ('compile_refs unchanged', lambda: bwa.compile_refs( data['refdir'], bwa_path, False, out( 'reference.fa' ) ),
+            None),
+        ('raw bwa index', expect( lambda: run_cmd( [bwa_path, 'index', ref] ), 0 ),
+            lambda: bwa.clear_index( ref )),
+        ('index_ref', expect( index_ref, True ), lambda: bwa.clear_index( ref )),
+        ('raw bwa mem', expect( lambda: run_cmd( [bwa_path, 'mem', '-t', threads, ref, data['fastq']], out( 'raw.sam' ) ), 0 ),
+            ensure_indexed),
+        ('BWAMem.run', expect( mem_run, 0 ), ensure_indexed),
+    ]
+
+def compare( results, previous, threshold ):
+    '''
+        Compare median times with a previous result file
+
+        @param results - Results of this run
+        @param previous - Results of an earlier run
+        @param threshold - Ratio above which a benchmark counts as slower
+        @return (report text, list of names that got slower)
+    '''
+    lines = []
+    if previous.get( 'params' ) != results['params']:
+        lines.append( 'Warning: runs used different parameters so times may not be comparable\n' )
+    lines.append( '{0:<26}{1:>12}{2:>12}{3:>9}\n'.format('benchmark', 'before', 'after', 'ratio') )
+    slower = []
+    for name, result in sorted( results['benchmarks'].items() ):
+        before = previous.get( 'benchmarks', {} ).get( name )
+        if before is None:
+            continue
+        ratio = result['median'] / max( before['median'], 1e-9 )
+        if ratio > threshold:
+            slower.append( name )
+        lines.append( '{0:<26}{1:>12.4f}{2:>12.4f}{3:>9.2f}{4}\n'.format(
+            name, before['median'], result['median'], ratio,
+            ' slower' if ratio > threshold else ''
+        ))
+    return ''.join( lines ), slower
+
+def main( argv=None ):
+    args = parse_args( argv )
+    logging.basicConfig( level=logging.WARNING )
+    workdir = tempfile.mkdtemp( prefix='pybwabench', dir=args.workdir )
+    # Keep the read count cache and index store from skewing the timings
+    os.environ[cache.CACHE_DIR_ENV] = os.path.join( workdir, '.cache' )
+    try:
+        data = make_data( workdir, args )
+        results = {
+            'version': RESULTS_VERSION,
+            'commit': git_commit(),
+            'created': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'bwa_version': bwa.bwa_version( args.bwa or bwa.which_bwa() ),
+            'params': dict( [(k, v) for k, v in vars( args ).items()
+                if k not in ('output', 'compare', 'workdir', 'bwa', 'keep')] ),
+            'benchmarks': {},
+            'failed': {}
+        }
+        for name, func, setup in benchmarks( data, workdir, args ):
+            if args.only and not [o for o in args.only if o in name]:
+                continue
+            try:
+                result = timeit( func, args.repeat, setup )
+            except Exception as e:
+                # Includes setup failing such as the reference not indexing
+                results['failed'][name] = '{0}: {1}'.format(e.__class__.__name__, e)
+                sys.stderr.write( '{0:<26} failed: {1}\n'.format(name, e) )
+                continue
+            result['value'] = repr( result['value'] )
+            results['benchmarks'][name] = result
+            sys.stderr.write( '{0:<26}{1:>10.4f}s median {2:>10.4f}s best\n'.format(
+                name, result['median'], result['best']
+            ))
+        bench = results['benchmarks']
+        for raw, wrapped in (('raw bwa index', 'index_ref'), ('raw bwa mem', 'BWAMem.run')):
+            if raw in bench and wrapped in bench:
+                results.setdefault( 'overhead', {} )[wrapped] = \
+                    bench[wrapped]['median'] - bench[raw]['median']
+    finally:
+        if args.keep:
+            sys.stderr.write( "Kept {0}\n".format(workdir) )
+        else:
+            shutil.rmtree( workdir )
+
+    text = json.dumps( results, indent=2, sort_keys=True )
+    if args.output:
+        with open( args.output, 'w' ) as fh:
+            fh.write( text + '\n' )
+    else:
+        sys.stdout.write( text + '\n' )
+
+    if args.compare:
+        with open( args.compare ) as fh:
+            report, slower = compare( results, json.load( fh ), args.threshold )
+        sys.stderr.write( report )
+        if slower:
+            sys.exit( 1 )
+    if results['failed']:
+        sys.exit( 1 )
+
+def parse_args( argv=None ):
+    parser = ArgumentParser( description='Benchmark pyBWA against raw bwa on synthetic data' )
+
+    parser.add_argument( '--ref-length', type=int, default=1000000, help='Reference bases[Default: 1000000]' )
+    parser.add_argument( '--contigs', type=int, default=4, help='Reference contigs, one file each for compile_refs[Default: 4]' )
+    parser.add_argument( '--reads', type=int, default=20000, help='Fastq reads[Default: 20000]' )
+    parser.add_argument( '--read-length', type=int, default=150, help='Fastq read length[Default: 150]' )
+    parser.add_argument( '--sff-reads', type=int, default=5000, help='Sff reads[Default: 5000]' )
+    parser.add_argument( '--sff-read-length', type=int, default=400, help='Sff read length[Default: 400]' )
+    parser.add_argument( '--seed', type=int, default=0, help='Random seed of the data[Default: 0]' )
+    parser.add_argument( '--threads', type=int, default=1, help='bwa mem -t[Default: 1]' )
+    parser.add_argument( '--repeat', type=int, default=3, help='Runs of each benchmark[Default: 3]' )
+    parser.add_argument( '--only', action='append', help='Only run benchmarks whose name contains this. Can be given more than once' )
+    parser.add_argument( '--bwa', default=None, help='bwa to use[Default: the one in PATH]' )
+    parser.add_argument( '--workdir', default=None, help='Where to put the data[Default: system temp directory]' )
+    parser.add_argument( '--keep', action='store_true', default=False, help='Keep the generated data' )
+    parser.add_argument( '--output', default=None, help='Write results json here instead of stdout' )
+    parser.add_argument( '--compare', default=None, help='Results json of an earlier run to compare medians with' )
+    parser.add_argument( '--threshold', type=float, default=1.2, help='With --compare, exit 1 if any median is this many times slower[Default: 1.2]' )
+
+    return parser.parse_args( argv )
+
+if __name__ == '__main__':
+    main()
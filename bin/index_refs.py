@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+
+from bwa import bwa_index
+bwa_index.main()
@@ -1,6 +1,6 @@
 import logging
 import re
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, call
 import tempfile
 import os
 import os.path
@@ -8,21 +8,45 @@ import sys
 import glob
 import fnmatch
 import tempfile
-
-from Bio import SeqIO
-import sh
+import threading
+import shutil
+import errno
+import fcntl
+import time
+import itertools
+import multiprocessing
+import contextlib
+import collections
+import atexit
+import signal
+import select
 
 import seqio
+import cache
+import indexstore
+import instrument
+from monitor import StderrMonitor
+import sam
+from sam import iter_sam
 
 logger = logging.getLogger( __name__ )
 
-def compile_reads( reads, outputfile='reads.fastq' ):
+@instrument.timed( 'compile_reads' )
+def compile_reads( reads, outputfile='reads.fastq', stream=False ):
     '''
         Compile all given reads from directory of reads or just return reads if it is fastq
         If reads is sff file then convert to fastq
+        A single fastq is returned untouched even if it is gzip compressed
+        since bwa reads gzip itself. Compressed fastq from a directory are
+        decompressed into outputfile.
+
+        With stream set nothing is written and a seqio.ReadStream is returned
+        instead that BWAMem will write into a named pipe for bwa to read as
+        bwa runs
 
-        @param reads - Directory/file of .fastq or .sff
+        @param reads - Directory/file of .fastq, .fastq.gz or .sff
         @param outputfile - File path of single fastq file output
+        @param stream - Return a seqio.ReadStream instead of writing outputfile
         @return fastq with all reads from reads
     '''
     if os.path.isdir( reads ):
@@ -30,8 +54,12 @@ def compile_reads( reads, outputfile='reads.fastq' ):
     elif isinstance( reads, str ):
         # Single read file given
         if os.path.splitext( reads )[1] == '.sff':
+            if stream:
+                return seqio.ReadStream( [reads] )
             # Just convert the single reads
-            return seqio.sffs_to_fastq( [reads], outputfile )
+            outputfile = seqio.sffs_to_fastq( [reads], outputfile )
+            seed_read_count( outputfile, [reads] )
+            return outputfile
         else:
             # Already fastq so nothing to do
             #  This is a bad assumption
@@ -43,6 +71,10 @@ def compile_reads( reads, outputfile='reads.fastq' ):
 
     # Get only sff files to convert
     sffs = fnmatch.filter( reads, '*.sff' )
+    fastqs = fnmatch.filter( reads, '*.fastq' ) + fnmatch.filter( reads, '*.fastq.gz' )
+    if stream:
+        return seqio.ReadStream( fastqs + sffs )
+
     tmpsfffastq = None
     if len( sffs ):
         tmpsfffastq = os.path.join(
@@ -54,7 +86,6 @@ def compile_reads( reads, outputfile='reads.fastq' ):
     else:
         sfffastq = []
 
-    fastqs = fnmatch.filter( reads, '*.fastq' )
     # Concat fastq files and sff converted fastq files into
     #  outputfile
     converts = fastqs + sfffastq
@@ -63,17 +94,119 @@ def compile_reads( reads, outputfile='reads.fastq' ):
         )
     )
     seqio.concat_files( fastqs + sfffastq, outputfile )
+    seed_read_count( outputfile, fastqs + sffs )
     if tmpsfffastq is not None:
         os.unlink( tmpsfffastq )
     return outputfile
 
-def compile_refs( refs ):
+def seed_read_count( outputfile, inputs ):
+    '''
+        Cache the read count of outputfile as the sum of the read counts of
+        the inputs it was compiled from so it never has to be recounted
+
+        Only counts that are known without reading the inputs are used, which
+        are cached counts and sff headers. Otherwise nothing is cached and the
+        reads are left for BWAMem to count while bwa runs.
+
+        @param outputfile - Compiled read file
+        @param inputs - Read files that make up outputfile
+    '''
+    readcount = 0
+    try:
+        for f in inputs:
+            if os.path.splitext( f )[1] == '.sff':
+                count = seqio.sff_read_count( f )
+            else:
+                count = cache.READ_COUNTS.get( f )
+            if count is None:
+                logger.debug( "Read count of {0} is not known yet".format(f) )
+                return
+            readcount += count
+        cache.READ_COUNTS.set( outputfile, readcount )
+    except (OSError, IOError, ValueError) as e:
+        logger.debug( "Not caching read count of {0}: {1}".format(outputfile, e) )
+
+# Written next to a compiled reference to record what it was concatted from
+SOURCES_EXT = '.sources.json'
+
+def concat_refs( ref_files, outputfile ):
+    '''
+        Concat ref_files into outputfile unless outputfile was already concatted
+        from ref_files and none of them changed since
+
+        The path, inode, size and mtime of every file are kept in
+        <outputfile>.sources.json which is only written once the concat
+        succeeded.
+
+        @raises OSError, IOError, ValueError as seqio.concat_files
+        @param ref_files - List of reference files in concat order
+        @param outputfile - Path of the concatted reference
+        @return True if outputfile was written, False if it was up to date
+    '''
+    if sources_current( ref_files, outputfile ):
+        logger.info( "{0} is up to date with its references".format(outputfile) )
+        return False
+
+    seqio.concat_files( ref_files, outputfile )
+    record_sources( ref_files, outputfile )
+    return True
+
+def sources_current( ref_files, outputfile ):
+    '''
+        Check <outputfile>.sources.json to see if outputfile is still what
+        ref_files concat to. Only stats the files.
+
+        @raises OSError if any of ref_files cannot be stat'd
+        @param ref_files - List of reference files in concat order
+        @param outputfile - Path of the concatted reference
+        @return True if neither outputfile nor any of ref_files changed since
+            they were recorded
+    '''
+    sources = [[os.path.abspath( f )] + cache.file_identity( f ) for f in ref_files]
+    manifest = cache.read_json( outputfile + SOURCES_EXT, {} )
+    if manifest.get( 'sources' ) != sources:
+        return False
+    try:
+        return cache.file_identity( outputfile ) == manifest.get( 'output' )
+    except OSError:
+        return False
+
+def record_sources( ref_files, outputfile ):
+    '''
+        Write <outputfile>.sources.json so concat_refs knows outputfile is
+        what ref_files concat to
+
+        @param ref_files - List of reference files in concat order
+        @param outputfile - Path of the concatted reference
+    '''
+    try:
+        sources = [[os.path.abspath( f )] + cache.file_identity( f ) for f in ref_files]
+        cache.write_json( outputfile + SOURCES_EXT,
+            {'sources': sources, 'output': cache.file_identity( outputfile )}
+        )
+    except (OSError, IOError) as e:
+        logger.warning( "Could not record the sources of {0}: {1}".format(outputfile, e) )
+
+@instrument.timed( 'compile_refs' )
+def compile_refs( refs, bwa_path=None, store=None, outputfile='reference.fa' ):
     '''
         Compile all given refs into a single file to be indexed
 
+        If the index store already has an index of what the refs would
+        concat to then the stored reference and index are hard linked as
+        outputfile instead of concatting, so evicting the entry later does
+        not take them away. outputfile is only rewritten when the refs changed
+        since it was last compiled(see concat_refs) and the store is not
+        looked in at all when it did not.
+
         @TODO -- Write tests
 
         @param refs - Directory/file of fasta formatted files
+        @param bwa_path - Path to bwa the index would be built with. Default is
+            the one in PATH
+        @param store - indexstore.IndexStore to look in. Default is
+            indexstore.INDEX_STORE and False never uses a store
+        @param outputfile - Where a directory of refs is concatted to
         @return path to concatted indexed reference file
     '''
     ref_files = []
@@ -83,24 +216,38 @@ def compile_refs( refs ):
         logger.info( "Compiling and concatting refs inside of {0}".format(refs) )
         files = glob.glob( os.path.join( refs, '*' ) )
         logger.debug( "All files inside of {0}: {1}".format( files, refs ) )
-        ref_files = [f for f in files if os.path.splitext(f)[1] in ref_extensions]
+        ref_files = sorted( [f for f in files if os.path.splitext(f)[1] in ref_extensions] )
         logger.debug( "Filtering files down to only files with extensions in {0}".format(ref_extensions) )
         logger.debug( "Filtered files to concat: {0}".format( ref_files ) )
         try:
-            seqio.concat_files( ref_files, 'reference.fa' )
+            if sources_current( ref_files, outputfile ):
+                logger.info( "{0} is up to date with {1}".format(outputfile, refs) )
+                return outputfile
+        except OSError:
+            pass
+        if stored_index( ref_files, outputfile, bwa_path, store ) is not None:
+            logger.info( "Using stored index for {0}".format(refs) )
+            return outputfile
+        try:
+            concat_refs( ref_files, outputfile )
         except (OSError,IOError,ValueError) as e:
             logger.error( "There was an error with the references in {0}".format(refs) )
             logger.error( str( e ) )
             sys.exit(1)
-        return 'reference.fa'
+        return outputfile
     else:
         return refs
 
-def is_indexed( ref ):
+def is_indexed( ref, verify=False ):
     '''
         Checks to see if a given reference is indexed already
 
+        When index_ref wrote a manifest for ref the index also has to still
+        match ref(see indexstore.check_manifest)
+
         @param - Refrence file name
+        @param verify - Compare the full checksum of ref with the manifest
+            instead of only its size, mtime and quick checksum
         @return True if ref is indexed, False if not
     '''
     ref_ext = set(['.amb', '.ann', '.bwt', '.pac', '.sa'])
@@ -115,15 +262,143 @@ def is_indexed( ref ):
     
     # Return true only if the intersection of the found extensions is equal to
     # the expected ref_ext set
-    return intersec == ref_ext
+    if intersec != ref_ext:
+        return False
+
+    current = indexstore.check_manifest( ref, verify )
+    if current is False:
+        logger.warning( "Index of {0} is stale since {0} changed after " \
+            "it was indexed".format(ref) )
+        return False
+    return True
+
+def clear_index( ref ):
+    '''
+        Remove the index files and manifest next to ref
+
+        @param ref - Reference path
+    '''
+    for ext in indexstore.INDEX_EXTENSIONS + (indexstore.MANIFEST_EXT,):
+        if os.path.lexists( ref + ext ):
+            os.unlink( ref + ext )
+
+def stored_index( ref_files, outputfile, bwa_path=None, store=None ):
+    '''
+        Link the stored index of what ref_files concat to as outputfile
+        (see indexstore.IndexStore.checkout)
 
-def index_ref( ref, bwa_path=None ):
+        @param ref_files - List of reference files in concat order
+        @param outputfile - Path to link the stored reference to
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @param store - See compile_refs
+        @return outputfile or None if there is no stored index to link
+    '''
+    if store is None:
+        store = indexstore.INDEX_STORE
+    if not store or not ref_files:
+        return None
+    try:
+        if bwa_path is None:
+            bwa_path = which_bwa()
+        key = store.key( cache.content_digest( ref_files ), bwa_version( bwa_path ) )
+        if store.checkout( key, outputfile ) is None:
+            return None
+    except (OSError, IOError, ValueError) as e:
+        logger.debug( "Not looking for a stored index: {0}".format(e) )
+        return None
+    record_sources( ref_files, outputfile )
+    return outputfile
+
+# Memory bwa index -a is needs per reference base
+IS_BYTES_PER_BASE = 5.37
+# is stores positions of the reference and its reverse complement in 32 bits
+IS_MAX_LENGTH = 2**30
+# Rough memory bwa index -a bwtsw needs per reference base outside of the
+# block it builds at once and per base of that block
+BWTSW_BYTES_PER_BASE = 1
+BWTSW_BYTES_PER_BLOCK_BASE = 8
+# bwa's own -b default
+DEFAULT_BLOCK_SIZE = 10000000
+# bwa parses -b into a C int
+MAX_BLOCK_SIZE = 2**31 - 1
+# Share of physical memory indexing may use when no budget is given
+INDEX_MEMORY_FRACTION = 0.5
+
+def physical_memory( ):
+    '''
+        @return bytes of physical memory or None if it cannot be found
+    '''
+    try:
+        return os.sysconf( 'SC_PAGE_SIZE' ) * os.sysconf( 'SC_PHYS_PAGES' )
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def index_options( ref, algorithm=None, block_size=None, memory=None ):
+    '''
+        Pick bwa index options that index ref the fastest within a memory
+        budget
+
+        is is used when it fits in memory and ref is short enough for it
+        since it is the fastest for those. Otherwise bwtsw is used with the
+        largest block size that fits, as bigger blocks index faster. The
+        block size is capped at what bwa can parse.
+
+        @param ref - Reference fasta path
+        @param algorithm - is or bwtsw to override the choice
+        @param block_size - -b to override the choice(only used with bwtsw)
+        @param memory - Memory budget in bytes or as a string such as 8G.
+            Default is half of physical memory
+        @return dict of bwa index options for BWAIndex
+    '''
+    memory = indexstore.parse_size( memory )
+    if memory is None:
+        physical = physical_memory()
+        if physical is not None:
+            memory = int( physical * INDEX_MEMORY_FRACTION )
+    if algorithm is None or (algorithm == 'bwtsw' and block_size is None):
+        with contextlib.closing( seqio.open_seqfile( ref ) ) as fh:
+            length = seqio.fasta_length( fh )
+        logger.debug( "{0} is {1} bases long".format(ref, length) )
+
+    if algorithm is None:
+        algorithm = 'bwtsw'
+        if length <= IS_MAX_LENGTH and \
+                (memory is None or length * IS_BYTES_PER_BASE <= memory):
+            algorithm = 'is'
+    if algorithm == 'is':
+        return {'a': 'is'}
+
+    if block_size is None:
+        block_size = DEFAULT_BLOCK_SIZE
+        if memory is not None:
+            spare = memory - length * BWTSW_BYTES_PER_BASE
+            block_size = max( block_size, spare // BWTSW_BYTES_PER_BLOCK_BASE )
+        block_size = max( 1, min( block_size, length, MAX_BLOCK_SIZE ) )
+    return {'a': 'bwtsw', 'b': int( block_size )}
+
+@instrument.timed( 'index_ref' )
+def index_ref( ref, bwa_path=None, store=None, algorithm=None, block_size=None,
+        memory=None ):
     '''
         Indexes a given reference
 
+        The index is built into the index store, or taken from it when the same
+        reference was already indexed by the same bwa version, and linked
+        next to ref
+
+        The algorithm and block size are picked from the length of ref and
+        the memory budget unless they are given(see index_options)
+
         @param ref - Reference file path to index
         @param bwa_path - Optional path to bwa executable
+        @param store - indexstore.IndexStore to use. Default is
+            indexstore.INDEX_STORE and False indexes ref in place
+        @param algorithm - bwa index -a(is or bwtsw)
+        @param block_size - bwa index -b
+        @param memory - Memory budget for indexing(see index_options)
+        @return True if ref is indexed
     '''
+    instrument.annotate( ref=ref )
     # Don't reindex an already indexed ref
     if is_indexed( ref ):
         logger.debug( "{0} is already indexed".format(ref) )
@@ -138,30 +413,987 @@ def index_ref( ref, bwa_path=None ):
         logger.critical('Reference path {0} cannot be read'.format(ref))
         return False
 
-    logger.info( "Indexing {0}".format(ref) )
+    with indexstore.index_lock( ref ):
+        # Another process may have indexed ref while we waited for the lock
+        if is_indexed( ref ):
+            logger.info( "{0} was indexed by another process".format(ref) )
+            return True
+
+        # Whatever index files are there are incomplete or stale
+        clear_index( ref )
+        try:
+            options = index_options( ref, algorithm, block_size, memory )
+        except (IOError, ValueError) as e:
+            logger.error( "Could not pick index options for {0}: {1}".format(ref, e) )
+            return False
+
+        if store is None:
+            store = indexstore.INDEX_STORE
+        if store:
+            try:
+                version = bwa_version( bwa_path )
+                digest = cache.DIGESTS.digest( ref )
+                key = store.key( digest, version )
+                stored = store.resolve( key, ref,
+                    lambda path: _bwa_index( path, bwa_path, options ),
+                    {'bwa_version': version}
+                )
+                if stored is None:
+                    return False
+                # Eviction waits for the links to be made
+                with store.key_lock( key ):
+                    if not os.path.exists( stored ):
+                        raise OSError( errno.ENOENT, "Stored index was evicted", stored )
+                    indexstore.link_index( stored, ref )
+                indexstore.write_manifest( ref, version, digest )
+                return True
+            except (OSError, IOError) as e:
+                logger.warning( "Index store {0} could not be used so indexing " \
+                    "{1} in place: {2}".format(store.root, ref, e) )
+        return _bwa_index( ref, bwa_path, options )
+
+# Outcome of indexing a single reference with index_refs
+#  indexed is True if ref ended up indexed, skipped is True if it already was,
+#  seconds is how long it took and error is why it failed or None
+IndexResult = collections.namedtuple( 'IndexResult',
+    'ref indexed skipped seconds error'
+)
+
+def index_memory_estimate( ref ):
+    '''
+        Rough memory bwa index needs for ref from its file size so it costs
+        only a stat
+
+        @param ref - Reference path
+        @return bytes
+    '''
+    size = os.path.getsize( ref )
+    if seqio.compression( ref ):
+        size *= 4
+    if size <= IS_MAX_LENGTH:
+        return int( size * IS_BYTES_PER_BASE )
+    return int( size * BWTSW_BYTES_PER_BASE + DEFAULT_BLOCK_SIZE * BWTSW_BYTES_PER_BLOCK_BASE )
+
+def index_workers( refs, workers=None, memory=None ):
+    '''
+        How many references to index at once
+
+        @param refs - Reference paths that need indexing
+        @param workers - Requested number of processes or None for 1 per cpu
+        @param memory - Memory budget in bytes for all processes or None
+        @return number of processes to use, at least 1
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if memory is not None and refs:
+        largest = max( [index_memory_estimate( ref ) for ref in refs] )
+        workers = min( workers, memory // max( 1, largest ) )
+    return max( 1, min( workers, len( refs ) ) )
+
+def index_refs( refs, bwa_path=None, workers=None, memory=None, store=None ):
+    '''
+        Index many references at once in a pool of processes
+
+        References that are already indexed are skipped. The number of
+        processes is bounded by the number of cpus and by how many of the
+        largest reference fit in memory at once. Each process gets an even
+        share of the memory budget to pick its index options with.
+
+        @param refs - List of reference paths
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @param workers - Maximum number of processes[Default: 1 per cpu]
+        @param memory - Memory budget in bytes or as a string such as 32G for
+            all processes. Default is half of physical memory
+        @param store - See index_ref
+        @return list of IndexResult in the same order as refs
+    '''
+    if bwa_path is None:
+        bwa_path = which_bwa()
+    memory = indexstore.parse_size( memory )
+    if memory is None:
+        physical = physical_memory()
+        if physical is not None:
+            memory = int( physical * INDEX_MEMORY_FRACTION )
+
+    results = {}
+    todo = []
+    for ref in refs:
+        if ref in results or ref in todo:
+            continue
+        if os.path.exists( ref ) and is_indexed( ref ):
+            results[ref] = IndexResult( ref, True, True, 0.0, None )
+        else:
+            todo.append( ref )
+
+    if todo:
+        try:
+            workers = index_workers( todo, workers, memory )
+        except OSError:
+            # Missing references fail in their job
+            workers = max( 1, min( workers or multiprocessing.cpu_count(), len( todo ) ) )
+        job_memory = None if memory is None else memory // workers
+        logger.info( "Indexing {0} references {1} at a time".format(len( todo ), workers) )
+        jobs = [(ref, bwa_path, store, job_memory) for ref in todo]
+        if workers == 1:
+            done = map( _index_ref_job, jobs )
+        else:
+            pool = multiprocessing.Pool( workers )
+            try:
+                done = pool.map( _index_ref_job, jobs )
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        for result in done:
+            results[result.ref] = result
+            if result.indexed:
+                logger.info( "Indexed {0} in {1:.2f}s".format(result.ref, result.seconds) )
+            else:
+                logger.error( "Failed to index {0} after {1:.2f}s: {2}".format(
+                        result.ref, result.seconds, result.error
+                    )
+                )
+    return [results[ref] for ref in refs]
+
+def _index_ref_job( args ):
+    '''
+        Pool worker that indexes a single reference
+
+        @param args - (ref, bwa_path, store, memory)
+        @return IndexResult
+    '''
+    ref, bwa_path, store, memory = args
+    start = time.time()
+    error = None
+    indexed = False
     try:
-        ret = BWAIndex( ref, bwa_path=bwa_path ).run()
-    except ValueError as e:
-        logger.error( e )
+        indexed = index_ref( ref, bwa_path, store, memory=memory )
+        if not indexed:
+            if os.path.exists( ref ):
+                error = 'bwa index failed'
+            else:
+                error = 'reference does not exist'
+    except Exception as e:
+        error = str( e ) or e.__class__.__name__
+    return IndexResult( ref, indexed, False, time.time() - start, error )
 
-    if ret != 0:
-        logger.error( "Error running bwa index on {0}".format( ref ) )
+def _bwa_index( ref, bwa_path, options=None ):
+    '''
+        Run bwa index on ref
+
+        The index is written with bwa index -p into a temporary directory next
+        to ref and its files are renamed into place once bwa finishes so
+        nothing ever sees a half written index
+
+        @param options - Extra BWAIndex options such as {'a': 'bwtsw'}
+        @return True if it was indexed
+    '''
+    logger.info( "Indexing {0}".format(ref) )
+    try:
+        tmpdir = tempfile.mkdtemp( prefix='.pybwa', dir=os.path.dirname( ref ) or '.' )
+    except OSError as e:
+        logger.error( "Cannot index {0}: {1}".format(ref, e) )
         return False
-    else:
-        logger.info( "bwa index ran on {0}".format(ref) )
+    try:
+        prefix = os.path.join( tmpdir, os.path.basename( ref ) )
+        options = dict( options or {}, p=prefix )
+        ret = 1
+        try:
+            ret = BWAIndex( ref, bwa_path=bwa_path, **options ).run()
+        except ValueError as e:
+            logger.error( e )
+
+        if ret != 0:
+            logger.error( "Error running bwa index on {0}".format( ref ) )
+            return False
+        try:
+            for ext in indexstore.INDEX_EXTENSIONS:
+                os.rename( prefix + ext, ref + ext )
+        except OSError as e:
+            logger.error( "bwa index did not write the index of {0}: {1}".format(ref, e) )
+            clear_index( ref )
+            return False
+    finally:
+        shutil.rmtree( tmpdir )
+
+    logger.info( "bwa index ran on {0}".format(ref) )
+    try:
+        indexstore.write_manifest( ref, bwa_version( bwa_path ) )
+    except (OSError, IOError) as e:
+        logger.warning( "Could not write index manifest for {0}: {1}".format(ref, e) )
+    return True
+
+def shm_indexes( bwa_path=None ):
+    '''
+        List the indexes bwa has loaded into shared memory
+
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @return dictionary of index name to its size in bytes
+    '''
+    if bwa_path is None:
+        bwa_path = which_bwa()
+    p = Popen( [bwa_path, 'shm', '-l'], stdout=PIPE, stderr=PIPE )
+    stdout, stderr = p.communicate()
+    indexes = {}
+    for line in stdout.splitlines():
+        fields = line.split( '\t' )
+        if len( fields ) == 2 and fields[1].isdigit():
+            indexes[fields[0]] = int( fields[1] )
+    return indexes
+
+def shm_dir( ):
+    '''
+        Directory SharedIndex links references into under names made from
+        their content so they are unique in shared memory
+
+        @return path to the directory(may not exist yet)
+    '''
+    return os.path.join( cache.cache_dir(), 'shm' )
+
+class SharedIndex( object ):
+    '''
+        Keeps the index of a reference in shared memory with bwa shm so every
+        bwa mem run against it skips loading the index from disk
+
+            with SharedIndex( 'reference.fa' ) as shared:
+                for sample in samples:
+                    BWAMem( shared.path, sample ).run( sample + '.sam' )
+
+        bwa finds the index in shared memory by the file name of the
+        reference so the reference and its index are linked into shm_dir()
+        as <content digest>.fa and that is what is loaded. BWAMem has to be
+        given path for bwa mem to use the shared copy. An index of the same
+        content that is already loaded is used as is.
+
+        Every SharedIndex using an index holds a shared lock on it. The last
+        one to let go drops the index when the block exits, when python exits
+        and on SIGTERM, as long as a SharedIndex loaded it. bwa shm -d drops
+        every index in shared memory so it is left loaded when other indexes
+        are loaded too unless drop is forced.
+    '''
+    # Held shared by every user of an index
+    USERS_EXT = '.pybwa.users'
+    # Exists while an index that a SharedIndex loaded is in shared memory
+    LOADED_EXT = '.pybwa.shm'
+
+    def __init__( self, ref, bwa_path=None, tmpfile=None ):
+        '''
+            @param ref - Indexed reference path
+            @param bwa_path - Path to bwa. Default is the one in PATH
+            @param tmpfile - bwa shm -f temporary file that lowers peak memory
+                while loading a large index
+        '''
+        self.ref = ref
+        self.bwa_path = bwa_path or which_bwa()
+        self.tmpfile = tmpfile
+        # Content keyed link to ref that bwa mem has to be given. Set by load
+        self.path = None
+        self.name = None
+        # True while this instance has the index loaded
+        self.loaded = False
+        self._users = None
+        # True while this instance holds the load lock
+        self._locked = False
+        self._prev_sigterm = None
+        self._atexit = False
+
+    def __enter__( self ):
+        self.load()
+        return self
+
+    def __exit__( self, exc_type, exc_value, tb ):
+        self.drop()
+
+    def link( self ):
+        '''
+            Link ref, its index and manifest into shm_dir() named by the
+            content digest of ref
+
+            @raises OSError, IOError if ref cannot be read or linked
+            @return path of the link
+        '''
+        dirname = shm_dir()
+        if not os.path.isdir( dirname ):
+            try:
+                os.makedirs( dirname )
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = os.path.join( dirname, cache.DIGESTS.digest( self.ref ) + '.fa' )
+        for ext in ('', indexstore.MANIFEST_EXT):
+            if os.path.lexists( path + ext ) or not os.path.exists( self.ref + ext ):
+                continue
+            try:
+                os.link( self.ref + ext, path + ext )
+            except OSError:
+                os.symlink( os.path.abspath( self.ref + ext ), path + ext )
+        indexstore.link_index( self.ref, path, copy=False )
+        return path
+
+    def load( self ):
+        '''
+            Load the index into shared memory unless it is already there
+
+            @raises ValueError if ref is not indexed, bwa has no shm command
+                or bwa shm fails
+            @return True if this loaded it
+        '''
+        if self._users is not None:
+            return self.loaded
+        if not is_indexed( self.ref ):
+            raise ValueError( "{0} is not indexed".format(self.ref) )
+        if not bwa_supports( 'shm', self.bwa_path ):
+            raise ValueError( "{0} does not have bwa shm".format(self.bwa_path) )
+        try:
+            self.path = self.link()
+        except (OSError, IOError) as e:
+            raise ValueError( "Could not link {0} into {1}: {2}".format(self.ref, shm_dir(), e) )
+        self.name = os.path.basename( self.path )
+        # Loading and dropping happen one process at a time
+        with indexstore.file_lock( self.path + indexstore.LOCK_EXT ):
+            self._locked = True
+            try:
+                return self._load()
+            finally:
+                self._locked = False
+
+    def _load( self ):
+        ''' load while holding the load lock '''
+        self._users = open( self.path + self.USERS_EXT, 'a' )
+        fcntl.flock( self._users, fcntl.LOCK_SH )
+        # Every user drops it on exit in case it is the last one
+        self._register()
+        if self.name in shm_indexes( self.bwa_path ):
+            logger.info( "Index of {0} is already in shared memory as {1}".format(
+                    self.ref, self.name
+                )
+            )
+            return False
+        cmd = [self.bwa_path, 'shm']
+        if self.tmpfile:
+            cmd += ['-f', self.tmpfile]
+        cmd.append( self.path )
+        logger.info( "Loading index of {0} into shared memory as {1}".format(self.ref, self.name) )
+        # Marked before loading so a partial load is still dropped
+        open( self.path + self.LOADED_EXT, 'a' ).close()
+        self.loaded = True
+        p = Popen( cmd, stdout=PIPE, stderr=PIPE )
+        stdout, stderr = p.communicate()
+        if p.returncode != 0 or self.name not in shm_indexes( self.bwa_path ):
+            self._drop()
+            raise ValueError( "bwa shm could not load {0}: {1}".format(self.ref, stderr) )
         return True
 
+    def drop( self, force=False ):
+        '''
+            Stop using the index and drop it from shared memory when nothing
+            else uses it and a SharedIndex loaded it
+
+            @param force - Drop it even though bwa shm -d drops every other
+                index in shared memory as well
+        '''
+        if self._users is None:
+            return
+        # Such as SIGTERM arriving while loading
+        if self._locked:
+            return self._drop( force )
+        with indexstore.file_lock( self.path + indexstore.LOCK_EXT ):
+            self._drop( force )
+
+    def _drop( self, force=False ):
+        ''' drop while holding the load lock '''
+        self._users.close()
+        self._users = None
+        self.loaded = False
+        self._unregister()
+        with open( self.path + self.USERS_EXT, 'a' ) as users:
+            try:
+                fcntl.flock( users, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                logger.info( "Leaving index {0} in shared memory since it is still in use".format(self.name) )
+                return
+            if not os.path.exists( self.path + self.LOADED_EXT ):
+                return
+            others = [n for n in shm_indexes( self.bwa_path ) if n != self.name]
+            if others and not force:
+                logger.warning( "Leaving index {0} in shared memory since bwa shm -d would " \
+                    "also drop {1}".format(self.name, ', '.join( others ))
+                )
+                return
+            if others:
+                logger.warning( "Also dropping {0} from shared memory".format(', '.join( others )) )
+            logger.info( "Dropping index {0} from shared memory".format(self.name) )
+            call( [self.bwa_path, 'shm', '-d'], stdout=PIPE, stderr=PIPE )
+            os.unlink( self.path + self.LOADED_EXT )
+
+    def _register( self ):
+        ''' Make sure drop runs if python exits or is terminated '''
+        if not self._atexit:
+            # atexit cannot unregister so drop does nothing once it already ran
+            atexit.register( self.drop )
+            self._atexit = True
+        try:
+            self._prev_sigterm = signal.signal( signal.SIGTERM, self._sigterm )
+        except ValueError:
+            # Signals can only be handled in the main thread
+            self._prev_sigterm = None
+
+    def _unregister( self ):
+        if self._prev_sigterm is not None:
+            try:
+                signal.signal( signal.SIGTERM, self._prev_sigterm )
+            except ValueError:
+                pass
+            self._prev_sigterm = None
+
+    def _sigterm( self, signum, frame ):
+        ''' Drop the index then do whatever SIGTERM did before '''
+        prev = self._prev_sigterm
+        self.drop()
+        if callable( prev ):
+            prev( signum, frame )
+        elif prev != signal.SIG_IGN:
+            signal.signal( signum, signal.SIG_DFL )
+            os.kill( os.getpid(), signum )
+
+# Executables already found keyed by name and PATH
+_WHICH = {}
+
+def which( program ):
+    '''
+        Find program in PATH the way which does without starting a process
+
+        @param program - Executable name
+        @return absolute path to the first executable program in PATH or ''
+            if there is none
+    '''
+    search = os.environ.get( 'PATH', os.defpath )
+    path = _WHICH.get( (program, search) )
+    if path and os.access( path, os.X_OK ):
+        return path
+    for directory in search.split( os.pathsep ):
+        path = os.path.join( directory or '.', program )
+        if os.path.isfile( path ) and os.access( path, os.X_OK ):
+            # Relative PATH entries depend on the current directory
+            if os.path.isabs( directory ):
+                _WHICH[(program, search)] = path
+            return os.path.abspath( path )
+    return ''
+
 def which_bwa( ):
     '''
         Return output of which bwa
     '''
-    return str(sh.which('bwa')).strip()
+    return which( 'bwa' )
+
+# Printed in bwa's usage
+#  Version: 0.7.15-r1140
+VERSION_REGEX = re.compile( 'Version:\s*(\S+)' )
+# Commands listed in bwa's usage
+#  Command: index         index sequences in the FASTA format
+#           mem           BWA-MEM algorithm
+COMMAND_REGEX = re.compile( '^(?:Command:)?\s+(\w+)\s{2,}\S', re.M )
+
+class BWAProbe( cache.FileCache ):
+    '''
+        Version and commands of bwa binaries parsed from their usage so
+        bwa only has to be run once for each binary instead of in every
+        process. A rebuilt or replaced bwa has a different inode, size or mtime
+        and is probed again.
+    '''
+    FILENAME = 'bwa.json'
+
+    def compute( self, filename ):
+        '''
+            @raises OSError if filename cannot be run
+            @return {'version': version or 'unknown', 'commands': [command,...]}
+        '''
+        p = Popen( [filename], stdout=PIPE, stderr=PIPE )
+        output = ''.join( p.communicate() )
+        m = VERSION_REGEX.search( output )
+        commands = output.partition( 'Command:' )
+        commands = commands[1] + commands[2].partition( 'Note:' )[0]
+        return {
+            'version': m.group( 1 ) if m else 'unknown',
+            'commands': COMMAND_REGEX.findall( commands )
+        }
+
+# Probes of every bwa used by this process
+BWA_PROBES = BWAProbe()
+
+def probe_bwa( bwa_path=None ):
+    '''
+        @raises OSError if bwa cannot be run
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @return what BWAProbe.compute returns for bwa_path
+    '''
+    if bwa_path is None:
+        bwa_path = which_bwa()
+    return BWA_PROBES.value( bwa_path )
+
+def bwa_version( bwa_path=None ):
+    '''
+        Version of bwa as printed in its usage
+
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @return version string or 'unknown' if it is not printed
+    '''
+    return probe_bwa( bwa_path )['version']
+
+def bwa_supports( command, bwa_path=None ):
+    '''
+        Whether bwa has command such as shm, which older versions lack
+
+        @param command - bwa command
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @return True if bwa lists command in its usage or lists no commands
+            at all so it cannot be told
+    '''
+    commands = probe_bwa( bwa_path )['commands']
+    return not commands or command in commands
+
+def which_samtools( ):
+    '''
+        Return output of which samtools
+    '''
+    return which( 'samtools' )
 
 def bwa_usage():
     '''
         Returns the output of just running bwa mem from command line
     '''
-    return str(sh.bwa('mem')).strip()
+    p = Popen( [which_bwa(), 'mem'], stdout=PIPE, stderr=PIPE )
+    return ''.join( p.communicate() ).strip()
+
+def shard_sizes( total, shards, unit=1 ):
+    '''
+        Split total reads into at most shards contiguous chunks that are as
+        even as possible
+
+        @param total - Number of reads to split
+        @param shards - Maximum number of chunks
+        @param unit - Chunks hold a multiple of this many reads such as 2 for
+            interleaved pairs. Any remainder goes to the last chunk
+        @return list of chunk sizes without any empty chunks
+    '''
+    units = total // unit
+    shards = max( 1, min( shards, units ) )
+    base, extra = divmod( units, shards )
+    sizes = [(base + (i < extra)) * unit for i in range( shards )]
+    sizes[-1] += total % unit
+    return [size for size in sizes if size]
+
+class BackgroundCall( threading.Thread ):
+    '''
+        Run a function in a daemon thread and hand back its return value
+        or exception through result()
+    '''
+    def __init__( self, func, *args ):
+        super( BackgroundCall, self ).__init__()
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+
+    def run( self ):
+        try:
+            self.value = self.func( *self.args )
+        except Exception as e:
+            self.error = e
+
+    def result( self ):
+        '''
+            Wait for func to finish
+
+            @raises whatever func raised
+            @return what func returned
+        '''
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def stop_process( process ):
+    '''
+        Kill process if it is still running, reap it and close its stderr
+
+        @param process - Popen with a stderr pipe
+    '''
+    if process.returncode is None and process.poll() is None:
+        try:
+            process.kill()
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    instrument.wait( process )
+    if process.stderr is not None:
+        process.stderr.close()
+
+def follow_process( process, monitor ):
+    '''
+        Feed the stderr of process to monitor until process closes it
+
+        If that raises, such as a progress callback failing, process is
+        stopped before the error is passed on so it is never left running
+        with nobody reading its stderr
+
+        @param process - Popen with a stderr pipe
+        @param monitor - StderrMonitor
+        @return monitor
+    '''
+    try:
+        return monitor.follow( process.stderr )
+    except:
+        stop_process( process )
+        raise
+
+class SAMStream( object ):
+    '''
+        Iterates over the SAM output of a running bwa process, yielding a
+        sam.SAMHeader first and then a sam.SAMRecord for every alignment
+
+        bwa blocks on writing once the pipe is full so it only runs as fast as
+        the records are consumed. returncode is None until the stream has been
+        exhausted and is then set to what bwa_return_code would have returned.
+    '''
+    def __init__( self, bwa, process, monitor ):
+        '''
+            @param bwa - BWA instance that started process
+            @param process - Popen with stdout and stderr pipes
+            @param monitor - StderrMonitor for process
+        '''
+        self.bwa = bwa
+        self.process = process
+        self.monitor = monitor
+        self.returncode = None
+        # stderr has to be drained while stdout is read or bwa can block
+        self._stderr = BackgroundCall( follow_process, process, monitor )
+        self._stderr.start()
+
+    def __iter__( self ):
+        exhausted = False
+        try:
+            for item in iter_sam( self.process.stdout ):
+                yield item
+            exhausted = True
+        finally:
+            # Abandoned or failed part way through
+            if not exhausted:
+                self.close()
+        self._finish()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, tb ):
+        self.close()
+
+    def close( self ):
+        '''
+            Stop bwa if the stream was not exhausted
+        '''
+        if self.process.poll() is None:
+            logger.info( "Stopping bwa before all output was read" )
+            self.process.kill()
+        self.process.stdout.close()
+        instrument.wait( self.process )
+        self._stderr.join()
+
+    def _finish( self ):
+        instrument.wait( self.process )
+        self._stderr.result()
+        logger.debug( "STDERR: {0}".format(self.monitor.output()) )
+        self.returncode = self.bwa.bwa_return_code(
+            self.monitor.output(), self.monitor
+        )
+
+class CancelledError( Exception ):
+    ''' Raised by BWAJob.result when the job was cancelled '''
+    pass
+
+class BWAJob( object ):
+    '''
+        Handle of a bwa process started with run_async that never blocks
+        unless result is called
+
+        bwa's stderr is only read when poll is called so a job can be driven
+        by any event loop by waiting for fileno to become readable:
+
+            job = BWAMem( ref, reads ).run_async( 'out.sam' )
+            while job.poll() is None:
+                select.select( [job], [], [] )
+            job.result()
+
+        Progress callbacks are called from poll so they run in the thread
+        that drives the job.
+
+        Once bwa closes stderr poll keeps returning None until the input read
+        count or SAM verification running in the background(see
+        BWA.background_calls) is done. fileno stays readable meanwhile so
+        result waits on those threads instead of on fileno.
+    '''
+    def __init__( self, bwa, process, monitor, cleanup=None ):
+        '''
+            @param bwa - BWA instance that started process
+            @param process - Popen with a stderr pipe
+            @param monitor - StderrMonitor for process
+            @param cleanup - Called once the job is finished or cancelled
+        '''
+        self.bwa = bwa
+        self.process = process
+        self.monitor = monitor
+        self.returncode = None
+        self.cancelled = False
+        self._cleanup = cleanup
+        self._partial = ''
+        # True once bwa closed stderr
+        self._eof = False
+        fd = process.stderr.fileno()
+        flags = fcntl.fcntl( fd, fcntl.F_GETFL )
+        fcntl.fcntl( fd, fcntl.F_SETFL, flags | os.O_NONBLOCK )
+
+    def fileno( self ):
+        ''' stderr of bwa which is readable whenever poll has work to do '''
+        return self.process.stderr.fileno()
+
+    def done( self ):
+        ''' @return True once the job finished or was cancelled '''
+        return self.cancelled or self.returncode is not None
+
+    def poll( self ):
+        '''
+            Parse whatever bwa wrote to stderr since the last call
+
+            @return None while bwa is running, otherwise what bwa_return_code
+                returned just like run does
+        '''
+        if self.done():
+            return self.returncode
+        while not self._eof:
+            try:
+                data = os.read( self.fileno(), 65536 )
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                raise
+            if not data:
+                self._eof = True
+                break
+            lines = (self._partial + data).split( '\n' )
+            self._partial = lines.pop()
+            for line in lines:
+                self.monitor.feed( line + '\n' )
+        if self._pending():
+            return None
+        self._finish()
+        return self.returncode
+
+    def result( self, timeout=None ):
+        '''
+            Wait for bwa to finish
+
+            @raises CancelledError if the job was cancelled
+            @param timeout - Seconds to wait at most or None to wait until done
+            @return what bwa_return_code returned or None if timeout expired
+        '''
+        end = None if timeout is None else time.time() + timeout
+        while self.poll() is None and not self.cancelled:
+            wait = None if end is None else max( 0, end - time.time() )
+            if wait == 0:
+                return None
+            pending = self._pending()
+            if pending:
+                pending[0].join( wait )
+            else:
+                select.select( [self], [], [], wait )
+        if self.cancelled:
+            raise CancelledError( "bwa job was cancelled" )
+        return self.returncode
+
+    def cancel( self ):
+        '''
+            Kill bwa if it is still running
+
+            @return True if it was cancelled, False if it had already finished
+        '''
+        if self.done():
+            return False
+        logger.info( "Cancelling bwa" )
+        self.cancelled = True
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self._close()
+        return True
+
+    def _pending( self ):
+        ''' @return background calls of bwa still running once stderr closed '''
+        if not self._eof:
+            return []
+        return [c for c in self.bwa.background_calls() if c.is_alive()]
+
+    def _finish( self ):
+        if self._partial:
+            self.monitor.feed( self._partial )
+            self._partial = ''
+        instrument.wait( self.process )
+        self._close()
+        logger.debug( "STDERR: {0}".format(self.monitor.output()) )
+        self.returncode = self.bwa.bwa_return_code(
+            self.monitor.output(), self.monitor
+        )
+
+    def _close( self ):
+        self.process.stderr.close()
+        for feeder in getattr( self.bwa, 'feeders', {} ).values():
+            feeder.cleanup()
+        if self._cleanup is not None:
+            self._cleanup()
+            self._cleanup = None
+
+class Shard( object ):
+    '''
+        Single bwa process of a sharded run that writes its SAM output to its
+        own file and feeds its stderr into a monitor shared by all shards
+    '''
+    def __init__( self, cmd, output, combined ):
+        '''
+            @param cmd - Full bwa command
+            @param output - Path to write the SAM output to
+            @param combined - StderrMonitor that all shards feed
+        '''
+        self.cmd = cmd
+        self.output = output
+        self.combined = combined
+        self.monitor = StderrMonitor()
+        logger.info( "Running {0}".format( " ".join( cmd ) ) )
+        with open( output, 'wb' ) as fh:
+            self.process = Popen( cmd, stdout=fh, stderr=PIPE )
+        self._stderr = BackgroundCall( self.follow )
+        self._stderr.start()
+
+    def follow( self ):
+        '''
+            Feed stderr lines to both monitors until bwa closes it
+            bwa is stopped if feeding them raises(see follow_process)
+        '''
+        try:
+            for line in iter( self.process.stderr.readline, '' ):
+                self.monitor.feed( line )
+                self.combined.feed( line )
+        except:
+            stop_process( self.process )
+            raise
+
+    def wait( self ):
+        '''
+            Wait for bwa and its stderr to finish
+
+            @return StderrMonitor of this shard
+        '''
+        instrument.wait( self.process )
+        self._stderr.result()
+        return self.monitor
+
+    def write_sam( self, fh, header=True ):
+        '''
+            Append this shard's SAM output to fh
+
+            @param fh - File handle to write to
+            @param header - Include the header lines
+        '''
+        with open( self.output, 'rb' ) as fr:
+            if not header:
+                # Header lines are the only ones that can start with @
+                for line in iter( fr.readline, '' ):
+                    if not line.startswith( '@' ):
+                        fh.write( line )
+                        break
+            shutil.copyfileobj( fr, fh, seqio.READ_BLOCK_SIZE )
+
+    def close( self ):
+        ''' Stop bwa if it is still running '''
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self._stderr.join()
+
+class FifoFeeder( BackgroundCall ):
+    '''
+        Writes a seqio.ReadStream into a named pipe in the background for a
+        process to read as if it were a file
+
+        result() is the number of reads written or None if the process went
+        away before it read everything
+    '''
+    def __init__( self, stream ):
+        '''
+            Creates the named pipe
+
+            @param stream - seqio.ReadStream to write
+        '''
+        super( FifoFeeder, self ).__init__( self.feed )
+        self.stream = stream
+        self.process = None
+        self.tmpdir = tempfile.mkdtemp( prefix='pybwa' )
+        self.fifo = os.path.join( self.tmpdir, 'reads.fastq' )
+        os.mkfifo( self.fifo )
+
+    def start( self, process=None ):
+        '''
+            @param process - Popen that reads the fifo. Used to give up if it
+                exits without opening the fifo
+        '''
+        self.process = process
+        super( FifoFeeder, self ).start()
+
+    def cleanup( self ):
+        ''' Remove the named pipe '''
+        shutil.rmtree( self.tmpdir, True )
+
+    def feed( self ):
+        try:
+            fd = self._open_fifo()
+            if fd is None:
+                logger.warning( "Nothing read {0} from {1}".format(self.stream, self.fifo) )
+                return None
+            try:
+                with os.fdopen( fd, 'wb' ) as fh:
+                    return self.stream.write( fh )
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                logger.warning( "Reader of {0} exited early".format(self.fifo) )
+                return None
+        finally:
+            self.cleanup()
+
+    def _open_fifo( self ):
+        '''
+            Open the fifo for writing without blocking forever if the reader
+            never shows up
+
+            @return blocking file descriptor or None if process exited
+        '''
+        while True:
+            try:
+                fd = os.open( self.fifo, os.O_WRONLY | os.O_NONBLOCK )
+            except OSError as e:
+                # No reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+                if self.process is not None and self.process.poll() is not None:
+                    return None
+                time.sleep( 0.05 )
+                continue
+            flags = fcntl.fcntl( fd, fcntl.F_GETFL )
+            fcntl.fcntl( fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK )
+            return fd
 
 class BWA( object ):
     # Options that are required
@@ -182,10 +1414,17 @@ class BWA( object ):
             
             Class Options:
                 bwa_path as a kwarg that specifies the path to the bwa executable
+                validation as a kwarg that sets how thoroughly inputs are
+                    checked. One of seqio.VALIDATION_LEVELS. Default samples
+                    large files and fully checks small ones
         '''
         # Save args, kwargs for parsing
         self.kwargs = kwargs
         self.args = list( args )
+        # Not a bwa option so it never ends up in self.options
+        self.validation = self.kwargs.pop( 'validation', None )
+        if self.validation is not None and self.validation not in seqio.VALIDATION_LEVELS:
+            raise ValueError( "{0} is not a validation level".format(self.validation) )
         # Options list
         self.options = []
         # Required options values. If you zip REQUIRED_OPTIONS and required_options_values you will get a
@@ -237,12 +1476,17 @@ class BWA( object ):
             if val.lower() not in ('true','false'):
                 self.options.append( val )
 
-    def bwa_return_code( self, output ):
+    @instrument.timed( 'bwa_return_code' )
+    def bwa_return_code( self, output, monitor=None ):
         '''
             Parse stderr output to find if it executed without errors
             Since it seems that bwa does not set return codes we have to parse
             stderr output instead
 
+            monitor is the StderrMonitor that followed the run if there was one
+            and holds the totals parsed from all of stderr while output may
+            only be its tail
+
             If the following regex is found then the Usage statement was printed 
              which indicates a failure of one of the options:
                 ^Usage:\s+bwa
@@ -264,62 +1508,168 @@ class BWA( object ):
         # Otherwise return 0
         return 0
 
-    def run( self, output_file='bwa.sai' ):
+    def run( self, output_file='bwa.sai', progress=None ):
         '''
             Wrapper function to make running bwa easier so you don't have to supply
             a bunch of arguments
 
             @param output_file - The file path to write the sai output to
+            @param progress - Callable that is given a monitor.Progress each time
+                bwa reports reading more reads
             @returns output of self.run_bwa
         '''
         return self.run_bwa( self.required_options_values, self.options, 
-            self.args, output_file )
+            self.args, output_file, progress )
 
-    def run_bwa( self, required_options, options_list, args_list, output_file='bwa.sai' ):
+    def run_async( self, output_file='bwa.sai', progress=None ):
+        '''
+            Start bwa like run does without waiting for it to finish
+
+            bwa mem output is always written as SAM
+
+            @param output_file - The file path to write the output to
+            @param progress - Progress callback(see run)
+            @returns BWAJob
+        '''
+        return self._start_job( output_file, progress )
+
+    def _start_job( self, output_file, progress=None, cleanup=None ):
+        '''
+            @param cleanup - Called once the job finished or was cancelled
+            @returns BWAJob writing stdout to output_file
+        '''
+        with open( output_file, 'wb' ) as fh:
+            p, monitor = self.start_bwa( self.required_options_values,
+                self.options, self.args, fh, progress )
+        return BWAJob( self, p, monitor, cleanup )
+
+    def run_bwa( self, required_options, options_list, args_list, output_file='bwa.sai', progress=None ):
         '''
             @param required_options - Should correspond to self.REQUIRED_OPTIONS
             @param options_list - Full options for bwa as a list (ex. ['mem', '-t', '2'])
             @param args_list - Required arguments that come after options
             @param output_file - Output location for stdout
+            @param progress - Progress callback(see run)
 
             @returns 0 for success, 2 if incorrect options
 
             Subclass implementation should return 1 for any other failures
         '''
+        with instrument.stage( 'run_bwa' ):
+            # Run bwa
+            with open( output_file, 'wb' ) as fh:
+                p, monitor = self.start_bwa(
+                    required_options, options_list, args_list, fh, progress
+                )
+                # Parse stderr as it is written
+                follow_process( p, monitor )
+                instrument.wait( p )
+            logger.debug( "STDERR: {0}".format(monitor.output()) )
+
+            # Parse the status
+            return self.bwa_return_code( monitor.output(), monitor )
+
+    def start_bwa( self, required_options, options_list, args_list, stdout, progress=None ):
+        '''
+            Start bwa without waiting for it
+
+            @param required_options, options_list, args_list - See run_bwa
+            @param stdout - Where bwa's stdout goes. Anything Popen accepts
+            @param progress - Progress callback(see run)
+
+            @raises ValueError if the bwa path is not valid
+            @returns (Popen, StderrMonitor) where the monitor has not read any
+                of the process's stderr yet
+        '''
         if not os.path.exists( required_options[0] ):
             raise ValueError( "{0} is not a valid bwa path".format( required_options[0] ) )
 
-        # Run bwa
-        with open( output_file, 'wb' ) as fh:
-            cmd = required_options + options_list + args_list
-            logger.info( "Running {0}".format( " ".join( cmd ) ) )
-            p = Popen( cmd, stdout=fh, stderr=PIPE )
+        # Read streams are handed to bwa as named pipes
+        self.feeders = {}
+        cmd_args = []
+        for arg in args_list:
+            if isinstance( arg, seqio.ReadStream ):
+                feeder = FifoFeeder( arg )
+                self.feeders[id( arg )] = feeder
+                arg = feeder.fifo
+            cmd_args.append( arg )
 
-            # Get the output
-            stdout, stderr = p.communicate()
-        logger.debug( "STDERR: {0}".format(stderr) )
+        cmd = required_options + options_list + cmd_args
+        logger.info( "Running {0}".format( " ".join( cmd ) ) )
+        instrument.annotate( command=" ".join( cmd ) )
+        try:
+            p = Popen( cmd, stdout=stdout, stderr=PIPE )
+        except:
+            for feeder in self.feeders.values():
+                feeder.cleanup()
+            raise
+        for feeder in self.feeders.values():
+            feeder.start( p )
+        self.start_expected_count()
+        monitor = StderrMonitor(
+            callback=progress, expected_reads=self.expected_reads_hint
+        )
+        return p, monitor
 
-        # Parse the status
-        return self.bwa_return_code( stderr )
+    def start_expected_count( self ):
+        '''
+            Called as soon as bwa is started so subclasses can work out what
+            bwa_return_code needs while bwa is still running
+        '''
+        pass
+
+    def background_calls( self ):
+        '''
+            @return BackgroundCall threads bwa_return_code collects from once
+                bwa finishes
+        '''
+        return []
+
+    def expected_reads_hint( self ):
+        '''
+            Number of reads bwa is expected to process if it is already known
+            Only used to estimate time remaining
+
+            @return None as only subclasses know what bwa will process
+        '''
+        return None
 
     def validate_indexed_fasta( self, fastapath ):
         '''
             Make sure fastapath is a valid path and already has an index
 
+            With validation none only the path is checked, full compares the
+            full checksum of fastapath with its index manifest and sample
+            only its size, mtime and quick checksum(see is_indexed)
+
             @param fastapath - Path to fasta file
         '''
-        if not is_indexed( fastapath ):
-            raise ValueError( "{0} does not have an index".format(fastapath) )
         if not os.path.exists( fastapath ):
             raise ValueError( "{0} does not exist".format(fastapath) )
+        level = seqio.validation_level( fastapath, self.validation )
+        if level == 'none':
+            return
+        if not is_indexed( fastapath, verify=level == 'full' ):
+            raise ValueError( "{0} does not have an index".format(fastapath) )
 
     def validate_input( self, inputpath ):
-        if os.path.exists( inputpath ):
-            try:
-                seqio.seqfile_type( inputpath )
-            except ValueError:
-                raise ValueError( "{0} is not a valid input file".format(inputpath) )
-        else:
+        '''
+            Make sure inputpath is a read file or ReadStream of read files
+            at the validation level(see seqio.validate_seqfile)
+
+            @param inputpath - Read file path or seqio.ReadStream
+            @return what seqio.validate_seqfile returned for inputpath or None
+                for a ReadStream
+        '''
+        if isinstance( inputpath, seqio.ReadStream ):
+            if not inputpath.files:
+                raise ValueError( "{0} has no reads".format(inputpath) )
+            for path in inputpath.files:
+                self.validate_input( path )
+            return None
+        try:
+            return seqio.validate_seqfile( inputpath, self.validation )
+        except (ValueError, IOError, OSError):
             raise ValueError( "{0} is not a valid input file".format(inputpath) )
 
 class BWAIndex( BWA ):
@@ -335,11 +1685,21 @@ class BWAIndex( BWA ):
         '''
         if len( self.args ) != 1:
             raise ValueError( "bwa index needs only 1 parameter" )
-        self.validate_input( self.args[0] )
-        if seqio.reads_in_file( self.args[0] ) == 0:
+        ftype = self.validate_input( self.args[0] )
+        # Sampling already found records and none trusts the file
+        level = seqio.validation_level( self.args[0], self.validation )
+        if level == 'full':
+            reads = cache.reads_in_file( self.args[0] )
+        elif ftype == 'sff':
+            # Sampling only parsed the header which has the count for free
+            reads = seqio.sff_read_count( self.args[0] )
+        else:
+            reads = None
+        if reads == 0:
             raise ValueError( "{0} is not a valid file to index".format(self.args[0]) )
 
-    def bwa_return_code( self, stderr ):
+    @instrument.timed( 'bwa_return_code' )
+    def bwa_return_code( self, stderr, monitor=None ):
         ''' 
             Missing file:
                 [bwa_index] fail to open file 'bob'. Abort!
@@ -359,10 +1719,41 @@ class BWAIndex( BWA ):
         os.unlink( tmpf )
         return ret
 
+    def run_async( self ):
+        '''
+            Start bwa index without waiting for it(see BWA.run_async)
+
+            @returns BWAJob
+        '''
+        fd, tmpf = tempfile.mkstemp()
+        os.close( fd )
+        try:
+            return self._start_job( tmpf, cleanup=lambda: os.unlink( tmpf ) )
+        except:
+            os.unlink( tmpf )
+            raise
+
 class BWAMem( BWA ):
+    # How run checks that bwa processed every read
+    #  reads counts the input reads and sam counts the primary records in
+    #  bwa's output as it is written(see start_bwa)
+    VERIFICATION_MODES = ('reads', 'sam')
+
     def __init__( self, *args, **kwargs ):
-        ''' Injects mem command and runs super '''
+        '''
+            Injects mem command and runs super
+
+            verification as a kwarg is one of VERIFICATION_MODES[Default: reads]
+        '''
         kwargs['command'] = 'mem'
+        # Background count of the input reads while bwa runs
+        self._expected_count = None
+        # sam.PrimaryCounter and the thread teeing bwa's output through it
+        self._sam_counter = None
+        self._sam_copier = None
+        self.verification = kwargs.pop( 'verification', None ) or 'reads'
+        if self.verification not in self.VERIFICATION_MODES:
+            raise ValueError( "{0} is not a verification mode".format(self.verification) )
         super( BWAMem, self ).__init__( *args, **kwargs )
 
     def required_args( self ):
@@ -391,7 +1782,8 @@ class BWAMem( BWA ):
             if len( args ) == 3:
                 self.validate_input( self.args[2] )
 
-    def bwa_return_code( self, output ):
+    @instrument.timed( 'bwa_return_code' )
+    def bwa_return_code( self, output, monitor=None ):
         '''
             Just make sure bwa output has the following regex and make sure the read \d counts
             up to how many sequence lines there are
@@ -400,29 +1792,334 @@ class BWAMem( BWA ):
             Example Line:
                 [M::main_mem] read 100 sequences (111350 bp)...
                 [main] Version: 0.7.4-r385
-        '''
-        read_line_pat = '\[M::main_mem\] read (\d+) sequences \((\d+) bp\)...'
-        cpat = re.compile( read_line_pat )
 
-        total_reads = 0
-        total_bp = 0
-        counts = cpat.findall( output )
-        for reads, bps in counts:
-            total_reads += int( reads )
-            total_bp += int( bps )
+            Read totals come from monitor when given otherwise output is parsed
+        '''
+        if monitor is None:
+            monitor = StderrMonitor().parse( output )
+        total_reads = monitor.total_reads
 
-        # Count num of read sequences
-        expected_reads = seqio.reads_in_file( self.args[1] )
-        # If mates file was given count them too
-        if len( self.args ) == 3:
-            expected_reads += seqio.reads_in_file( self.args[2] )
+        expected_reads = self.expected_reads()
 
-        # No lines found in input file?
-        if expected_reads == 0:
+        # No lines found in input file or they were never fully fed to bwa?
+        if not expected_reads:
             return 1
 
         if total_reads != expected_reads:
             logger.warning( "Expecting BWA to process {0} reads but processed {1}".format(expected_reads, total_reads) )
             return 1
 
-        return super( BWAMem, self ).bwa_return_code( output )
+        return super( BWAMem, self ).bwa_return_code( output, monitor )
+
+    @instrument.timed( 'run_bwa' )
+    def run( self, output_file='bwa.sai', progress=None, output_format='sam',
+            sort_threads=1, sort_memory=None, samtools_path=None, shards=1 ):
+        '''
+            Run bwa mem writing either its SAM output or a coordinate sorted and
+            indexed BAM
+
+            With more than one shard the reads are split between that many bwa
+            processes(see align_shards) since a single bwa stops scaling well
+            before all cores of a large machine are used
+
+            @param output_file - Path to write output to
+            @param progress - Progress callback(see BWA.run)
+            @param output_format - sam writes bwa's output as is. bam pipes bwa's
+                output straight into samtools sort and then indexes the result
+            @param sort_threads - Threads samtools sort uses
+            @param sort_memory - Memory per samtools sort thread such as 768M.
+                Default is the samtools default
+            @param samtools_path - Path to samtools(>=1.3). Default is the one
+                in PATH
+            @param shards - Number of bwa processes to split the reads between
+            @returns 0 for success, 2 if incorrect options, 1 for anything else
+        '''
+        if output_format == 'sam':
+            if shards > 1:
+                return self.run_sharded( output_file, shards, progress )
+            return super( BWAMem, self ).run( output_file, progress )
+        elif output_format == 'bam':
+            return self.run_sorted_bam( output_file, progress, sort_threads,
+                sort_memory, samtools_path, shards )
+        raise ValueError( "{0} is not a valid output format".format(output_format) )
+
+    def run_sorted_bam( self, output_file, progress=None, sort_threads=1,
+            sort_memory=None, samtools_path=None, shards=1 ):
+        '''
+            Pipe bwa mem output into samtools sort and index the sorted bam
+            so no unsorted intermediate is written
+
+            See run for parameters
+        '''
+        if samtools_path is None:
+            samtools_path = which_samtools()
+        if not os.path.exists( samtools_path ):
+            raise ValueError( "{0} is not a valid samtools path".format(samtools_path) )
+
+        sort_cmd = [samtools_path, 'sort', '-@', str(sort_threads), '-O', 'bam', '-o', output_file]
+        if sort_memory:
+            sort_cmd += ['-m', str(sort_memory)]
+        sort_cmd.append( '-' )
+        logger.info( "Running {0}".format( " ".join( sort_cmd ) ) )
+        sorter = Popen( sort_cmd, stdin=PIPE )
+        try:
+            if shards > 1:
+                monitor = self.align_shards( sorter.stdin, shards, progress,
+                    os.path.dirname( output_file ) or '.' )
+            else:
+                p, monitor = self.start_bwa( self.required_options_values,
+                    self.options, self.args, sorter.stdin, progress )
+        except:
+            # A sorted bam of part of the reads is worse than none
+            sorter.stdin.close()
+            stop_process( sorter )
+            raise
+        # Only bwa should hold the write end so sort sees the end of input
+        sorter.stdin.close()
+        if shards <= 1:
+            try:
+                follow_process( p, monitor )
+                instrument.wait( p )
+            except:
+                stop_process( sorter )
+                raise
+        sort_ret = instrument.wait( sorter )
+        logger.debug( "STDERR: {0}".format(monitor.output()) )
+
+        ret = self.bwa_return_code( monitor.output(), monitor )
+        if ret != 0:
+            return ret
+        if sort_ret != 0:
+            logger.error( "samtools sort failed to create {0}".format(output_file) )
+            return 1
+        if call( [samtools_path, 'index', output_file] ) != 0:
+            logger.error( "samtools index failed to index {0}".format(output_file) )
+            return 1
+        return 0
+
+    def run_sharded( self, output_file, shards, progress=None ):
+        '''
+            Run bwa mem as shards processes merging their output into a single
+            SAM file
+
+            See run for parameters
+        '''
+        with open( output_file, 'wb' ) as fh:
+            monitor = self.align_shards( fh, shards, progress,
+                os.path.dirname( output_file ) or '.' )
+        logger.debug( "STDERR: {0}".format(monitor.output()) )
+        return self.bwa_return_code( monitor.output(), monitor )
+
+    def align_shards( self, fh, shards, progress=None, tmpdir='.' ):
+        '''
+            Split the reads into contiguous chunks, align each chunk with its
+            own bwa process and write their SAM output to fh with a single
+            header in the same order a single bwa would have written it
+
+            The thread budget(-t or 1 per cpu) is divided between the
+            processes. Mates are split at the same reads as the reads file so
+            pairs stay together and interleaved pairs(-p) are never split.
+            Each shard is started as soon as its reads are written so splitting
+            overlaps with aligning.
+
+            @raises ValueError if the reads and mates have different read counts
+            @param fh - File handle to write the merged SAM to
+            @param shards - Maximum number of bwa processes
+            @param progress - Progress callback(see BWA.run)
+            @param tmpdir - Directory to put the split reads and output in
+            @return StderrMonitor that followed all of the shards
+        '''
+        bwa_path = self.required_options_values[0]
+        if not os.path.exists( bwa_path ):
+            raise ValueError( "{0} is not a valid bwa path".format( bwa_path ) )
+        self.feeders = {}
+        self._expected_count = None
+        # Shards always count their inputs to split them
+        self._sam_counter = None
+
+        inputs = self.args[1:]
+        counts = [self.input_reads( reads ) for reads in inputs]
+        if len( inputs ) == 2 and counts[0] != counts[1]:
+            raise ValueError( "{0} has {1} reads but {2} has {3}".format(
+                    inputs[0], counts[0], inputs[1], counts[1]
+                )
+            )
+        unit = 2 if '-p' in self.options else 1
+        sizes = shard_sizes( counts[0], shards, unit )
+        options = self.shard_options( len( sizes ) )
+        monitor = StderrMonitor(
+            callback=progress, expected_reads=lambda: sum( counts )
+        )
+
+        workdir = tempfile.mkdtemp( prefix='.bwashards', dir=tmpdir )
+        records = [seqio.iter_read_records( reads ) for reads in inputs]
+        running = []
+        try:
+            for i, size in enumerate( sizes ):
+                paths = []
+                for j, recs in enumerate( records ):
+                    path = os.path.join( workdir, '{0}.{1}.reads'.format(i, j) )
+                    with open( path, 'wb' ) as out:
+                        out.writelines( itertools.islice( recs, size ) )
+                    paths.append( path )
+                cmd = self.required_options_values + options + \
+                    [self.args[0]] + paths
+                output = os.path.join( workdir, '{0}.sam'.format(i) )
+                running.append( Shard( cmd, output, monitor ) )
+
+            # Merge in order while the later shards are still running
+            for i, shard in enumerate( running ):
+                shard_monitor = shard.wait()
+                expected = sizes[i] * len( inputs )
+                if shard_monitor.total_reads != expected:
+                    logger.warning( "Shard {0} processed {1} of {2} reads".format(
+                            i, shard_monitor.total_reads, expected
+                        )
+                    )
+                shard.write_sam( fh, header=(i == 0) )
+        finally:
+            for shard in running:
+                shard.close()
+            shutil.rmtree( workdir )
+        return monitor
+
+    def shard_options( self, shards ):
+        '''
+            Options for each of shards bwa processes with the thread budget
+            from -t(or 1 per cpu) divided between them
+
+            @param shards - Number of bwa processes
+            @return options list
+        '''
+        options = list( self.options )
+        if '-t' in options:
+            i = options.index( '-t' )
+            threads = int( options[i+1] )
+            del options[i:i+2]
+        else:
+            threads = multiprocessing.cpu_count()
+        return options + ['-t', str( max( 1, threads // max( 1, shards ) ) )]
+
+    def count_expected_reads( self ):
+        '''
+            @return number of reads in the reads file plus the mates file
+        '''
+        expected_reads = self.input_reads( self.args[1] )
+        # If mates file was given count them too
+        if len( self.args ) == 3:
+            mates = self.input_reads( self.args[2] )
+            if expected_reads is None or mates is None:
+                return None
+            expected_reads += mates
+        return expected_reads
+
+    def input_reads( self, reads ):
+        '''
+            Count the reads in a single input
+
+            @param reads - Read file path or seqio.ReadStream
+            @return number of reads or None if a ReadStream was not fully read
+        '''
+        if not isinstance( reads, seqio.ReadStream ):
+            return cache.reads_in_file( reads )
+        feeder = getattr( self, 'feeders', {} ).get( id( reads ) )
+        if feeder is None:
+            return sum( [cache.reads_in_file( f ) for f in reads.files] )
+        return feeder.result()
+
+    def start_bwa( self, required_options, options_list, args_list, stdout, progress=None ):
+        '''
+            Start bwa like BWA.start_bwa
+
+            With verification set to sam, bwa writes into a pipe that a
+            background sam.tee copies to stdout. It counts the primary records
+            on the way so the reads never have to be counted. That only
+            confirms bwa wrote a record for every read it reported reading.
+
+            The input reads are still counted when the caller reads bwa's
+            output itself(stdout is PIPE as in stream).
+        '''
+        self._sam_counter = None
+        if self.verification != 'sam' or stdout == PIPE:
+            return super( BWAMem, self ).start_bwa( required_options,
+                options_list, args_list, stdout, progress )
+        # Set first so start_expected_count knows not to count the inputs
+        self._sam_counter = sam.PrimaryCounter()
+        p, monitor = super( BWAMem, self ).start_bwa( required_options,
+            options_list, args_list, PIPE, progress )
+        # The copy has its own descriptor so the caller can close stdout. It
+        #  is kept from other children so a pipe still ends when the copy does
+        fd = os.dup( stdout.fileno() )
+        fcntl.fcntl( fd, fcntl.F_SETFD, fcntl.fcntl( fd, fcntl.F_GETFD ) | fcntl.FD_CLOEXEC )
+        self._sam_copier = BackgroundCall( sam.tee, p.stdout, fd, self._sam_counter )
+        self._sam_copier.start()
+        return p, monitor
+
+    def start_expected_count( self ):
+        '''
+            Count the input reads in the background while bwa aligns them
+            unless bwa's output is being counted instead
+        '''
+        if self._sam_counter is not None:
+            return
+        self._expected_count = BackgroundCall( self.count_expected_reads )
+        self._expected_count.start()
+
+    def background_calls( self ):
+        '''
+            @return the SAM record count or the input read count that
+                expected_reads collects
+        '''
+        if self._sam_counter is not None:
+            return [self._sam_copier]
+        return [c for c in (self._expected_count,) if c is not None]
+
+    def expected_reads_hint( self ):
+        '''
+            @return the background read count if it has finished
+        '''
+        counter = self._expected_count
+        if counter is None or counter.is_alive() or counter.error is not None:
+            return None
+        return counter.value
+
+    def expected_reads( self ):
+        '''
+            Collect the count started by start_expected_count or count now if
+            it was never started. With verification set to sam it is the
+            number of primary records bwa wrote instead
+
+            @return number of reads bwa should process or None if the records
+                bwa wrote could not be counted
+        '''
+        if self._sam_counter is not None:
+            self._sam_counter = None
+            try:
+                written = self._sam_copier.result()
+            except (OSError, IOError, ValueError) as e:
+                logger.error( "Could not count the records bwa wrote: {0}".format(e) )
+                return None
+            logger.debug( "bwa wrote {0} primary records".format(written) )
+            return written
+        counter, self._expected_count = self._expected_count, None
+        if counter is None:
+            return self.count_expected_reads()
+        return counter.result()
+
+    def stream( self, progress=None ):
+        '''
+            Run bwa mem and iterate over its SAM output straight from the pipe
+            instead of writing it to a file first
+
+            >>> stream = mem.stream()
+            >>> for record in stream:
+            ...     pass
+            >>> stream.returncode
+            0
+
+            @param progress - Progress callback(see run)
+            @return SAMStream
+        '''
+        p, monitor = self.start_bwa( self.required_options_values,
+            self.options, self.args, PIPE, progress )
+        return SAMStream( self, p, monitor )
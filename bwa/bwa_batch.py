@@ -0,0 +1,358 @@
+'''
+    Map many samples in one process sharing a core budget between
+    concurrent bwa mem jobs
+
+    The manifest is a json list of samples:
+
+        [
+            {
+                "name": "sample1",
+                "reads": "sample1/reads",
+                "mates": "sample1/mates.fastq",
+                "reference": "refs/",
+                "options": {"k": 19, "M": true},
+                "bam": false
+            },
+            ...
+        ]
+
+    Only reads and reference are required. name defaults to the name of reads
+    and relative paths are relative to the manifest.
+'''
+from argparse import ArgumentParser
+import Queue
+
+import bwa
+import cache
+
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+logging.basicConfig( level=logging.DEBUG )
+logger = logging.getLogger( os.path.basename( os.path.splitext( __file__ )[0] ) )
+
+# Keys a sample in the manifest may have
+SAMPLE_KEYS = ('name', 'reads', 'mates', 'reference', 'options', 'output', 'bam')
+
+# Single sample from the manifest
+Sample = collections.namedtuple( 'Sample', SAMPLE_KEYS )
+
+# Outcome of mapping a single sample
+#  status is mapped, failed or skipped(reference could not be indexed),
+#  reads is how many reads were mapped or None if unknown
+SampleResult = collections.namedtuple( 'SampleResult',
+    'name status returncode output reads seconds threads error'
+)
+
+def main( argv=None ):
+    args = parse_args( argv )
+
+    samples = load_manifest( args.manifest )
+    results = run_batch(
+        samples, threads=args.threads, jobs=args.jobs, memory=args.memory,
+        outdir=args.outdir, shm=args.shm
+    )
+    sys.stdout.write( report( results ) )
+    if args.report:
+        cache.write_json( args.report, [r._asdict() for r in results] )
+
+    failed = [r for r in results if r.status != 'mapped']
+    if failed:
+        logger.error( "{0} of {1} samples did not map".format(len( failed ), len( results )) )
+        sys.exit( 1 )
+
+def load_manifest( manifest ):
+    '''
+        Read the samples from a manifest file
+
+        @raises ValueError if the manifest is not a valid list of samples
+        @param manifest - Path to json manifest
+        @return list of Sample
+    '''
+    with open( manifest ) as fh:
+        try:
+            entries = json.load( fh )
+        except ValueError as e:
+            raise ValueError( "{0} is not valid json: {1}".format(manifest, e) )
+    if not isinstance( entries, list ):
+        raise ValueError( "{0} has to be a list of samples".format(manifest) )
+
+    basedir = os.path.dirname( os.path.abspath( manifest ) )
+    def path( p ):
+        if p is None:
+            return None
+        return os.path.join( basedir, os.path.expanduser( p ) )
+
+    samples = []
+    for i, entry in enumerate( entries ):
+        if not isinstance( entry, dict ):
+            raise ValueError( "Sample {0} in {1} is not an object".format(i, manifest) )
+        unknown = set( entry ) - set( SAMPLE_KEYS )
+        if unknown:
+            raise ValueError( "Sample {0} in {1} has unknown keys {2}".format(
+                    i, manifest, ', '.join( sorted( unknown ) )
+                )
+            )
+        for key in ('reads', 'reference'):
+            if not entry.get( key ):
+                raise ValueError( "Sample {0} in {1} is missing {2}".format(i, manifest, key) )
+        reads = path( str( entry['reads'] ) )
+        name = str( entry.get( 'name' ) or
+            os.path.basename( reads.rstrip( os.sep ) ).split( '.' )[0] )
+        mates = entry.get( 'mates' )
+        samples.append( Sample(
+            name=name,
+            reads=reads,
+            mates=path( mates and str( mates ) ),
+            reference=path( str( entry['reference'] ) ),
+            options=dict( [(str( k ), v) for k, v in (entry.get( 'options' ) or {}).items()] ),
+            output=path( entry.get( 'output' ) and str( entry['output'] ) ),
+            bam=bool( entry.get( 'bam' ) )
+        ))
+
+    names = [s.name for s in samples]
+    duplicates = set( [n for n in names if names.count( n ) > 1] )
+    if duplicates:
+        raise ValueError( "Sample names have to be unique: {0}".format(', '.join( sorted( duplicates ) )) )
+    return samples
+
+def job_threads( threads, jobs ):
+    '''
+        Split a core budget between concurrent jobs
+
+        @param threads - Total cores to use
+        @param jobs - Number of jobs running at once
+        @return -t for each job, at least 1
+    '''
+    return max( 1, threads // max( 1, jobs ) )
+
+def prepare_references( samples, workdir='.', memory=None, bwa_path=None ):
+    '''
+        Compile and index every distinct reference of samples once
+
+        Directories of references are concatted into workdir named by their
+        path so different directories never share a file
+
+        @param samples - list of Sample
+        @param workdir - Where directories of references are concatted to
+        @param memory - Memory budget for indexing(see bwa.index_refs)
+        @param bwa_path - Path to bwa
+        @return dictionary of Sample.reference to the indexed reference path
+            or None if it could not be indexed
+    '''
+    compiled = {}
+    for sample in samples:
+        ref = sample.reference
+        if ref in compiled:
+            continue
+        outputfile = os.path.join( workdir,
+            'reference-{0}.fa'.format(hashlib.sha1( ref ).hexdigest()[:12])
+        )
+        try:
+            compiled[ref] = bwa.compile_refs( ref, bwa_path, outputfile=outputfile )
+        except SystemExit:
+            # compile_refs exits on references it cannot concat
+            compiled[ref] = None
+
+    todo = sorted( set( [c for c in compiled.values() if c is not None] ) )
+    indexed = dict( [(r.ref, r.indexed) for r in bwa.index_refs( todo, bwa_path, memory=memory )] )
+    for ref, path in compiled.items():
+        if path is not None and not indexed.get( path ):
+            compiled[ref] = None
+    return compiled
+
+def run_batch( samples, threads=None, jobs=None, memory=None, outdir='.',
+        shm=False, bwa_path=None ):
+    '''
+        Map every sample with jobs bwa mem processes running at once
+
+        @param samples - list of Sample
+        @param threads - Core budget for all jobs together[Default: 1 per cpu]
+        @param jobs - How many samples to map at once. Default is one job for
+            every 4 threads
+        @param memory - Memory budget for indexing references
+        @param outdir - Directory outputs without an output path are written
+            to as <name>.sam or <name>.bam
+        @param shm - Keep each reference in shared memory with bwa.SharedIndex
+            while its samples are mapped
+        @param bwa_path - Path to bwa. Default is the one in PATH
+        @return list of SampleResult in the same order as samples
+    '''
+    if bwa_path is None:
+        bwa_path = bwa.which_bwa()
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if jobs is None:
+        jobs = max( 1, threads // 4 )
+    jobs = max( 1, min( jobs, len( samples ) ) )
+    per_job = job_threads( threads, jobs )
+    if not os.path.isdir( outdir ):
+        os.makedirs( outdir )
+
+    refs = prepare_references( samples, outdir, memory, bwa_path )
+
+    shared = []
+    if shm:
+        shared = share_references( [r for r in set( refs.values() ) if r is not None], bwa_path )
+        # bwa mem only finds the shared copy through its content keyed link
+        links = dict( [(s.ref, s.path) for s in shared] )
+        refs = dict( [(k, links.get( r, r )) for k, r in refs.items()] )
+
+    results = {}
+    queue = Queue.Queue()
+    for sample in samples:
+        queue.put( sample )
+    def worker( ):
+        while True:
+            try:
+                sample = queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[sample.name] = map_sample(
+                sample, refs[sample.reference], per_job, outdir, bwa_path
+            )
+
+    logger.info( "Mapping {0} samples {1} at a time with {2} threads each".format(
+            len( samples ), jobs, per_job
+        )
+    )
+    try:
+        workers = [threading.Thread( target=worker ) for i in range( jobs )]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            # Joined with a timeout so KeyboardInterrupt still gets through
+            while t.is_alive():
+                t.join( 1 )
+    finally:
+        for s in shared:
+            s.drop()
+    return [results[s.name] for s in samples]
+
+def share_references( refs, bwa_path ):
+    '''
+        Load refs into shared memory
+
+        @return list of loaded bwa.SharedIndex
+    '''
+    shared = []
+    for ref in refs:
+        s = bwa.SharedIndex( ref, bwa_path )
+        try:
+            s.load()
+        except ValueError as e:
+            logger.warning( str( e ) )
+            continue
+        shared.append( s )
+    return shared
+
+def map_sample( sample, ref, threads, outdir='.', bwa_path=None ):
+    '''
+        Map a single sample
+
+        @param sample - Sample to map
+        @param ref - Indexed reference or None if it could not be indexed
+        @param threads - bwa mem -t
+        @param outdir - See run_batch
+        @param bwa_path - Path to bwa
+        @return SampleResult
+    '''
+    output = sample.output
+    if output is None:
+        output = os.path.join( outdir, sample.name + ('.bam' if sample.bam else '.sam') )
+    if ref is None:
+        return SampleResult( sample.name, 'skipped', None, output, None, 0.0,
+            threads, "reference {0} could not be indexed".format(sample.reference) )
+
+    options = dict( sample.options )
+    if 't' in options:
+        logger.warning( "Ignoring -t {0} of {1} in favor of the batch thread budget".format(
+                options['t'], sample.name
+            )
+        )
+    options['t'] = threads
+    options['bwa_path'] = bwa_path
+
+    last = []
+    start = time.time()
+    ret = None
+    reads = None
+    error = None
+    # Reads compiled from a directory only live as long as the mapping
+    tmpdir = None
+    try:
+        tmpdir = tempfile.mkdtemp( prefix='.' + sample.name, dir=outdir )
+        reads_path = bwa.compile_reads( sample.reads,
+            os.path.join( tmpdir, sample.name + '.reads.fastq' ) )
+        args = [ref, reads_path]
+        if sample.mates:
+            args.append( sample.mates )
+        mem = bwa.BWAMem( *args, **options )
+        ret = mem.run( output, progress=last.append,
+            output_format='bam' if sample.bam else 'sam' )
+        if last:
+            reads = last[-1].reads
+        else:
+            reads = mem.count_expected_reads()
+    except Exception as e:
+        error = str( e ) or e.__class__.__name__
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree( tmpdir, ignore_errors=True )
+    seconds = time.time() - start
+
+    if ret == 0:
+        status = 'mapped'
+    else:
+        status = 'failed'
+        if error is None:
+            error = 'bwa mem returned {0}'.format(ret)
+    logger.info( "{0} {1} in {2:.2f}s".format(sample.name, status, seconds) )
+    return SampleResult( sample.name, status, ret, output, reads, seconds, threads, error )
+
+def report( results ):
+    '''
+        Tab separated summary line per sample with its throughput
+
+        @param results - list of SampleResult
+        @return report text with a header line
+    '''
+    lines = ['name\tstatus\treads\tseconds\treads_per_sec\tthreads\terror\n']
+    for r in results:
+        rate = ''
+        if r.reads is not None and r.seconds > 0:
+            rate = '{0:.1f}'.format(r.reads / float( r.seconds ))
+        lines.append( '{0}\t{1}\t{2}\t{3:.2f}\t{4}\t{5}\t{6}\n'.format(
+                r.name, r.status, '' if r.reads is None else r.reads, r.seconds,
+                rate, r.threads, r.error or ''
+            )
+        )
+    return ''.join( lines )
+
+def parse_args( argv=None ):
+    parser = ArgumentParser( epilog='Map many samples listed in a json manifest with bwa mem' )
+
+    parser.add_argument( '--threads', default=None, type=int, help='Cores all jobs share[Default: 1 per cpu]' )
+    parser.add_argument( '--jobs', default=None, type=int, help='Samples mapped at once. Each gets threads/jobs bwa mem threads[Default: threads/4]' )
+    parser.add_argument( '--memory', default=None, help='Memory budget for indexing references such as 32G[Default: half of physical memory]' )
+    parser.add_argument( '--outdir', default='.', help='Directory for outputs and compiled references[Default: current directory]' )
+    parser.add_argument( '--shm', action='store_true', default=False, help='Keep each reference index in shared memory while mapping' )
+    parser.add_argument( '--report', default=None, help='Also write the summary as json to this file' )
+
+    parser.add_argument( dest='manifest', help='Json list of samples' )
+
+    return parser.parse_args( argv )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+from argparse import ArgumentParser
+
+import bwa
+
+import logging
+import os.path
+import sys
+
+logging.basicConfig( level=logging.DEBUG )
+logger = logging.getLogger( os.path.basename( os.path.splitext( __file__ )[0] ) )
+
+def main( argv=None ):
+    args = parse_args( argv )
+
+    store = False if args.no_store else None
+    results = bwa.index_refs(
+        args.refs, workers=args.workers, memory=args.memory, store=store
+    )
+    sys.stdout.write( report( results ) )
+
+    failed = [r for r in results if not r.indexed]
+    if failed:
+        logger.error( "Failed to index {0} of {1} references".format(len( failed ), len( results )) )
+        sys.exit( 1 )
+
+def report( results ):
+    '''
+        Tab separated line per reference of how indexing it went
+
+        @param results - list of bwa.IndexResult
+        @return report text
+    '''
+    lines = []
+    for r in results:
+        if r.skipped:
+            status = 'skipped'
+        elif r.indexed:
+            status = 'indexed'
+        else:
+            status = 'failed'
+        lines.append( '{0}\t{1}\t{2:.2f}\t{3}\n'.format(r.ref, status, r.seconds, r.error or '') )
+    return ''.join( lines )
+
+def parse_args( argv=None ):
+    parser = ArgumentParser( epilog='Index many references with bwa index at once' )
+
+    parser.add_argument( '--workers', default=None, type=int, help='Maximum number of references to index at once[Default: 1 per cpu]' )
+    parser.add_argument( '--memory', default=None, help='Memory all bwa index processes may use together such as 32G[Default: half of physical memory]' )
+    parser.add_argument( '--no-store', action='store_true', default=False, help='Do not use the shared index store' )
+
+    parser.add_argument( dest='refs', nargs='+', help='Reference fasta files to index' )
+
+    return parser.parse_args( argv )
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from subprocess import check_output
 
 import bwa
 import seqio
+import instrument
 
 import logging
 import os.path
@@ -16,28 +17,64 @@ logger = logging.getLogger( os.path.basename( os.path.splitext( __file__ )[0] )
 def main():
     args = parse_args().__dict__
 
+    profile_path = args.pop( 'profile' )
+    if profile_path is None:
+        run( args )
+        return
+    profile = instrument.Profile()
+    instrument.add_hook( profile )
+    try:
+        run( args )
+    finally:
+        instrument.remove_hook( profile )
+        try:
+            profile.write( profile_path )
+        except (IOError, OSError) as e:
+            logger.warning( "Could not write profile {0}: {1}".format(profile_path, e) )
+
+def run( args ):
+    '''
+        Compile, index and map as given by the parsed arguments
+
+        @param args - parse_args dictionary
+    '''
     ref_file = bwa.compile_refs( args['index'] )
     del args['index']
 
-    read_path = bwa.compile_reads( args['reads'] )
+    read_path = bwa.compile_reads( args['reads'], stream=args['stream_reads'] )
     del args['reads']
+    del args['stream_reads']
 
     mates_path = args['mates']
     del args['mates']
+    output_format = 'bam' if args['bam'] else 'sam'
     output_file = args['output']
+    if output_file is None:
+        output_file = 'bwa.bam' if args['bam'] else 'bwa.sai'
+    sort_threads = args['sort_threads']
+    sort_memory = args['sort_memory']
+    shards = args['shards']
 
     del args['output']
+    del args['bam']
+    del args['sort_threads']
+    del args['sort_memory']
+    del args['shards']
     args['bwa_path'] = bwa.which_bwa()
 
     ret = 1
     ret = bwa.index_ref( ref_file )
 
     ret = 1
+    run_args = dict(
+        output_format=output_format, sort_threads=sort_threads, sort_memory=sort_memory,
+        shards=shards
+    )
     try:
         if mates_path:
-            ret = bwa.BWAMem( ref_file, read_path, mates_path, **args ).run( output_file )
+            ret = bwa.BWAMem( ref_file, read_path, mates_path, **args ).run( output_file, **run_args )
         else:
-            ret = bwa.BWAMem( ref_file, read_path, **args ).run( output_file )
+            ret = bwa.BWAMem( ref_file, read_path, **args ).run( output_file, **run_args )
     except ValueError as e:
         logger.error( str(e) )
 
@@ -74,7 +111,15 @@ def parse_args( ):
     parser.add_argument( '-C', help='append FASTA/FASTQ comment to SAM output' )
     parser.add_argument( '-H', help='hard clipping' )
     parser.add_argument( '-M', help='mark shorter split hits as secondary (for Picard/GATK compatibility)' )
-    parser.add_argument( '--output', metavar='output_file', default='bwa.sai', help='Output file to put sam output in[Default:bwa.sai]' )
+    parser.add_argument( '--output', metavar='output_file', default=None, help='Output file to put sam output in[Default:bwa.sai or bwa.bam with --bam]' )
+    parser.add_argument( '--stream-reads', action='store_true', default=False, help='Feed compiled reads to bwa through a named pipe instead of writing reads.fastq' )
+    parser.add_argument( '--shards', default=1, type=int, help='Split the reads between this many bwa processes that share the -t threads[Default:1]' )
+    parser.add_argument( '--bam', action='store_true', default=False, help='Pipe output through samtools sort to make a sorted and indexed bam' )
+    parser.add_argument( '--sort-threads', default=1, type=int, help='Threads for samtools sort with --bam[Default:1]' )
+    parser.add_argument( '--sort-memory', default=None, help='Memory per samtools sort thread with --bam such as 768M' )
+    parser.add_argument( '--validation', choices=('none', 'sample', 'full'), default=None, help='How thoroughly to check the reference and reads before running bwa[Default: sample files over 64M, otherwise full]' )
+    parser.add_argument( '--verification', choices=('reads', 'sam'), default=None, help='Check bwa processed every read by counting the input reads or the primary records bwa writes[Default: reads]' )
+    parser.add_argument( '--profile', default=None, help='Write the timings of each stage of the run to this json file' )
 
     parser.add_argument( dest='index', help='Reference location' )
     parser.add_argument( dest='reads', help='Read or directory of reads to be mapped(.fastq and .sff supported)' )
@@ -0,0 +1,261 @@
+'''
+    Caches that are kept in memory for the process and in the cache directory
+    between processes
+'''
+import logging
+import json
+import os
+import os.path
+import tempfile
+import time
+import hashlib
+import contextlib
+
+import seqio
+
+logger = logging.getLogger( __name__ )
+
+# Environmental variable that can be used to relocate the cache directory
+CACHE_DIR_ENV = 'PYBWA_CACHE_DIR'
+
+def cache_dir( ):
+    '''
+        Return the directory persistent caches are stored in
+        PYBWA_CACHE_DIR if it is set, otherwise ~/.cache/pybwa
+
+        @return path to cache directory(may not exist yet)
+    '''
+    path = os.environ.get( CACHE_DIR_ENV )
+    if not path:
+        path = os.path.join( os.path.expanduser( '~' ), '.cache', 'pybwa' )
+    return path
+
+def file_identity( path ):
+    '''
+        Return what identifies the contents of path without reading it
+
+        @raises OSError if path cannot be stat'd
+        @param path - File path
+        @return [inode, size, mtime]
+    '''
+    st = os.stat( path )
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+def read_json( path, default=None ):
+    '''
+        Load json from path returning default if it cannot be read
+    '''
+    try:
+        with open( path ) as fh:
+            return json.load( fh )
+    except (IOError, OSError, ValueError):
+        return default
+
+def write_json( path, data ):
+    '''
+        Atomically replace path with data dumped as json
+        Directories leading up to path are created
+
+        @raises IOError, OSError if path cannot be written
+    '''
+    dirname = os.path.dirname( path ) or '.'
+    if not os.path.isdir( dirname ):
+        os.makedirs( dirname )
+    fd, tmp = tempfile.mkstemp( dir=dirname, prefix='.tmp' )
+    try:
+        with os.fdopen( fd, 'w' ) as fh:
+            json.dump( data, fh )
+        os.rename( tmp, path )
+    except:
+        os.unlink( tmp )
+        raise
+
+def content_digest( paths, blocksize=seqio.READ_BLOCK_SIZE ):
+    '''
+        sha1 of the decompressed contents of paths as if they were
+        concatenated into a single file
+
+        @param paths - List of file paths
+        @param blocksize - Bytes to read at a time
+        @return hex digest
+    '''
+    sha = hashlib.sha1()
+    for path in paths:
+        with contextlib.closing( seqio.open_seqfile( path ) ) as fh:
+            for block in seqio.iter_blocks( fh, blocksize ):
+                sha.update( block )
+    return sha.hexdigest()
+
+def quick_digest( path, sample=1024 * 1024 ):
+    '''
+        sha1 of the size, first and last sample bytes of path which catches
+        most edits without reading the whole file
+
+        @param path - File path
+        @param sample - Bytes to read from each end
+        @return hex digest
+    '''
+    size = os.stat( path ).st_size
+    sha = hashlib.sha1( str( size ) )
+    with open( path, 'rb' ) as fh:
+        sha.update( fh.read( sample ) )
+        if size > sample:
+            fh.seek( max( sample, size - sample ) )
+            sha.update( fh.read( sample ) )
+    return sha.hexdigest()
+
+class FileCache( object ):
+    '''
+        Values computed from a file keyed by path and the path's inode, size
+        and mtime
+
+        Entries live in memory and in a json file inside of the cache directory
+        so other processes can reuse them. Least recently used entries are
+        dropped once there are more than max_entries.
+
+        Subclasses set FILENAME and implement compute
+    '''
+    FILENAME = None
+
+    def __init__( self, path=None, max_entries=10000 ):
+        '''
+            @param path - Json file to persist values to. Default is
+                FILENAME inside of cache_dir(). False only keeps values
+                in memory
+            @param max_entries - Maximum number of files to keep values for
+        '''
+        self._path = path
+        self.max_entries = max_entries
+        self.entries = {}
+
+    @property
+    def path( self ):
+        ''' Resolved lazily so the cache directory can be changed '''
+        if self._path is None:
+            return os.path.join( cache_dir(), self.FILENAME )
+        return self._path
+
+    def get( self, filename ):
+        '''
+            @param filename - Path to file
+            @return cached value or None if unknown or filename changed
+        '''
+        key = os.path.abspath( filename )
+        identity = file_identity( filename )
+        entry = self.entries.get( key )
+        if not self._valid( entry, identity ):
+            entry = self._load().get( key )
+            if not self._valid( entry, identity ):
+                return None
+        entry['used'] = time.time()
+        self.entries[key] = entry
+        return entry['value']
+
+    def set( self, filename, value ):
+        '''
+            Record the value for filename
+
+            @param filename - Path to file
+            @param value - Json serializable value computed from filename
+        '''
+        key = os.path.abspath( filename )
+        self.entries[key] = {
+            'identity': file_identity( filename ),
+            'value': value,
+            'used': time.time()
+        }
+        self._evict( self.entries )
+        self._save( key )
+
+    def value( self, filename ):
+        '''
+            Cached value of compute for filename
+        '''
+        value = self.get( filename )
+        if value is None:
+            value = self.compute( filename )
+            self.set( filename, value )
+        return value
+
+    def compute( self, filename ):
+        ''' Work out the value for filename '''
+        raise NotImplementedError( "This class is intended to be subclassed " \
+                "and not instantiated directly" )
+
+    def clear( self ):
+        ''' Forget everything in memory and on disk '''
+        self.entries = {}
+        if self.path and os.path.exists( self.path ):
+            os.unlink( self.path )
+
+    def _valid( self, entry, identity ):
+        ''' Entries from older versions or for a changed file are not used '''
+        return entry is not None and 'value' in entry and \
+            entry['identity'] == identity
+
+    def _evict( self, entries ):
+        ''' Drop least recently used entries over max_entries '''
+        if len( entries ) <= self.max_entries:
+            return
+        byage = sorted( entries, key=lambda k: entries[k]['used'] )
+        for key in byage[:len( entries ) - self.max_entries]:
+            del entries[key]
+
+    def _load( self ):
+        if not self.path:
+            return {}
+        return read_json( self.path, {} )
+
+    def _save( self, key ):
+        '''
+            Merge key into what is on disk so other processes' entries survive
+        '''
+        if not self.path:
+            return
+        entries = self._load()
+        entries[key] = self.entries[key]
+        self._evict( entries )
+        try:
+            write_json( self.path, entries )
+        except (IOError, OSError) as e:
+            logger.debug( "Could not save {0}: {1}".format(self.path, e) )
+
+class ReadCountCache( FileCache ):
+    '''
+        Read counts of read files
+    '''
+    FILENAME = 'readcounts.json'
+
+    def compute( self, filename ):
+        return seqio.reads_in_file( filename )
+
+    def reads_in_file( self, filename ):
+        '''
+            Cached version of seqio.reads_in_file
+        '''
+        return self.value( filename )
+
+class DigestCache( FileCache ):
+    '''
+        Content digests of files such as references
+    '''
+    FILENAME = 'digests.json'
+
+    def compute( self, filename ):
+        return content_digest( [filename] )
+
+    def digest( self, filename ):
+        '''
+            Cached version of content_digest for a single file
+        '''
+        return self.value( filename )
+
+# Caches shared by the whole process
+READ_COUNTS = ReadCountCache()
+DIGESTS = DigestCache()
+
+def reads_in_file( filename ):
+    '''
+        seqio.reads_in_file using the process wide READ_COUNTS cache
+    '''
+    return READ_COUNTS.reads_in_file( filename )
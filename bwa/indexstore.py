@@ -0,0 +1,455 @@
+'''
+    Shared store of bwa indexes keyed by reference content and bwa version
+    so the same reference is only ever indexed once
+'''
+import logging
+import hashlib
+import contextlib
+import errno
+import fcntl
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import time
+
+import cache
+
+logger = logging.getLogger( __name__ )
+
+# Environmental variable that can be used to relocate the store
+STORE_DIR_ENV = 'PYBWA_INDEX_STORE'
+# Environmental variable that caps the size of the store such as 50G
+STORE_SIZE_ENV = 'PYBWA_INDEX_STORE_SIZE'
+
+# Files bwa index creates next to the reference
+INDEX_EXTENSIONS = ('.amb', '.ann', '.bwt', '.pac', '.sa')
+# Name of the reference inside of each entry
+REF_NAME = 'ref.fa'
+# Written last so an entry without it is incomplete
+META_NAME = 'meta.json'
+# Written next to an indexed reference to detect when the reference changes
+MANIFEST_EXT = '.pybwa.json'
+# Lock file next to a reference that is held while it is indexed
+LOCK_EXT = '.pybwa.lock'
+
+SIZE_REGEX = re.compile( '^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', re.I )
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size( size ):
+    '''
+        Convert a size such as 512M or 20G to bytes
+
+        @raises ValueError if size cannot be parsed
+        @param size - int, number of bytes as a string or number with a
+            K, M, G or T suffix
+        @return number of bytes or None if size is None or empty
+    '''
+    if size is None or size == '':
+        return None
+    if isinstance( size, (int, long) ):
+        return size
+    m = SIZE_REGEX.match( str( size ) )
+    if not m:
+        raise ValueError( "{0} is not a valid size".format(size) )
+    return int( float( m.group( 1 ) ) * SIZE_UNITS[m.group( 2 ).upper()] )
+
+def store_dir( ):
+    '''
+        Return the directory the index store is kept in
+        PYBWA_INDEX_STORE if it is set, otherwise indexes inside of
+        cache.cache_dir()
+
+        @return path to store directory(may not exist yet)
+    '''
+    path = os.environ.get( STORE_DIR_ENV )
+    if not path:
+        path = os.path.join( cache.cache_dir(), 'indexes' )
+    return path
+
+def link_index( src_ref, dst_ref, copy=True ):
+    '''
+        Make the index files of src_ref available as the index of dst_ref
+
+        Files are hard linked so they outlive the entry being evicted. When
+        that is not possible, such as across file systems, they are copied so
+        nothing under dst_ref points back into the store. Existing files are
+        left alone.
+
+        @raises OSError, IOError if the files cannot be linked or copied
+        @param src_ref - Indexed reference
+        @param dst_ref - Reference to link the index files next to
+        @param copy - Copy files that cannot be hard linked. Otherwise they
+            are symlinked which is only safe when src_ref is not in a store
+    '''
+    for ext in INDEX_EXTENSIONS:
+        src = src_ref + ext
+        dst = dst_ref + ext
+        if os.path.lexists( dst ):
+            continue
+        try:
+            os.link( src, dst )
+        except OSError:
+            if not copy:
+                os.symlink( os.path.abspath( src ), dst )
+                continue
+            dirname = os.path.dirname( os.path.abspath( dst ) )
+            fd, tmp = tempfile.mkstemp( prefix='.pybwa', dir=dirname )
+            os.close( fd )
+            try:
+                shutil.copyfile( src, tmp )
+                os.chmod( tmp, 0644 )
+                os.rename( tmp, dst )
+            except:
+                os.unlink( tmp )
+                raise
+
+@contextlib.contextmanager
+def file_lock( path, wait=True ):
+    '''
+        Hold an exclusive advisory lock on path for the duration of the with
+        block, waiting for whichever process holds it now
+
+        The lock file is left behind since removing it would let two processes
+        lock different files of the same name. When it cannot be created, such
+        as in a read only directory, no lock is taken.
+
+        @param path - Lock file path
+        @param wait - Wait for the lock. Otherwise the block runs without it
+            when another process holds it
+        @return False in the with block if the lock is held by another
+            process and wait is False, otherwise True
+    '''
+    try:
+        fh = open( path, 'a' )
+    except IOError as e:
+        logger.debug( "Not locking {0}: {1}".format(path, e) )
+        yield True
+        return
+    try:
+        try:
+            fcntl.flock( fh, fcntl.LOCK_EX | fcntl.LOCK_NB )
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if not wait:
+                yield False
+                return
+            logger.info( "Waiting for another process to release {0}".format(path) )
+            fcntl.flock( fh, fcntl.LOCK_EX )
+        yield True
+    finally:
+        fh.close()
+
+def index_lock( ref ):
+    '''
+        Lock held while ref is indexed so concurrent jobs index it only once
+
+        @param ref - Reference path
+        @return file_lock context manager
+    '''
+    return file_lock( ref + LOCK_EXT )
+
+def manifest_path( ref ):
+    '''
+        @return path of the index manifest of ref
+    '''
+    return ref + MANIFEST_EXT
+
+def write_manifest( ref, bwa_version, digest=None ):
+    '''
+        Record what ref and its index files looked like when it was indexed
+
+        @raises OSError, IOError if it cannot be written
+        @param ref - Indexed reference
+        @param bwa_version - Version of bwa that built the index
+        @param digest - cache.content_digest of ref if it is already known.
+            Otherwise it is worked out which is cheap next to indexing
+    '''
+    if digest is None:
+        digest = cache.DIGESTS.digest( ref )
+    st = os.stat( ref )
+    manifest = {
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'quick_digest': cache.quick_digest( ref ),
+        'digest': digest,
+        'bwa_version': bwa_version,
+        'index': dict( [(ext, os.stat( ref + ext ).st_size) for ext in INDEX_EXTENSIONS] )
+    }
+    cache.write_json( manifest_path( ref ), manifest )
+
+def check_manifest( ref, verify=False ):
+    '''
+        Check that ref and its index files still match its manifest
+
+        Normally only takes a few stats. The quick digest is only read when
+        the size matches but the mtime does not, such as after a copy or touch.
+
+        @param ref - Reference path
+        @param verify - Also compare the full content digest of ref
+        @return None if there is no manifest, otherwise True if the index is
+            current and False if it is stale
+    '''
+    manifest = cache.read_json( manifest_path( ref ) )
+    if manifest is None:
+        return None
+    try:
+        st = os.stat( ref )
+        if st.st_size != manifest['size']:
+            return False
+        for ext, size in manifest['index'].items():
+            if os.stat( ref + ext ).st_size != size:
+                return False
+        if st.st_mtime != manifest['mtime'] and \
+                cache.quick_digest( ref ) != manifest['quick_digest']:
+            return False
+        if verify and cache.content_digest( [ref] ) != manifest['digest']:
+            return False
+    except (OSError, IOError, KeyError, TypeError) as e:
+        logger.debug( "Manifest of {0} does not match: {1}".format(ref, e) )
+        return False
+    return True
+
+class IndexStore( object ):
+    '''
+        Directory of indexed references where every entry is a directory
+        named by the key of the reference it holds
+
+            <root>/<key>/ref.fa
+            <root>/<key>/ref.fa.amb ...
+            <root>/<key>/meta.json
+
+        Entries are built in a temporary directory and renamed into place so
+        they are never seen half built. Once the store is bigger than
+        max_bytes the least recently used entries are removed.
+    '''
+    def __init__( self, root=None, max_bytes=None ):
+        '''
+            @param root - Store directory. Default is store_dir()
+            @param max_bytes - Size cap of the store in bytes or as a string
+                such as 50G. Default is PYBWA_INDEX_STORE_SIZE or no cap
+        '''
+        self._root = root
+        self._max_bytes = parse_size( max_bytes )
+
+    @property
+    def root( self ):
+        ''' Resolved lazily so the store directory can be changed '''
+        if self._root is None:
+            return store_dir()
+        return self._root
+
+    @property
+    def max_bytes( self ):
+        if self._max_bytes is None:
+            return parse_size( os.environ.get( STORE_SIZE_ENV ) )
+        return self._max_bytes
+
+    def key( self, digest, bwa_version ):
+        '''
+            @param digest - Content digest of the reference
+            @param bwa_version - Version of bwa that builds the index since
+                index formats can change between versions
+            @return key of the entry
+        '''
+        return hashlib.sha1( '{0}\0{1}'.format(digest, bwa_version) ).hexdigest()
+
+    def ref_path( self, key ):
+        '''
+            @return path of the reference inside of the entry for key
+        '''
+        return os.path.join( self.root, key, REF_NAME )
+
+    def lookup( self, key ):
+        '''
+            Find a complete entry and mark it as used
+
+            @param key - Entry key
+            @return path to the indexed reference or None if not stored
+        '''
+        metapath = os.path.join( self.root, key, META_NAME )
+        meta = cache.read_json( metapath )
+        if meta is None:
+            return None
+        meta['used'] = time.time()
+        try:
+            cache.write_json( metapath, meta )
+        except (IOError, OSError) as e:
+            logger.debug( "Could not update {0}: {1}".format(metapath, e) )
+        return self.ref_path( key )
+
+    def add( self, key, ref, build, meta=None ):
+        '''
+            Build a new entry for ref
+
+            @raises OSError, IOError if the store cannot be written
+            @param key - Entry key
+            @param ref - Reference to copy into the entry
+            @param build - Called with the path of the copied reference and
+                returns True if it indexed it
+            @param meta - Extra information to keep in meta.json
+            @return path to the indexed reference or None if build failed
+        '''
+        if not os.path.isdir( self.root ):
+            os.makedirs( self.root )
+        tmpdir = tempfile.mkdtemp( prefix='.tmp', dir=self.root )
+        try:
+            # Copied rather than linked so editing ref cannot change the entry
+            tmpref = os.path.join( tmpdir, REF_NAME )
+            shutil.copyfile( ref, tmpref )
+            if not build( tmpref ):
+                return None
+            meta = dict( meta or {} )
+            meta.update( source=os.path.abspath( ref ), created=time.time(),
+                used=time.time() )
+            cache.write_json( os.path.join( tmpdir, META_NAME ), meta )
+            try:
+                os.rename( tmpdir, os.path.join( self.root, key ) )
+            except OSError:
+                # Another process stored the same reference first
+                if self.lookup( key ) is None:
+                    raise
+        finally:
+            if os.path.isdir( tmpdir ):
+                shutil.rmtree( tmpdir )
+        self.evict( keep=key )
+        return self.ref_path( key )
+
+    def resolve( self, key, ref, build, meta=None ):
+        '''
+            lookup key and add ref if it is not stored yet
+
+            Adding holds a lock on key so processes storing the same reference
+            at once wait for the first one and use its entry.
+
+            @return path to the indexed reference or None if build failed
+        '''
+        path = self.lookup( key )
+        if path is None:
+            if not os.path.isdir( self.root ):
+                os.makedirs( self.root )
+            with self.key_lock( key ):
+                path = self.lookup( key )
+                if path is None:
+                    return self.add( key, ref, build, meta )
+        logger.info( "Using stored index {0} for {1}".format(path, ref) )
+        return path
+
+    def key_lock( self, key, wait=True ):
+        '''
+            Lock held while the entry for key is added, checked out or
+            evicted
+
+            @param wait - See file_lock
+            @return file_lock context manager
+        '''
+        return file_lock( os.path.join( self.root, '.' + key + LOCK_EXT ), wait )
+
+    def checkout( self, key, dst_ref ):
+        '''
+            Hard link the reference, index and manifest of an entry as dst_ref
+            so they outlive the entry being evicted. Files already at dst_ref
+            are replaced.
+
+            @param key - Entry key
+            @param dst_ref - Path to link the reference to
+            @return dst_ref or None if key is not stored or the files cannot
+                be hard linked, such as across file systems
+        '''
+        if self.lookup( key ) is None:
+            return None
+        src_ref = self.ref_path( key )
+        # Eviction waits for the links to be made
+        with self.key_lock( key ):
+            if not os.path.exists( src_ref ):
+                return None
+            dirname = os.path.dirname( os.path.abspath( dst_ref ) )
+            tmpdir = tempfile.mkdtemp( prefix='.pybwa', dir=dirname )
+            try:
+                exts = ('',) + INDEX_EXTENSIONS + (MANIFEST_EXT,)
+                for ext in exts:
+                    os.link( src_ref + ext, os.path.join( tmpdir, REF_NAME + ext ) )
+                # Reference last so until it is replaced the new manifest
+                # marks the old reference as stale
+                for ext in reversed( exts ):
+                    os.rename( os.path.join( tmpdir, REF_NAME + ext ), dst_ref + ext )
+            except OSError as e:
+                logger.info( "Could not link stored index {0} to {1}: {2}".format(
+                        src_ref, dst_ref, e
+                    )
+                )
+                return None
+            finally:
+                shutil.rmtree( tmpdir )
+        return dst_ref
+
+    def entries( self ):
+        '''
+            @return list of (key, meta) of every complete entry
+        '''
+        if not os.path.isdir( self.root ):
+            return []
+        entries = []
+        for key in os.listdir( self.root ):
+            if key.startswith( '.' ):
+                continue
+            meta = cache.read_json( os.path.join( self.root, key, META_NAME ) )
+            if meta is not None:
+                entries.append( (key, meta) )
+        return entries
+
+    def entry_size( self, key ):
+        '''
+            @return bytes used by the files of an entry
+        '''
+        entrydir = os.path.join( self.root, key )
+        size = 0
+        for name in os.listdir( entrydir ):
+            size += os.lstat( os.path.join( entrydir, name ) ).st_size
+        return size
+
+    def remove( self, key ):
+        '''
+            Remove an entry by first moving it aside so it disappears at once
+        '''
+        entrydir = os.path.join( self.root, key )
+        trash = tempfile.mkdtemp( prefix='.del', dir=self.root )
+        try:
+            os.rename( entrydir, os.path.join( trash, key ) )
+        finally:
+            shutil.rmtree( trash )
+
+    def evict( self, keep=None ):
+        '''
+            Remove least recently used entries until the store fits in
+            max_bytes
+
+            @param keep - Key that is never removed
+        '''
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            return
+        entries = sorted( self.entries(), key=lambda e: e[1].get( 'used', 0 ) )
+        sizes = dict( [(key, self.entry_size( key )) for key, meta in entries] )
+        total = sum( sizes.values() )
+        for key, meta in entries:
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                # Entries being added or checked out are left for next time
+                with self.key_lock( key, wait=False ) as locked:
+                    if not locked:
+                        continue
+                    logger.info( "Evicting stored index {0}".format(key) )
+                    self.remove( key )
+            except OSError as e:
+                logger.debug( "Could not evict {0}: {1}".format(key, e) )
+                continue
+            total -= sizes[key]
+
+# Store shared by the whole process
+INDEX_STORE = IndexStore()
@@ -0,0 +1,297 @@
+'''
+    Structured timings of the stages of a run
+
+    Stages nest so a stage started inside of another one is part of it.
+    Each stage records its wall time, the cpu time of this process, the bytes
+    this process read and wrote and the resource usage of the child processes
+    that were reaped with wait while it was open.
+
+    The cpu time and bytes are counters of the whole process so they are only
+    kept for stages that no stage of another thread overlapped, such as when
+    bwa_batch maps several samples at once. They are None otherwise.
+
+    Every finished stage is handed to the hooks added with add_hook:
+
+        profile = instrument.Profile()
+        instrument.add_hook( profile )
+        ...
+        profile.write( 'profile.json' )
+'''
+import contextlib
+import errno
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger( __name__ )
+
+# Functions called with every finished Stage
+HOOKS = []
+# Open stages of each thread
+_local = threading.local()
+# Open stages of every thread
+_OPEN = set()
+_OPEN_LOCK = threading.Lock()
+
+# /proc/self/io fields recorded for each stage
+#  rchar and wchar count every byte read and written including pipes
+IO_FIELDS = ('rchar', 'wchar')
+
+def add_hook( hook ):
+    '''
+        @param hook - Called with every Stage once it finishes
+    '''
+    HOOKS.append( hook )
+
+def remove_hook( hook ):
+    if hook in HOOKS:
+        HOOKS.remove( hook )
+
+def process_io( ):
+    '''
+        @return dictionary of IO_FIELDS for this process or None where the
+            platform does not have /proc/self/io
+    '''
+    try:
+        with open( '/proc/self/io' ) as fh:
+            lines = fh.read().splitlines()
+    except (IOError, OSError):
+        return None
+    counters = {}
+    for line in lines:
+        key, _, value = line.partition( ':' )
+        if key in IO_FIELDS:
+            counters[key] = int( value )
+    return counters
+
+def rusage_dict( rusage ):
+    '''
+        @param rusage - resource.struct_rusage
+        @return dictionary of the fields of rusage that are recorded
+    '''
+    return {
+        'user': rusage.ru_utime,
+        'system': rusage.ru_stime,
+        # Kilobytes on Linux
+        'maxrss': rusage.ru_maxrss,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock
+    }
+
+class Stage( object ):
+    '''
+        Timings of a single stage
+    '''
+    def __init__( self, name, parent=None, info=None ):
+        '''
+            @param name - Stage name
+            @param parent - Stage this one runs inside of
+            @param info - Dictionary of extra details to keep
+        '''
+        self.name = name
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.info = dict( info or {} )
+        self.start = time.time()
+        self.seconds = None
+        self.error = None
+        self.children = {'count': 0, 'user': 0.0, 'system': 0.0,
+            'maxrss': 0, 'inblock': 0, 'oublock': 0}
+        self.thread = threading.current_thread()
+        # Set when a stage of another thread was open at the same time so
+        # the process wide counters are not this stage's alone
+        self.shared = False
+        self._rusage = resource.getrusage( resource.RUSAGE_SELF )
+        self._io = process_io()
+        self.cpu = None
+        self.io = None
+
+    def add_child( self, rusage ):
+        '''
+            Account for a reaped child process
+
+            @param rusage - resource.struct_rusage from os.wait4
+        '''
+        usage = rusage_dict( rusage )
+        self.children['count'] += 1
+        for key in ('user', 'system', 'inblock', 'oublock'):
+            self.children[key] += usage[key]
+        self.children['maxrss'] = max( self.children['maxrss'], usage['maxrss'] )
+
+    def finish( self, error=None ):
+        self.seconds = time.time() - self.start
+        self.error = error
+        if self.shared:
+            return
+        rusage = resource.getrusage( resource.RUSAGE_SELF )
+        self.cpu = {
+            'user': rusage.ru_utime - self._rusage.ru_utime,
+            'system': rusage.ru_stime - self._rusage.ru_stime
+        }
+        io = process_io()
+        if io is not None and self._io is not None:
+            self.io = dict( [(k, io[k] - self._io.get( k, 0 )) for k in io] )
+
+    def as_dict( self ):
+        '''
+            @return json serializable dictionary of the stage
+        '''
+        return {
+            'stage': self.name,
+            'parent': None if self.parent is None else self.parent.name,
+            'depth': self.depth,
+            'start': self.start,
+            'seconds': self.seconds,
+            'cpu': self.cpu,
+            'children': self.children,
+            'bytes_read': None if self.io is None else self.io.get( 'rchar' ),
+            'bytes_written': None if self.io is None else self.io.get( 'wchar' ),
+            'error': self.error,
+            'info': self.info
+        }
+
+def _stack( ):
+    if not hasattr( _local, 'stack' ):
+        _local.stack = []
+    return _local.stack
+
+def current( ):
+    '''
+        @return innermost open Stage of this thread or None
+    '''
+    stack = _stack()
+    return stack[-1] if stack else None
+
+def annotate( **info ):
+    '''
+        Add details to the innermost open stage of this thread
+    '''
+    stage = current()
+    if stage is not None:
+        stage.info.update( info )
+
+@contextlib.contextmanager
+def stage( name, **info ):
+    '''
+        Time everything inside of the with block as the stage name
+
+        A stage opened while a stage of the same name is innermost, such as by
+        an overridden method calling super, is part of that stage
+
+        @param name - Stage name
+        @param info - Extra details to keep with the stage
+        @return the Stage
+    '''
+    outer = current()
+    if outer is not None and outer.name == name:
+        outer.info.update( info )
+        yield outer
+        return
+    stack = _stack()
+    s = Stage( name, outer, info )
+    stack.append( s )
+    with _OPEN_LOCK:
+        for other in _OPEN:
+            if other.thread is not s.thread:
+                other.shared = s.shared = True
+        _OPEN.add( s )
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = '{0}: {1}'.format(e.__class__.__name__, e)
+        raise
+    finally:
+        stack.remove( s )
+        with _OPEN_LOCK:
+            _OPEN.discard( s )
+        s.finish( error )
+        for hook in list( HOOKS ):
+            try:
+                hook( s )
+            except Exception as e:
+                logger.warning( "Instrumentation hook {0} failed: {1}".format(hook, e) )
+
+def timed( name ):
+    '''
+        Decorator that runs every call of a function as a stage
+
+        @param name - Stage name
+    '''
+    def decorator( func ):
+        @functools.wraps( func )
+        def wrapper( *args, **kwargs ):
+            with stage( name ):
+                return func( *args, **kwargs )
+        return wrapper
+    return decorator
+
+def wait( process ):
+    '''
+        Popen.wait that reaps the process with os.wait4 to record its
+        resource usage with every open stage of this thread
+
+        returncode is set from the exit status the same way Popen sets it
+
+        @param process - subprocess.Popen
+        @return returncode of process
+    '''
+    if process.returncode is not None:
+        return process.returncode
+    while True:
+        try:
+            pid, status, rusage = os.wait4( process.pid, 0 )
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # Already reaped somewhere else
+                return process.wait()
+            raise
+    if os.WIFSIGNALED( status ):
+        process.returncode = -os.WTERMSIG( status )
+    else:
+        process.returncode = os.WEXITSTATUS( status )
+    s = current()
+    while s is not None:
+        s.add_child( rusage )
+        s = s.parent
+    return process.returncode
+
+class Profile( object ):
+    '''
+        Hook that keeps every finished stage so they can be written out as a
+        json profile
+    '''
+    def __init__( self ):
+        self.stages = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def __call__( self, stage ):
+        with self.lock:
+            self.stages.append( stage.as_dict() )
+
+    def as_dict( self ):
+        with self.lock:
+            stages = sorted( self.stages, key=lambda s: s['start'] )
+        return {
+            'argv': sys.argv,
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'stages': stages
+        }
+
+    def write( self, path ):
+        '''
+            @raises IOError, OSError if path cannot be written
+        '''
+        with open( path, 'w' ) as fh:
+            json.dump( self.as_dict(), fh, indent=2, sort_keys=True )
+            fh.write( '\n' )
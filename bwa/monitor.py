@@ -0,0 +1,102 @@
+'''
+    Follow bwa's stderr output while it runs
+'''
+import collections
+import re
+import threading
+import time
+
+# Snapshot of how far bwa has gotten that is handed to progress callbacks
+#  eta is seconds left and is None until expected_reads is known
+Progress = collections.namedtuple( 'Progress',
+    'reads bp elapsed reads_per_sec bp_per_sec expected_reads eta'
+)
+
+class StderrMonitor( object ):
+    '''
+        Parses bwa stderr one line at a time keeping only the last tail_lines
+        lines around for error reporting
+
+        feed is thread safe so one monitor can follow several processes
+    '''
+    # Printed by bwa mem for every batch of reads it loads
+    #  [M::main_mem] read 100 sequences (111350 bp)...
+    READ_LINE_REGEX = re.compile( '\[M::main_mem\] read (\d+) sequences \((\d+) bp\)...' )
+
+    def __init__( self, tail_lines=1000, callback=None, expected_reads=None ):
+        '''
+            @param tail_lines - How many of the last stderr lines to keep
+            @param callback - Called with a Progress every time bwa reports
+                reading a batch of reads
+            @param expected_reads - Callable that returns the number of reads
+                bwa should process or None if it is not known yet
+        '''
+        self.tail = collections.deque( maxlen=tail_lines )
+        self.callback = callback
+        self.expected_reads = expected_reads
+        self.total_reads = 0
+        self.total_bp = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def feed( self, line ):
+        '''
+            Parse a single line of stderr
+
+            @param line - Line of stderr output
+        '''
+        m = self.READ_LINE_REGEX.search( line )
+        with self.lock:
+            self.tail.append( line )
+            if m:
+                self.total_reads += int( m.group( 1 ) )
+                self.total_bp += int( m.group( 2 ) )
+                progress = self.progress()
+        if m and self.callback is not None:
+            self.callback( progress )
+
+    def parse( self, output ):
+        '''
+            Feed all lines of already collected output
+
+            @param output - Full stderr output
+            @return self
+        '''
+        for line in output.splitlines( True ):
+            self.feed( line )
+        return self
+
+    def follow( self, fh ):
+        '''
+            Feed lines from fh as they are written until it is closed
+
+            @param fh - Readable file handle such as Popen.stderr
+            @return self
+        '''
+        for line in iter( fh.readline, '' ):
+            self.feed( line )
+        return self
+
+    def output( self ):
+        '''
+            @return the last tail_lines lines of stderr
+        '''
+        return ''.join( self.tail )
+
+    def progress( self ):
+        '''
+            @return Progress for what has been parsed so far
+        '''
+        elapsed = time.time() - self.started
+        reads_per_sec = bp_per_sec = 0.0
+        if elapsed > 0:
+            reads_per_sec = self.total_reads / elapsed
+            bp_per_sec = self.total_bp / elapsed
+        expected = None
+        if self.expected_reads is not None:
+            expected = self.expected_reads()
+        eta = None
+        if expected is not None and reads_per_sec > 0:
+            eta = max( expected - self.total_reads, 0 ) / reads_per_sec
+        return Progress( self.total_reads, self.total_bp, elapsed,
+            reads_per_sec, bp_per_sec, expected, eta )
@@ -0,0 +1,167 @@
+'''
+    Lightweight SAM parsing for output streamed out of bwa
+'''
+import collections
+import errno
+import os
+
+# Flags that mark a record as not being the primary alignment of a read
+SECONDARY = 0x100
+SUPPLEMENTARY = 0x800
+# Flags that tell the two reads of a pair apart
+READ1 = 0x40
+READ2 = 0x80
+
+# Bytes copied at a time by tee
+TEE_BLOCK_SIZE = 64 * 1024
+
+class SAMHeader( list ):
+    '''
+        List of the @ header lines of a SAM file without newlines
+    '''
+    def to_lines( self ):
+        ''' @return header as it would be written to a SAM file '''
+        return ''.join( [line + '\n' for line in self] )
+
+class SAMRecord( collections.namedtuple( 'SAMRecord',
+        'qname flag rname pos mapq cigar rnext pnext tlen seq qual tags' ) ):
+    '''
+        Mandatory fields of a single alignment line with the optional
+        fields left unparsed in tags
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_line( cls, line ):
+        '''
+            @raises ValueError if line does not have the 11 mandatory fields
+            @param line - Single alignment line
+            @return SAMRecord
+        '''
+        fields = line.rstrip( '\r\n' ).split( '\t' )
+        if len( fields ) < 11:
+            raise ValueError( "Invalid SAM line: {0}".format(line) )
+        return cls( fields[0], int( fields[1] ), fields[2], int( fields[3] ),
+            int( fields[4] ), fields[5], fields[6], int( fields[7] ),
+            int( fields[8] ), fields[9], fields[10], fields[11:] )
+
+    @property
+    def is_primary( self ):
+        ''' True unless this is a secondary or supplementary alignment '''
+        return not self.flag & (SECONDARY | SUPPLEMENTARY)
+
+    def to_line( self ):
+        ''' @return record as a SAM line with trailing newline '''
+        fields = [str( f ) for f in self[:11]] + list( self.tags )
+        return '\t'.join( fields ) + '\n'
+
+def iter_sam( fh ):
+    '''
+        Parse SAM from fh one line at a time
+
+        @param fh - Readable file handle of SAM text
+        @return generator that yields a single SAMHeader followed by a
+            SAMRecord for every alignment
+    '''
+    header = SAMHeader()
+    header_done = False
+    for line in iter( fh.readline, '' ):
+        if not line.strip():
+            continue
+        if not header_done:
+            if line.startswith( '@' ):
+                header.append( line.rstrip( '\r\n' ) )
+                continue
+            header_done = True
+            yield header
+        yield SAMRecord.from_line( line )
+    if not header_done:
+        yield header
+
+class PrimaryCounter( object ):
+    '''
+        Counts the reads in SAM text fed to it in blocks of any size by
+        counting primary records
+
+        bwa writes exactly one primary record for every read it processes,
+        mapped or not, so this matches the reads bwa reports reading. A
+        record with the same QNAME and read1/read2 flags as the one before it
+        is not counted again.
+    '''
+    def __init__( self ):
+        self.count = 0
+        self._last = None
+        self._partial = ''
+
+    def feed( self, data ):
+        '''
+            @raises ValueError if a complete line is not a SAM line
+            @param data - Next block of SAM text
+        '''
+        lines = (self._partial + data).split( '\n' )
+        self._partial = lines.pop()
+        for line in lines:
+            self.add_line( line )
+
+    def add_line( self, line ):
+        '''
+            Count a single header or alignment line
+
+            @raises ValueError if line is not a SAM line
+        '''
+        # QNAME cannot start with @ so only header lines do
+        if not line.strip() or line[0] == '@':
+            return
+        fields = line.split( '\t', 2 )
+        if len( fields ) < 3 or not fields[1].isdigit():
+            raise ValueError( "Invalid SAM line: {0}".format(line) )
+        flag = int( fields[1] )
+        if flag & (SECONDARY | SUPPLEMENTARY):
+            return
+        key = (fields[0], flag & (READ1 | READ2))
+        if key != self._last:
+            self.count += 1
+            self._last = key
+
+    def close( self ):
+        '''
+            Count whatever was left without a trailing newline
+
+            @return count
+        '''
+        if self._partial:
+            self.add_line( self._partial.rstrip( '\r' ) )
+            self._partial = ''
+        return self.count
+
+def tee( src, dst, counter, blocksize=TEE_BLOCK_SIZE ):
+    '''
+        Copy SAM text from src to dst feeding every block to counter on the
+        way so it never has to be read back. Both src and dst are closed once
+        src ends.
+
+        @param src - Readable file handle such as bwa's stdout
+        @param dst - File descriptor to write to
+        @param counter - PrimaryCounter
+        @param blocksize - Bytes to copy at a time
+        @return counter.count once src ends
+    '''
+    try:
+        fd = src.fileno()
+        while True:
+            try:
+                data = os.read( fd, blocksize )
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            counter.feed( data )
+            view = buffer( data )
+            while view:
+                view = view[os.write( dst, view ):]
+        return counter.close()
+    finally:
+        src.close()
+        os.close( dst )
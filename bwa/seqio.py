@@ -1,22 +1,112 @@
-from Bio import SeqIO
-
 import os
 import sys
 import os.path
+import errno
 import glob
 import shutil
+import struct
+import multiprocessing
+import tempfile
+import mmap
+import random
+import re
+import collections
+import gzip
+import contextlib
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+import instrument
+
+# Size of the blocks read when scanning sequence files as raw bytes
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Errors that mean a zero copy call cannot be used for a pair of files
+ZERO_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+# Rough resident memory of a single sff conversion process
+SFF_WORKER_MEMORY = 128 * 1024 * 1024
+
+# Fixed part of the sff common header
+#  magic, version, index offset, index length, number of reads, header length,
+#  key length, number of flows, flowgram format
+SFF_HEADER = struct.Struct( '>4s4sQIIHHHB' )
+# Only sff version this understands
+SFF_VERSION = '\x00\x00\x00\x01'
+
+# Fixed part of each sff read header
+#  read header length, name length, number of bases, clip quality left,
+#  clip quality right, clip adapter left, clip adapter right
+SFF_READ_HEADER = struct.Struct( '>2HI4H' )
+
+# Maps raw phred quality bytes to sanger fastq characters capped at 93
+PHRED33 = ''.join( [chr( min( q, 93 ) + 33 ) for q in range( 256 )] )
+
+# Amount of fastq text collected before it is written out
+FASTQ_WRITE_BUFFER = 4 * 1024 * 1024
+
+# Every gzip member starts with these bytes
+GZIP_MAGIC = '\x1f\x8b'
+# Fixed gzip header up to the subfield id of the first extra field
+#  magic, compression method, flags, mtime, extra flags, os, extra length,
+#  subfield id 1, subfield id 2
+GZIP_HEADER = struct.Struct( '<2sBBIBBHcc' )
+# Extra field flag in the gzip header
+GZIP_FEXTRA = 0x04
+
+# Patterns of read files that are picked up from a directory of reads
+READ_PATTERNS = ('*.sff', '*.fastq', '*.fastq.gz')
+
+# How thoroughly read and reference files are checked before bwa runs
+#  none only checks that the file exists, sample checks the head, the tail and
+#  a few record aligned offsets and full reads the whole file
+VALIDATION_LEVELS = ('none', 'sample', 'full')
+# Files at least this big are sampled unless a level is given
+SAMPLE_VALIDATION_SIZE = 64 * 1024 * 1024
+# Random offsets checked besides the head and tail when sampling
+VALIDATION_SAMPLES = 8
+# Bytes read at each sampled offset
+VALIDATION_WINDOW = 64 * 1024
+# Any line of a fasta file that is not a header. Whitespace is dropped by
+# fasta parsers so it is allowed anywhere
+FASTA_SEQUENCE_REGEX = re.compile( '^[A-Za-z*.\-\s]*$' )
+
+# Parsed sff common header
+SffHeader = collections.namedtuple( 'SffHeader',
+    'index_offset index_length number_of_reads header_length number_of_flows'
+)
+
+# Single sff read
+#  bases and quals are the raw, untrimmed values from the file
+#  clip_left and clip_right are python slice positions of the good bases
+SffRead = collections.namedtuple( 'SffRead',
+    'name bases quals clip_left clip_right'
+)
 
 class EmptyFileError( Exception ):
     pass
 
-def sffs_to_fastq( sffs, output='sff.fastq' ):
+@instrument.timed( 'sffs_to_fastq' )
+def sffs_to_fastq( sffs, output='sff.fastq', workers=None, max_memory=None, trim=False ):
     '''
         Given a list of sffs, concat them into a single fastq
         Nothing created if empty list given
 
+        Bases outside of the clip points are written in lower case like
+        Biopython does unless trim is set in which case they are removed.
+
+        With more than one sff and worker each sff is converted into its own
+        part file by a pool of processes and the parts are concatenated into
+        output in the same order as sffs so the output is the same as a serial
+        conversion.
+
         @raises ValueError if invalid sff file is encountered or output is invalid path
         @param sffs - List of sff file paths to convert and concat into fastq
         @param output - Output fastq file path[Default: sff.fastq]
+        @param workers - Number of conversion processes[Default: 1 per cpu]
+        @param max_memory - Bytes of memory the conversion processes may use
+            altogether which limits how many are started
+        @param trim - Trim reads to their clip points
         @return Path to fastq file created or None if empty list given
     '''
     # Has to be a list
@@ -27,35 +117,397 @@ def sffs_to_fastq( sffs, output='sff.fastq' ):
     if not sffs:
         return
 
-    try:
-        # Concat all sequences to output file
-        with open( output, 'w' ) as fh:
-            for sff in sffs:
-                    SeqIO.write( SeqIO.parse( sff, 'sff' ), fh, 'fastq' )
-    except (OSError, IOError) as e:
-        raise ValueError( "{0} is not a valid output file".format(output) )
-    except ValueError as e:
-        raise ValueError( "{0} is not a valid sff file".format(sff) )
+    workers = conversion_workers( len( sffs ), workers, max_memory )
+    if workers == 1:
+        try:
+            with open( output, 'w' ) as fh:
+                for sff in sffs:
+                    _sff_to_fastq( sff, fh, trim )
+        except (OSError, IOError) as e:
+            raise ValueError( "{0} is not a valid output file".format(output) )
+    else:
+        _parallel_sffs_to_fastq( sffs, output, workers, trim )
     
     return output
 
+def conversion_workers( numfiles, workers=None, max_memory=None ):
+    '''
+        How many processes to convert numfiles files with
+
+        @param numfiles - Number of files to convert
+        @param workers - Requested number of workers or None for 1 per cpu
+        @param max_memory - Memory bound in bytes or None for no bound
+        @return number of workers to use, at least 1
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_memory is not None:
+        workers = min( workers, max_memory // SFF_WORKER_MEMORY )
+    return max( 1, min( workers, numfiles ) )
+
+def _sff_to_fastq( sff, fh, trim=False ):
+    '''
+        Write sff as fastq to an open file handle
+
+        @raises ValueError if sff cannot be read as an sff
+        @raises IOError if fh cannot be written
+    '''
+    try:
+        write_sff_fastq( sff, fh, trim )
+    except ValueError:
+        raise ValueError( "{0} is not a valid sff file".format(sff) )
+    except (OSError, IOError):
+        if not os.path.isfile( sff ):
+            raise ValueError( "{0} is not a valid sff file".format(sff) )
+        raise
+
+def _sff_to_fastq_part( args ):
+    '''
+        Pool worker that converts a single sff into its own part file
+
+        @param args - (sff path, part path, trim)
+        @return part path
+    '''
+    sff, part, trim = args
+    with open( part, 'w' ) as fh:
+        _sff_to_fastq( sff, fh, trim )
+    return part
+
+def _parallel_sffs_to_fastq( sffs, output, workers, trim=False ):
+    '''
+        Convert sffs into part files in a process pool and concat the parts
+        into output in order as they become available
+    '''
+    try:
+        partdir = tempfile.mkdtemp(
+            prefix='.sffparts', dir=os.path.dirname( output ) or '.'
+        )
+    except (OSError, IOError):
+        raise ValueError( "{0} is not a valid output file".format(output) )
+
+    jobs = [(sff, os.path.join( partdir, '{0}.fastq'.format(i) ), trim)
+        for i, sff in enumerate( sffs )]
+    pool = multiprocessing.Pool( workers )
+    try:
+        with open( output, 'wb' ) as fh:
+            # imap hands back parts in order while later ones still convert
+            for part in pool.imap( _sff_to_fastq_part, jobs ):
+                with open( part, 'rb' ) as fr:
+                    shutil.copyfileobj( fr, fh, READ_BLOCK_SIZE )
+                os.unlink( part )
+        pool.close()
+    except:
+        pool.terminate()
+        if os.path.isfile( output ):
+            os.unlink( output )
+        exc_type, exc_value, tb = sys.exc_info()
+        # Same as the serial conversion
+        if issubclass( exc_type, (OSError, IOError) ):
+            raise ValueError( "{0} is not a valid output file".format(output) )
+        raise exc_type, exc_value, tb
+    finally:
+        pool.join()
+        shutil.rmtree( partdir )
+
+class ReadStream( object ):
+    '''
+        Fastq and sff files that are written out as a single fastq on the fly
+        instead of being concatenated into a file first
+
+        Reads are tallied while they are written so they never have to be
+        counted separately
+    '''
+    def __init__( self, files ):
+        '''
+            @param files - List of fastq and sff paths in the order they
+                should be written
+        '''
+        self.files = list( files )
+
+    def __repr__( self ):
+        return 'ReadStream({0!r})'.format(self.files)
+
+    def write( self, fh ):
+        '''
+            Write every file to fh as fastq
+
+            @raises ValueError if any of the files are not valid
+            @param fh - File handle to write to
+            @return number of reads written
+        '''
+        count = 0
+        for filename in self.files:
+            if seqfile_type( filename ) == 'sff':
+                count += write_sff_fastq( filename, fh )
+                continue
+            with contextlib.closing( open_seqfile( filename ) ) as fr:
+                reads = count_fastq( _TeeReader( fr, fh ) )
+            # Not a plain 4 line fastq so it has to be parsed to count
+            if reads is None:
+                reads = reads_in_file( filename )
+            count += reads
+        return count
+
+def compression( filename ):
+    '''
+        Detect gzip compression from the magic bytes of filename
+
+        BGZF is the blocked gzip written by bgzip that can be decompressed in
+        parallel. It is still a valid gzip file.
+
+        @param filename - Path to file to check
+        @return None if not compressed, 'bgzf' or 'gzip'
+    '''
+    with open( filename, 'rb' ) as fh:
+        data = fh.read( GZIP_HEADER.size )
+    if not data.startswith( GZIP_MAGIC ):
+        return None
+    if len( data ) == GZIP_HEADER.size:
+        magic, method, flags, mtime, xfl, os_, xlen, si1, si2 = \
+            GZIP_HEADER.unpack( data )
+        if flags & GZIP_FEXTRA and (si1, si2) == ('B', 'C'):
+            return 'bgzf'
+    return 'gzip'
+
+def decompress_command( filename, threads=None ):
+    '''
+        Command that writes filename decompressed to stdout using as many
+        threads as it can
+
+        bgzip decompresses BGZF blocks in parallel and pigz offloads
+        reading, writing and checksumming to threads for any gzip file
+
+        @param filename - Path to gzip or bgzf file
+        @param threads - Threads to use[Default: 1 per cpu]
+        @return command list or None if neither bgzip nor pigz is installed
+    '''
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if compression( filename ) == 'bgzf':
+        bgzip = find_executable( 'bgzip' )
+        if bgzip:
+            return [bgzip, '-dc', '-@', str( threads ), filename]
+    pigz = find_executable( 'pigz' )
+    if pigz:
+        return [pigz, '-dc', '-p', str( threads ), filename]
+    return None
+
+def open_seqfile( filename, threads=None ):
+    '''
+        Open a possibly compressed file for reading in binary mode
+
+        Compressed files are decompressed by an external process when
+        decompress_command finds one and by the gzip module otherwise
+
+        @raises IOError if filename cannot be opened
+        @param filename - Path to plain, gzip or bgzf file
+        @param threads - Threads to decompress with[Default: 1 per cpu]
+        @return file like object with read and close
+    '''
+    if not compression( filename ):
+        return open( filename, 'rb' )
+    cmd = decompress_command( filename, threads )
+    if cmd is None:
+        return gzip.open( filename, 'rb' )
+    return DecompressedFile( cmd )
+
+class DecompressedFile( object ):
+    '''
+        Read the stdout of a decompression process like a file
+    '''
+    def __init__( self, cmd ):
+        '''
+            @param cmd - Command list that writes to stdout
+        '''
+        self.cmd = cmd
+        self.stderr = tempfile.TemporaryFile()
+        self.process = Popen( cmd, stdout=PIPE, stderr=self.stderr )
+
+    def read( self, size=-1 ):
+        '''
+            @raises IOError if the process fails
+            @return up to size bytes or everything left if size is negative
+        '''
+        data = self.process.stdout.read( size )
+        if not data or size < 0:
+            self._check()
+        return data
+
+    def _check( self ):
+        if self.process.wait() != 0:
+            self.stderr.seek( 0 )
+            raise IOError( "{0} failed: {1}".format(
+                    ' '.join( self.cmd ), self.stderr.read().strip()
+                )
+            )
+
+    def close( self ):
+        ''' Stop the process if it has not finished '''
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
+
+    def readline( self ):
+        '''
+            @raises IOError if the process fails
+            @return next line or '' at the end
+        '''
+        line = self.process.stdout.readline()
+        if not line:
+            self._check()
+        return line
+
+    def __iter__( self ):
+        return iter( self.readline, '' )
+
+class _TeeReader( object ):
+    '''
+        File like object that writes everything read from it to another file
+    '''
+    def __init__( self, fh, out ):
+        self.fh = fh
+        self.out = out
+
+    def read( self, size=-1 ):
+        data = self.fh.read( size )
+        self.out.write( data )
+        return data
+
+def iter_read_records( reads ):
+    '''
+        Iterate over every read of fasta, fastq(compressed or not) and sff
+        files as the text of a single record
+
+        sff reads come out as fastq the same way ReadStream writes them
+
+        @raises ValueError if any of the files are not valid
+        @param reads - Path to a read file or a ReadStream
+        @return generator of fasta or fastq record text
+    '''
+    if isinstance( reads, ReadStream ):
+        files = reads.files
+    else:
+        files = [reads]
+    for filename in files:
+        ftype = seqfile_type( filename )
+        if ftype == 'sff':
+            for read in iter_sff( filename ):
+                yield sff_fastq_record( read )
+            continue
+        # Biopython is slow to import so it is only loaded once it is needed
+        from Bio.SeqIO.FastaIO import SimpleFastaParser
+        from Bio.SeqIO.QualityIO import FastqGeneralIterator
+        with contextlib.closing( open_seqfile( filename ) ) as fh:
+            if ftype == 'fasta':
+                for title, seq in SimpleFastaParser( fh ):
+                    yield '>' + title + '\n' + seq + '\n'
+            else:
+                for title, seq, qual in FastqGeneralIterator( fh ):
+                    yield '@' + title + '\n' + seq + '\n+\n' + qual + '\n'
+
 def get_reads( dir_path ):
     '''
         Return a list of sff and fastq files in a given dir_path
 
         @raises ValueError if invalid path given
         @param dir_path - Path to directory of fastq and sff files
-        @return list of fastq and sff files found in dir_path. Each has dir_path prefixed to them. Empty list if none found
+        @return list of fastq, fastq.gz and sff files found in dir_path. Each has dir_path prefixed to them. Empty list if none found
     '''
     if not os.path.isdir( dir_path ):
         raise ValueError( "{0} is not a valid directory".format(dir_path) )
-    return glob.glob( os.path.join( dir_path, '*.sff' ) ) + glob.glob( os.path.join( dir_path, '*.fastq' ) ) 
+    reads = []
+    for pattern in READ_PATTERNS:
+        reads += glob.glob( os.path.join( dir_path, pattern ) )
+    return reads
+
+def copy_fd( src, dst, count ):
+    '''
+        Copy count bytes from the start of file descriptor src to the current
+        position of dst
+
+        Uses os.copy_file_range or os.sendfile when python has them so the
+        data never leaves the kernel and falls back to a buffered copy when
+        it does not or the files do not support it
+
+        @param src - File descriptor to copy from
+        @param dst - File descriptor to copy to
+        @param count - Number of bytes to copy
+        @return number of bytes copied which is less than count if src is
+            shorter
+    '''
+    offset = 0
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr( os, name, None )
+        if func is None:
+            continue
+        try:
+            while offset < count:
+                if name == 'copy_file_range':
+                    copied = func( src, dst, count - offset, offset )
+                else:
+                    copied = func( dst, src, offset, count - offset )
+                if copied == 0:
+                    return offset
+                offset += copied
+            return offset
+        except OSError as e:
+            # Only give up on the zero copy before anything was copied
+            if offset or e.errno not in ZERO_COPY_ERRORS:
+                raise
+    os.lseek( src, offset, os.SEEK_SET )
+    while offset < count:
+        data = os.read( src, min( READ_BLOCK_SIZE, count - offset ) )
+        if not data:
+            break
+        while data:
+            written = os.write( dst, data )
+            offset += written
+            data = data[written:]
+    return offset
+
+def _copy_seqfile( filename, fh ):
+    '''
+        Append filename to fh decompressing it if needed
+
+        @param filename - Sequence file path
+        @param fh - File object opened for writing
+        @return last byte written or '' if filename is empty
+    '''
+    if compression( filename ):
+        last = ''
+        with contextlib.closing( open_seqfile( filename ) ) as fr:
+            for block in iter( lambda: fr.read( READ_BLOCK_SIZE ), '' ):
+                fh.write( block )
+                last = block[-1]
+        return last
+    fd = os.open( filename, os.O_RDONLY )
+    try:
+        size = os.fstat( fd ).st_size
+        if size == 0:
+            return ''
+        fh.flush()
+        copy_fd( fd, fh.fileno(), size )
+        os.lseek( fd, size - 1, os.SEEK_SET )
+        return os.read( fd, 1 )
+    finally:
+        os.close( fd )
 
+@instrument.timed( 'concat_files' )
 def concat_files( filelist, outputfile ):
     '''
         Duplicate cat *filelist > outputfile
         Don't forget that the files in filelist could end with 2 newlines and thus put empty lines
         into your concatted file. Could be painful with fasta, fastq files
+
+        A file that does not end with a newline gets one so its last line is
+        not joined with the first line of the next file
+
+        Compressed files in filelist are decompressed into outputfile
+
+        An existing outputfile is unlinked first so other links to it are
+        left alone
         
         @raises OSError if any fo filelist or outputfile cannot be read/written
         @raises EmptyFileError if outputfile ends up empty
@@ -73,14 +525,22 @@ def concat_files( filelist, outputfile ):
     if outputfile in filelist:
         raise ValueError( "{0} contains the outputfile".format(filelist) )
 
+    # outputfile may be a hard link to a stored reference so it is replaced
+    # rather than truncated in place
+    try:
+        os.unlink( outputfile )
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
     # Concat all the found files
     # Could raise IOError or OSError as we are using open on files
     # that are not checked to see if they have perms to read/write
     with open( outputfile, 'wb' ) as fh:
         for f in filelist:
             try:
-                with open( f, 'rb' ) as fr:
-                    shutil.copyfileobj( fr, fh )
+                if _copy_seqfile( f, fh ) not in ('', '\n'):
+                    fh.write( '\n' )
             except (IOError,OSError) as e:
                 if e.errno == 2:
                     raise ValueError( "{0} does not exist".format(f) )
@@ -92,14 +552,28 @@ def concat_files( filelist, outputfile ):
         raise EmptyFileError( "Empty files given to concat" )
 
 def seqfile_type( filename ):
+    '''
+        Sniff the type of a sequence file from its first line
+
+        Gzip compressed fasta and fastq are detected by what they contain
+
+        @raises ValueError if filename is not a fasta, fastq or uncompressed sff
+        @param filename - Path to sequence file
+        @return 'fasta', 'fastq' or 'sff'
+    '''
     ftype = 'fasta'
-    with open( filename ) as fh:
+    compressed = compression( filename )
+    if compressed:
+        fh = gzip.open( filename, 'rb' )
+    else:
+        fh = open( filename )
+    with contextlib.closing( fh ):
         firstline = fh.readline()
         if firstline.startswith( '>' ):
             ftype = 'fasta'
         elif firstline.startswith( '@' ):
             ftype = 'fastq'
-        elif firstline.startswith( '.sff' ):
+        elif firstline.startswith( '.sff' ) and not compressed:
             ftype = 'sff'
         else:
             raise ValueError( "{0} not a valid sequence file".format(
@@ -108,7 +582,485 @@ def seqfile_type( filename ):
             )
     return ftype
 
+def validation_level( filename, level=None ):
+    '''
+        @raises ValueError if level is not one of VALIDATION_LEVELS
+        @raises OSError if level is None and filename cannot be stat'd
+        @param filename - File that will be validated
+        @param level - One of VALIDATION_LEVELS or None to sample files of at
+            least SAMPLE_VALIDATION_SIZE and fully validate smaller ones
+        @return one of VALIDATION_LEVELS
+    '''
+    if level is None:
+        if os.stat( filename ).st_size >= SAMPLE_VALIDATION_SIZE:
+            return 'sample'
+        return 'full'
+    if level not in VALIDATION_LEVELS:
+        raise ValueError( "{0} is not a validation level. Use one of {1}".format(
+                level, ', '.join( VALIDATION_LEVELS )
+            )
+        )
+    return level
+
+def validate_seqfile( filename, level=None, samples=VALIDATION_SAMPLES ):
+    '''
+        Check that filename is a fasta, fastq or sff file at the given level
+        (see validation_level)
+
+        full checks every record. sample checks the records in windows at the
+        head, the tail and samples random offsets so it costs the same for any
+        size of file. Fastq that is not in the 4 line layout is handed to
+        Biopython which can parse it. Only the head of compressed files can
+        be sampled.
+
+        @raises ValueError if filename is not a valid sequence file
+        @param filename - Path to sequence file
+        @param level - One of VALIDATION_LEVELS or None to pick by size
+        @param samples - Number of random offsets to check when sampling
+        @return 'fasta', 'fastq', 'sff' or None if level is none
+    '''
+    if not os.path.exists( filename ):
+        raise ValueError( "{0} does not exist".format(filename) )
+    level = validation_level( filename, level )
+    if level == 'none':
+        return None
+    ftype = seqfile_type( filename )
+    if ftype == 'sff':
+        if level == 'sample':
+            sff_read_count( filename )
+        else:
+            for read in iter_sff( filename ):
+                pass
+        return ftype
+    if level == 'sample':
+        valid = _sample_seqfile( filename, ftype, samples )
+    else:
+        valid = _check_seqfile( filename, ftype )
+    if valid:
+        return ftype
+    if ftype == 'fasta':
+        raise ValueError( "{0} is not a valid fasta file".format(filename) )
+    # Biopython raises for anything that is not valid fastq in any layout
+    try:
+        for record in iter_read_records( filename ):
+            pass
+    except ValueError as e:
+        raise ValueError( "{0} is not a valid fastq file: {1}".format(filename, e) )
+    return ftype
+
+def _check_seqfile( filename, ftype ):
+    '''
+        Check every line of a fasta or every 4 line record of a fastq
+
+        @return True if every record is valid
+    '''
+    record = []
+    # Blank lines are only allowed after the last fastq record
+    blank = False
+    with contextlib.closing( open_seqfile( filename ) ) as fh:
+        for line in fh:
+            line = line.rstrip( '\r\n' )
+            if ftype == 'fasta':
+                if not line.startswith( '>' ) and not FASTA_SEQUENCE_REGEX.match( line ):
+                    return False
+                continue
+            if not line.strip():
+                blank = True
+                continue
+            if blank:
+                return False
+            record.append( line )
+            if len( record ) == 4:
+                if not _is_fastq_record( record ):
+                    return False
+                record = []
+    return not record
+
+def _sample_seqfile( filename, ftype, samples ):
+    '''
+        Check the records in windows of fasta or fastq text at the head, the
+        tail and samples random offsets of filename
+
+        @return True if every window held valid records
+    '''
+    if compression( filename ):
+        with contextlib.closing( gzip.open( filename, 'rb' ) ) as fh:
+            return _valid_window( fh.read( VALIDATION_WINDOW ), ftype, True, True )
+    size = os.stat( filename ).st_size
+    # Same offsets every time for the same file size
+    rng = random.Random( size )
+    last = max( 0, size - VALIDATION_WINDOW )
+    offsets = sorted( set( [0, last] + [rng.randint( 0, last ) for i in range( samples )] ) )
+    with open( filename, 'rb' ) as fh:
+        for offset in offsets:
+            fh.seek( offset )
+            window = fh.read( VALIDATION_WINDOW )
+            if not _valid_window( window, ftype, offset == 0, offset + len( window ) >= size ):
+                return False
+    return True
+
+def _valid_window( window, ftype, head, tail ):
+    '''
+        @param window - Text from somewhere in a fasta or fastq file
+        @param head - window is the start of the file
+        @param tail - window is the end of the file
+        @return True if the complete records in window are valid
+    '''
+    lines = window.split( '\n' )
+    # Partial lines at either end of the window are dropped
+    if not head:
+        lines = lines[1:]
+    if tail:
+        while lines and not lines[-1].rstrip():
+            lines.pop()
+    else:
+        lines = lines[:-1]
+    lines = [line.rstrip( '\r' ) for line in lines]
+    if ftype == 'fasta':
+        if head and not (lines and lines[0].startswith( '>' )):
+            return False
+        for line in lines:
+            if not line.startswith( '>' ) and not FASTA_SEQUENCE_REGEX.match( line ):
+                return False
+        return True
+
+    # First line that starts a whole 4 line record
+    start = 0 if head else None
+    if start is None:
+        for i in range( len( lines ) - 3 ):
+            if _is_fastq_record( lines[i:i+4] ):
+                start = i
+                break
+        if start is None:
+            return False
+    if tail:
+        # Whatever is left after the last record is part of a broken one
+        if (len( lines ) - start) % 4 != 0:
+            return False
+    records = (len( lines ) - start) // 4
+    if records == 0 and (head or tail):
+        return False
+    for i in range( start, start + 4 * records, 4 ):
+        if not _is_fastq_record( lines[i:i+4] ):
+            return False
+    return True
+
 def reads_in_file( filename ):
+    '''
+        Count the reads in a fasta, fastq or sff file without parsing them
+        into SeqRecords. Fasta and fastq may be gzip compressed.
+
+        Fasta files count their header lines, sff files report their read count
+        in the common header and fastq files are counted by lines once every
+        record shows they are the simple 4 line format. Anything
+        else is handed to Biopython so the counts always match what SeqIO.parse
+        would produce.
+
+        @raises ValueError if filename is not a valid sequence file
+        @param filename - Path to fasta, fastq or sff file
+        @return number of reads in filename
+    '''
     ftype = seqfile_type( filename )
-    return sum( [1 for seq in SeqIO.parse( filename, ftype )] )
+    if ftype == 'sff':
+        return sff_read_count( filename )
+    with contextlib.closing( open_seqfile( filename ) ) as fh:
+        if ftype == 'fasta':
+            return count_fasta( fh )
+        count = count_fastq( fh )
+    if count is None:
+        from Bio import SeqIO
+        if compression( filename ):
+            fh = gzip.open( filename, 'rb' )
+        else:
+            fh = open( filename )
+        with contextlib.closing( fh ):
+            count = sum( [1 for seq in SeqIO.parse( fh, ftype )] )
+    return count
 
+def iter_blocks( fh, blocksize=READ_BLOCK_SIZE ):
+    '''
+        Iterate over fh in blocks of blocksize bytes
+
+        @param fh - File handle opened in binary mode
+        @param blocksize - Maximum bytes to read at a time
+    '''
+    while True:
+        block = fh.read( blocksize )
+        if not block:
+            break
+        yield block
+
+def count_fasta( fh, blocksize=READ_BLOCK_SIZE ):
+    '''
+        Count the lines that start with > in fh
+
+        @param fh - File handle to fasta data opened in binary mode
+        @param blocksize - Bytes to scan at a time
+        @return number of fasta records
+    '''
+    count = 0
+    # Previous byte seen so records that start on a block boundary are found
+    last = '\n'
+    for block in iter_blocks( fh, blocksize ):
+        count += block.count( '\n>' )
+        if last == '\n' and block[0] == '>':
+            count += 1
+        last = block[-1]
+    return count
+
+def fasta_length( fh, blocksize=READ_BLOCK_SIZE ):
+    '''
+        Count the sequence bytes in fh which is everything except header
+        lines and line endings
+
+        @param fh - File handle to fasta data opened in binary mode
+        @param blocksize - Bytes to scan at a time
+        @return total length of all sequences
+    '''
+    length = 0
+    # Header lines can span blocks
+    header = False
+    last = '\n'
+    for block in iter_blocks( fh, blocksize ):
+        pos = 0
+        end = len( block )
+        while pos < end:
+            if header:
+                nl = block.find( '\n', pos )
+                if nl == -1:
+                    pos = end
+                    continue
+                header = False
+                pos = nl + 1
+                last = '\n'
+            elif last == '\n' and block[pos] == '>':
+                header = True
+            else:
+                nxt = block.find( '\n>', pos )
+                stop = end if nxt == -1 else nxt + 1
+                segment = block[pos:stop]
+                length += len( segment ) - segment.count( '\n' ) - segment.count( '\r' )
+                last = segment[-1]
+                pos = stop
+    return length
+
+def count_fastq( fh, blocksize=READ_BLOCK_SIZE ):
+    '''
+        Count the records in fh assuming the 4 line fastq layout
+
+        Every record is checked for its header, separator and matching
+        sequence and quality lengths so anything Biopython would read
+        differently, such as wrapped records, is rejected. The checks run a
+        whole block of records at a time on slices of its lines. Blank lines
+        are only allowed after the last record. fh is always read to the end.
+
+        @param fh - File handle to fastq data opened in binary mode
+        @param blocksize - Bytes to scan at a time
+        @return number of fastq records or None if fh does not look like a
+            4 line fastq
+    '''
+    count = 0
+    # Whole lines of a record split over blocks
+    carry = []
+    # Unfinished last line of the previous block
+    partial = ''
+    # Blank lines were seen after carry
+    blank = False
+    valid = True
+    for block in iter_blocks( fh, blocksize ):
+        if not valid:
+            continue
+        lines = (partial + block).split( '\n' )
+        partial = lines.pop()
+        end = len( lines )
+        while end and not lines[end-1].strip():
+            end -= 1
+        if end == 0:
+            blank = blank or bool( lines )
+            continue
+        if blank:
+            valid = False
+            continue
+        blank = end < len( lines )
+        lines = carry + lines[:end]
+        whole = len( lines ) - len( lines ) % 4
+        if not _valid_fastq_lines( lines[:whole] ):
+            valid = False
+            continue
+        count += whole // 4
+        carry = lines[whole:]
+    if valid and partial.strip():
+        if blank:
+            valid = False
+        else:
+            carry.append( partial )
+            if len( carry ) == 4 and _valid_fastq_lines( carry ):
+                count += 1
+                carry = []
+    if not valid or carry:
+        return None
+    return count
+
+def _valid_fastq_lines( lines ):
+    '''
+        Checks that lines are whole 4 line fastq records without looping over
+        them in python
+
+        @param lines - List of lines with a multiple of 4 items
+    '''
+    n = len( lines ) // 4
+    if not n:
+        return True
+    if ('\n' + '\n'.join( lines[0::4] )).count( '\n@' ) != n:
+        return False
+    if ('\n' + '\n'.join( lines[2::4] )).count( '\n+' ) != n:
+        return False
+    return map( len, lines[1::4] ) == map( len, lines[3::4] )
+
+def _is_fastq_record( lines ):
+    '''
+        Checks that lines is a single 4 line fastq record
+    '''
+    if len( lines ) != 4:
+        return False
+    title, seq, plus, qual = [line.rstrip() for line in lines]
+    if not title.startswith( '@' ) or not plus.startswith( '+' ):
+        return False
+    return len( seq ) == len( qual )
+
+def sff_read_count( filename ):
+    '''
+        Read the number of reads out of an sff common header
+
+        @raises ValueError if filename does not have a valid sff header
+        @param filename - Path to sff file
+        @return number of reads listed in the header
+    '''
+    with open( filename, 'rb' ) as fh:
+        header = sff_header( fh.read( SFF_HEADER.size ), filename )
+    return header.number_of_reads
+
+def sff_header( data, filename ):
+    '''
+        Parse the fixed part of an sff common header
+
+        @raises ValueError if data is not an sff header this can read
+        @param data - At least the first SFF_HEADER.size bytes of the file
+        @param filename - Name of file data came from for errors
+        @return SffHeader
+    '''
+    if len( data ) < SFF_HEADER.size or data[:4] != '.sff':
+        raise ValueError( "{0} is not a valid sff file".format(filename) )
+    magic, version, index_offset, index_length, number_of_reads, header_length, \
+        key_length, number_of_flows, flowgram_format = SFF_HEADER.unpack_from( data )
+    if version != SFF_VERSION or flowgram_format != 1:
+        raise ValueError( "{0} is an unsupported sff version".format(filename) )
+    return SffHeader( index_offset, index_length, number_of_reads,
+        header_length, number_of_flows )
+
+def iter_sff( filename ):
+    '''
+        Iterate over the reads of an sff without decoding flowgrams
+
+        The file is memory mapped and only the name, bases, qualities and
+        clip points are sliced out of each read
+
+        @raises ValueError if filename is not a valid sff
+        @param filename - Path to sff file
+        @return generator of SffRead
+    '''
+    with open( filename, 'rb' ) as fh:
+        header = sff_header( fh.read( SFF_HEADER.size ), filename )
+        if header.number_of_reads == 0:
+            return
+        data = mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ )
+    try:
+        end = len( data )
+        flow_size = 2 * header.number_of_flows
+        index_offset = header.index_offset
+        offset = header.header_length
+        for i in xrange( header.number_of_reads ):
+            # Index block can sit between reads
+            if index_offset and offset == index_offset:
+                offset = index_offset + header.index_length
+                offset += -offset % 8
+            if offset + SFF_READ_HEADER.size > end:
+                raise ValueError( "{0} is truncated".format(filename) )
+            read_header_length, name_length, seq_len, clip_qual_left, \
+                clip_qual_right, clip_adapter_left, clip_adapter_right = \
+                SFF_READ_HEADER.unpack_from( data, offset )
+            if read_header_length < 10 or read_header_length % 8 != 0:
+                raise ValueError( "{0} has a malformed read header".format(filename) )
+            name_start = offset + SFF_READ_HEADER.size
+            name = data[name_start:name_start + name_length]
+            bases_start = offset + read_header_length + flow_size + seq_len
+            quals_start = bases_start + seq_len
+            if quals_start + seq_len > end:
+                raise ValueError( "{0} is truncated".format(filename) )
+
+            # Clip points are 1 based with 0 meaning not set
+            clip_left = max( clip_qual_left - 1, clip_adapter_left - 1, 0 )
+            if clip_qual_right and clip_adapter_right:
+                clip_right = min( clip_qual_right, clip_adapter_right )
+            else:
+                clip_right = clip_qual_right or clip_adapter_right or seq_len
+
+            yield SffRead( name, data[bases_start:quals_start],
+                data[quals_start:quals_start + seq_len], clip_left, clip_right )
+
+            # Flowgram, flow index, bases and qualities padded to 8 bytes
+            record_length = flow_size + 3 * seq_len
+            offset += read_header_length + record_length + -record_length % 8
+    finally:
+        data.close()
+
+def sff_fastq_record( read, trim=False ):
+    '''
+        Format an SffRead the same way Biopython writes sff records as fastq
+
+        @param read - SffRead
+        @param trim - Remove bases outside of the clip points instead of
+            lower casing them
+        @return fastq record text
+    '''
+    bases = read.bases
+    quals = read.quals
+    left = read.clip_left
+    right = read.clip_right
+    if trim:
+        if left >= right:
+            bases = quals = ''
+        else:
+            bases = bases[left:right].upper()
+            quals = quals[left:right]
+    elif left >= right:
+        bases = bases.lower()
+    else:
+        bases = bases[:left].lower() + bases[left:right].upper() + \
+            bases[right:].lower()
+    return '@' + read.name + '\n' + bases + '\n+\n' + quals.translate( PHRED33 ) + '\n'
+
+def write_sff_fastq( filename, fh, trim=False ):
+    '''
+        Write every read of an sff to fh as fastq in large chunks
+
+        @raises ValueError if filename is not a valid sff
+        @param filename - Path to sff file
+        @param fh - File handle to write fastq to
+        @param trim - Trim reads to their clip points
+        @return number of reads written
+    '''
+    count = 0
+    chunk = []
+    chunk_size = 0
+    for read in iter_sff( filename ):
+        record = sff_fastq_record( read, trim )
+        chunk.append( record )
+        chunk_size += len( record )
+        count += 1
+        if chunk_size >= FASTQ_WRITE_BUFFER:
+            fh.write( ''.join( chunk ) )
+            chunk = []
+            chunk_size = 0
+    fh.write( ''.join( chunk ) )
+    return count
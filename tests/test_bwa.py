@@ -1,6 +1,6 @@
 from nose.tools import eq_, raises
 from bwa.bwa import BWA, BWAMem, BWAIndex
-from bwa import seqio, bwa
+from bwa import seqio, bwa, cache, indexstore
 
 import tempfile
 import shutil
@@ -8,6 +8,11 @@ import os
 import os.path
 import sys
 import glob
+import time
+import fcntl
+import signal
+import subprocess
+import threading
 
 import mock
 
@@ -227,6 +232,38 @@ class TestBWAMem( BaseBWA ):
         assert '-a 3' in result_output
         assert self.fa + ' ' + self.fa2 in result_output
 
+    def test_validation_notoption( self ):
+        ''' validation is not handed to bwa '''
+        mem = BWAMem( self.fa, self.fa2, validation='sample', bwa_path=self.bwa_path )
+        eq_( 'sample', mem.validation )
+        eq_( [], mem.options )
+
+    @raises( ValueError )
+    def test_validation_invalid( self ):
+        BWAMem( self.fa, self.fa2, validation='some', bwa_path=self.bwa_path )
+
+    def test_validation_none( self ):
+        ''' none only checks that the inputs exist '''
+        with open( 'garbage.fastq', 'w' ) as fh:
+            fh.write( 'not reads' )
+        with mock.patch.object( bwa, 'is_indexed' ) as is_indexed:
+            BWAMem( 'garbage.fastq', 'garbage.fastq', validation='none',
+                bwa_path=self.bwa_path )
+        eq_( 0, is_indexed.call_count )
+
+    def test_validation_full_verifies_index( self ):
+        with mock.patch.object( bwa, 'is_indexed', return_value=True ) as is_indexed:
+            BWAMem( self.fa, self.fa2, validation='full', bwa_path=self.bwa_path )
+            eq_( True, is_indexed.call_args[1]['verify'] )
+            BWAMem( self.fa, self.fa2, validation='sample', bwa_path=self.bwa_path )
+            eq_( False, is_indexed.call_args[1]['verify'] )
+
+    @raises( ValueError )
+    def test_validation_full_reads( self ):
+        with open( 'bad.fastq', 'w' ) as fh:
+            fh.write( '@read1\nACGT\n+\nIIII\n@read2\nACGT\n+\nII\n@read3\nACGT\n+\nIIII\n' )
+        BWAMem( self.fa, 'bad.fastq', bwa_path=self.bwa_path )
+
     def test_optionalthird( self ):
         ''' Test that given a correct third argument it still runs '''
         infa = ungzip(INPUT_PATH)
@@ -269,6 +306,289 @@ class TestBWAMem( BaseBWA ):
             bwa = BWAMem( self.fa, filename, bwa_path=BWA_PATH )
             eq_( 0, bwa.bwa_return_code( testline ) )
 
+    def test_run_countsduringbwa( self ):
+        ''' Input reads are counted while bwa is still running '''
+        # Fake bwa only reports reads once the count has started
+        bwa = self.mkbwa( 'counting; for i in $(seq 50); do [ -e counted ] && break; sleep 0.1; done; ' \
+            '[ -e counted ] && echo "[M::main_mem] read 1 sequences (4 bp)..." 1>&2' )
+        def count():
+            create( 'counted' )
+            return 1
+        mem = BWAMem( self.fa, self.fa2, bwa_path=bwa )
+        with mock.patch.object( mem, 'count_expected_reads', count ):
+            eq_( 0, mem.run( 'output' ) )
+        os.unlink( 'counted' )
+
+    def test_run_progress( self ):
+        ''' Progress callback is called for every batch bwa reads '''
+        line = '[M::main_mem] read 1 sequences (4 bp)...'
+        bwa = self.mkbwa( '"{0}" 1>&2; echo "{0}" 1>&2'.format(line) )
+        seen = []
+        mem = BWAMem( self.fa, self.fa2, self.fa2, bwa_path=bwa )
+        eq_( 0, mem.run( 'output', progress=seen.append ) )
+        eq_( [1, 2], [p.reads for p in seen] )
+        eq_( [4, 8], [p.bp for p in seen] )
+
+    def _progressfails( self, mem, **kwargs ):
+        ''' Run mem with a failing progress callback and return the bwa process '''
+        started = []
+        popen = bwa.Popen
+        def record( *args, **kw ):
+            started.append( popen( *args, **kw ) )
+            return started[-1]
+        def fail( progress ):
+            raise RuntimeError( 'callback failed' )
+        start = time.time()
+        with mock.patch.object( bwa, 'Popen', side_effect=record ):
+            try:
+                mem.run( 'output', progress=fail, **kwargs )
+                assert False, 'run did not raise'
+            except RuntimeError:
+                pass
+        assert time.time() - start < 10
+        return started
+
+    def test_run_progress_fails( self ):
+        ''' bwa is killed and reaped when the progress callback raises '''
+        bwa_path = self.mkbwa( '> /dev/null; echo "[M::main_mem] read 1 sequences (4 bp)..." 1>&2; exec sleep 30' )
+        p = self._progressfails( BWAMem( self.fa, self.fa2, bwa_path=bwa_path ) )[0]
+        eq_( -signal.SIGKILL, p.returncode )
+        assert p.stderr.closed
+
+    def test_run_sortedbam_progress_fails( self ):
+        ''' samtools sort is stopped as well '''
+        bwa_path = self.mkbwa( '> /dev/null; echo "[M::main_mem] read 1 sequences (4 bp)..." 1>&2; exec sleep 30' )
+        samtools = self._fakesamtools()
+        sorter, p = self._progressfails( BWAMem( self.fa, self.fa2, bwa_path=bwa_path ),
+            output_format='bam', samtools_path=samtools )
+        eq_( -signal.SIGKILL, p.returncode )
+        assert sorter.returncode is not None
+        assert not os.path.exists( 'output.bai' )
+
+    def test_run_sharded_progress_fails( self ):
+        bwa_path = self.mkbwa( '> /dev/null; echo "[M::main_mem] read 1 sequences (4 bp)..." 1>&2; exec sleep 30' )
+        started = self._progressfails( BWAMem( self.fa, self.fa2, bwa_path=bwa_path ), shards=2 )
+        assert started
+        for p in started:
+            assert p.returncode is not None
+
+    def _samfakebwa( self, reads ):
+        ''' Fake bwa that writes a SAM record per read and reports reads read '''
+        script = '> /dev/null; printf "@SQ\\tSN:seq1\\tLN:4\\n"; ' + \
+            'for i in $(seq {0}); do printf "r$i\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\tATGC\\tIIII\\n"; done; ' + \
+            'echo "[M::main_mem] read {0} sequences (4 bp)..." 1>&2'
+        return self.mkbwa( script.format(reads) )
+
+    def test_stream( self ):
+        ''' Records come out of the pipe and status is set when exhausted '''
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 1 ) )
+        stream = mem.stream()
+        eq_( None, stream.returncode )
+        items = list( stream )
+        eq_( ['@SQ\tSN:seq1\tLN:4'], items[0] )
+        eq_( ['r1'], [r.qname for r in items[1:]] )
+        eq_( 0, stream.returncode )
+
+    def test_stream_wrongcount( self ):
+        ''' Same failure status as bwa_return_code '''
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ) )
+        stream = mem.stream()
+        eq_( 4, len( list( stream ) ) )
+        eq_( 1, stream.returncode )
+
+    def test_stream_closedearly( self ):
+        ''' Stopping early kills bwa and leaves status unset '''
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 100000 ) )
+        stream = mem.stream()
+        for item in stream:
+            break
+        stream.close()
+        assert stream.process.returncode is not None
+        eq_( None, stream.returncode )
+
+    def test_run_async( self ):
+        ''' Same output and status as run without blocking '''
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 1 ) )
+        seen = []
+        job = mem.run_async( 'async.sam', progress=seen.append )
+        assert job.fileno() >= 0
+        eq_( 0, job.result() )
+        assert job.done()
+        eq_( 0, job.poll() )
+        eq_( 1, len( seen ) )
+        with open( 'async.sam' ) as fh:
+            eq_( 2, len( fh.read().splitlines() ) )
+
+    def test_run_async_wrongcount( self ):
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ) )
+        eq_( 1, mem.run_async( 'async.sam' ).result() )
+
+    def test_run_async_poll( self ):
+        ''' poll returns None while bwa runs and never blocks '''
+        bwa_path = self.mkbwa( '> /dev/null; echo "[M::main_mem] read 1 sequences (4 bp)..." 1>&2; sleep 1' )
+        job = BWAMem( self.fa, self.fa2, bwa_path=bwa_path ).run_async( 'async.sam' )
+        start = time.time()
+        eq_( None, job.poll() )
+        eq_( None, job.result( timeout=0.1 ) )
+        assert time.time() - start < 0.9
+        eq_( 0, job.result() )
+        eq_( 1, job.monitor.total_reads )
+
+    def test_run_async_poll_counting( self ):
+        ''' poll does not block on a read count that is still running '''
+        counting = threading.Event()
+        def count( ):
+            counting.wait( 5 )
+            return 1
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 1 ) )
+        with mock.patch.object( mem, 'count_expected_reads', side_effect=count ):
+            job = mem.run_async( 'async.sam' )
+            job.process.wait()
+            start = time.time()
+            eq_( None, job.poll() )
+            eq_( None, job.poll() )
+            eq_( None, job.result( timeout=0.1 ) )
+            assert time.time() - start < 1
+            counting.set()
+            eq_( 0, job.result() )
+
+    def test_run_async_cancel( self ):
+        ''' Cancelling kills bwa '''
+        bwa_path = self.mkbwa( '> /dev/null; exec sleep 30' )
+        job = BWAMem( self.fa, self.fa2, bwa_path=bwa_path ).run_async( 'async.sam' )
+        eq_( True, job.cancel() )
+        assert job.done()
+        assert job.process.returncode is not None
+        eq_( None, job.returncode )
+        eq_( False, job.cancel() )
+        try:
+            job.result()
+            assert False, 'result did not raise'
+        except bwa.CancelledError:
+            pass
+
+    def _fakesamtools( self, sortret=0 ):
+        ''' Fake samtools that logs its args, cats sort input to -o and touches a .bai '''
+        with open( 'samtools', 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\necho "$@" >> samtools.log\n' \
+                'if [ "$1" == "sort" ]; then\n' \
+                '  while [ $# -gt 0 ]; do [ "$1" == "-o" ] && out=$2; shift; done\n' \
+                '  cat > $out; exit {0}\n' \
+                'fi\ntouch $2.bai\n'.format(sortret) )
+        os.chmod( 'samtools', 0700 )
+        if os.path.exists( 'samtools.log' ):
+            os.unlink( 'samtools.log' )
+        return os.path.abspath( 'samtools' )
+
+    def test_run_sortedbam( self ):
+        ''' bwa output is piped into sort and then indexed '''
+        samtools = self._fakesamtools()
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 1 ) )
+        ret = mem.run( 'out.bam', output_format='bam', sort_threads=4,
+            sort_memory='1G', samtools_path=samtools )
+        eq_( 0, ret )
+        with open( 'out.bam' ) as fh:
+            eq_( 2, len( fh.readlines() ) )
+        assert os.path.exists( 'out.bam.bai' )
+        with open( 'samtools.log' ) as fh:
+            log = fh.read().splitlines()
+        eq_( 'sort -@ 4 -O bam -o out.bam -m 1G -', log[0] )
+        eq_( 'index out.bam', log[1] )
+
+    def test_run_sortedbam_bwafails( self ):
+        ''' bwa return code validation still applies '''
+        samtools = self._fakesamtools()
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ) )
+        eq_( 1, mem.run( 'out.bam', output_format='bam', samtools_path=samtools ) )
+
+    def test_run_sortedbam_sortfails( self ):
+        ''' Failed sort is a failure and nothing is indexed '''
+        samtools = self._fakesamtools( 1 )
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 1 ) )
+        eq_( 1, mem.run( 'out2.bam', output_format='bam', samtools_path=samtools ) )
+        assert not os.path.exists( 'out2.bam.bai' )
+
+    def test_verification_sam( self ):
+        ''' Records bwa writes are counted instead of the inputs '''
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ),
+            verification='sam' )
+        with mock.patch.object( mem, 'count_expected_reads' ) as count:
+            eq_( 0, mem.run( 'output' ) )
+        eq_( 0, count.call_count )
+        with open( 'output' ) as fh:
+            eq_( 4, len( fh.readlines() ) )
+
+    def test_verification_sam_missing( self ):
+        ''' Fewer primary records than reads bwa read is a failure '''
+        bwa = self.mkbwa( '> /dev/null; printf "@SQ\\tSN:seq1\\tLN:4\\n"; ' \
+            'printf "r1\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\tATGC\\tIIII\\n"; ' \
+            'printf "r1\\t256\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\tATGC\\tIIII\\n"; ' \
+            'echo "[M::main_mem] read 2 sequences (8 bp)..." 1>&2' )
+        mem = BWAMem( self.fa, self.fa2, bwa_path=bwa, verification='sam' )
+        eq_( 1, mem.run( 'output' ) )
+
+    def test_verification_sam_bam( self ):
+        ''' Counted on the way into samtools sort '''
+        samtools = self._fakesamtools()
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ),
+            verification='sam' )
+        eq_( 0, mem.run( 'out.bam', output_format='bam', samtools_path=samtools ) )
+        with open( 'out.bam' ) as fh:
+            eq_( 4, len( fh.readlines() ) )
+
+    def test_verification_sam_async( self ):
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self._samfakebwa( 3 ),
+            verification='sam' )
+        eq_( 0, mem.run_async( 'output' ).result() )
+        with open( 'output' ) as fh:
+            eq_( 4, len( fh.readlines() ) )
+
+    @raises( ValueError )
+    def test_verification_invalid( self ):
+        BWAMem( self.fa, self.fa2, bwa_path=self.bwa_path, verification='bam' )
+
+    @raises( ValueError )
+    def test_run_sortedbam_invalidsamtools( self ):
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self.bwa_path )
+        mem.run( 'out.bam', output_format='bam', samtools_path='/no/samtools' )
+
+    @raises( ValueError )
+    def test_run_invalidformat( self ):
+        mem = BWAMem( self.fa, self.fa2, bwa_path=self.bwa_path )
+        mem.run( 'out.cram', output_format='cram' )
+
+    def test_run_readstream( self ):
+        ''' ReadStream is fed through a named pipe and tallied as it passes '''
+        # Fake bwa that copies the reads it is given to stdout and reports them
+        bwa = self.mkbwa( '> /dev/null; n=$(cat $3 | tee fed.fastq | wc -l); cat fed.fastq; ' \
+            'echo "[M::main_mem] read $((n/4)) sequences (4 bp)..." 1>&2' )
+        fastq = ungzip( INPUT_PATH, 'stream.fastq' )
+        stream = seqio.ReadStream( [fastq, fastq] )
+        mem = BWAMem( self.fa, stream, bwa_path=bwa )
+        eq_( 0, mem.run( 'output' ) )
+        with open( fastq ) as fh:
+            expected = fh.read() * 2
+        with open( 'output' ) as fh:
+            eq_( expected, fh.read() )
+        for feeder in mem.feeders.values():
+            assert not os.path.exists( feeder.tmpdir )
+
+    def test_run_readstream_neveropened( self ):
+        ''' bwa exiting without reading the pipe does not hang '''
+        bwa = self.mkbwa( 'never read' )
+        fastq = ungzip( INPUT_PATH, 'stream.fastq' )
+        mem = BWAMem( self.fa, seqio.ReadStream( [fastq] ), bwa_path=bwa )
+        eq_( 1, mem.run( 'output' ) )
+
+    @raises( ValueError )
+    def test_readstream_invalidfile( self ):
+        BWAMem( self.fa, seqio.ReadStream( ['/invalid/path.fastq'] ), bwa_path=self.bwa_path )
+
+    def test_expectedreads_notstarted( self ):
+        ''' Counting still works when bwa_return_code is called directly '''
+        mem = BWAMem( self.fa, self.fa2, self.fa2, bwa_path=self.bwa_path )
+        eq_( 2, mem.expected_reads() )
+
     def test_bwareturncode_nocount( self ):
         ''' Make sure if no read sequences lines exist error is returned '''
         endline = '[main] Version: {0}.{1}.{2}-r{3}'
@@ -279,6 +599,124 @@ class TestBWAMem( BaseBWA ):
         bwa = BWAMem( self.fa, self.fa2, bwa_path=BWA_PATH )
         eq_( 1, bwa.bwa_return_code( '[main] Version: 0.7.4-r385' ) )
 
+class TestShards( BaseBWA ):
+    @classmethod
+    def setUpClass( self ):
+        super( TestShards, self ).setUpClass()
+        self.fa = os.path.join( self.tempdir, 'input.fa' )
+        with open( self.fa, 'w' ) as fh:
+            fh.write( '>seq1\nATGC\n' )
+        createrefindexes( self.fa + '.bwt' )
+        self.reads = self._writereads( 'reads.fa', 'r', 10 )
+        self.mates = self._writereads( 'mates.fa', 'm', 10 )
+
+    @classmethod
+    def _writereads( self, path, prefix, count ):
+        with open( path, 'w' ) as fh:
+            for i in range( 1, count + 1 ):
+                fh.write( '>{0}{1}\nATGC\n'.format(prefix, i) )
+        return os.path.abspath( path )
+
+    def setUp( self ):
+        for f in glob.glob( '*.log' ):
+            os.unlink( f )
+
+    def _shardbwa( self, report='$n' ):
+        ''' Fake bwa that writes a SAM record for every read in the shard files '''
+        script = '> /dev/null; echo "$*" >> shards.log; ' \
+            'printf "@SQ\\tSN:seq1\\tLN:4\\n@PG\\tID:bwa\\n"; n=0; ' \
+            'for f in "$@"; do case $f in *.reads) ' \
+            'n=$((n+$(grep -c "^>" $f))); ' \
+            'for r in $(grep "^>" $f | cut -c2-); do ' \
+            'printf "$r\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\tATGC\\tIIII\\n"; done;; esac; done; ' \
+            'echo "[M::main_mem] read ' + report + ' sequences (4 bp)..." 1>&2'
+        return self.mkbwa( script )
+
+    def _records( self, path ):
+        with open( path ) as fh:
+            lines = fh.read().splitlines()
+        return [l.split( '\t' )[0] for l in lines]
+
+    def test_shard_sizes( self ):
+        eq_( [4, 3, 3], bwa.shard_sizes( 10, 3 ) )
+        eq_( [1, 1], bwa.shard_sizes( 2, 5 ) )
+        eq_( [], bwa.shard_sizes( 0, 4 ) )
+        eq_( [4, 4, 3], bwa.shard_sizes( 11, 3, 2 ) )
+        eq_( [1], bwa.shard_sizes( 1, 4, 2 ) )
+
+    def test_shard_options( self ):
+        ''' Thread budget is divided between shards '''
+        mem = BWAMem( self.fa, self.reads, t=8, k=3, bwa_path=self.bwa_path )
+        options = mem.shard_options( 3 )
+        eq_( ['-t', '2'], options[-2:] )
+        eq_( 1, options.count( '-t' ) )
+        assert '-k' in options
+        eq_( ['-t', '1'], mem.shard_options( 16 )[-2:] )
+
+    def test_run_sharded( self ):
+        ''' Reads stay in order under a single header '''
+        mem = BWAMem( self.fa, self.reads, t=6, bwa_path=self._shardbwa() )
+        eq_( 0, mem.run( 'out.sam', shards=3 ) )
+        expected = ['@SQ', '@PG'] + ['r{0}'.format(i) for i in range( 1, 11 )]
+        eq_( expected, self._records( 'out.sam' ) )
+        with open( 'shards.log' ) as fh:
+            log = fh.read().splitlines()
+        eq_( 3, len( log ) )
+        for line in log:
+            assert line.startswith( 'mem -t 2 ' ), line
+        eq_( [], glob.glob( '.bwashards*' ) )
+
+    def test_run_sharded_mates( self ):
+        ''' Mates are split at the same reads '''
+        mem = BWAMem( self.fa, self.reads, self.mates, bwa_path=self._shardbwa() )
+        eq_( 0, mem.run( 'out.sam', shards=3 ) )
+        expected = ['@SQ', '@PG']
+        start = 1
+        for size in (4, 3, 3):
+            names = range( start, start + size )
+            expected += ['r{0}'.format(i) for i in names]
+            expected += ['m{0}'.format(i) for i in names]
+            start += size
+        eq_( expected, self._records( 'out.sam' ) )
+
+    def test_run_sharded_interleaved( self ):
+        ''' Interleaved pairs are not split between shards '''
+        mem = BWAMem( self.fa, self.reads, p=True, bwa_path=self._shardbwa() )
+        eq_( 0, mem.run( 'out.sam', shards=4 ) )
+        with open( 'shards.log' ) as fh:
+            eq_( 4, len( fh.read().splitlines() ) )
+        eq_( ['r{0}'.format(i) for i in range( 1, 11 )], self._records( 'out.sam' )[2:] )
+
+    @raises( ValueError )
+    def test_run_sharded_matesmismatch( self ):
+        mates = self._writereads( 'short.fa', 'm', 9 )
+        BWAMem( self.fa, self.reads, mates, bwa_path=self._shardbwa() ).run( 'out.sam', shards=2 )
+
+    def test_run_sharded_miscount( self ):
+        ''' Counts from every shard are summed for the status '''
+        mem = BWAMem( self.fa, self.reads, bwa_path=self._shardbwa( '1' ) )
+        eq_( 1, mem.run( 'out.sam', shards=2 ) )
+
+    def test_run_sharded_progress( self ):
+        seen = []
+        mem = BWAMem( self.fa, self.reads, bwa_path=self._shardbwa() )
+        eq_( 0, mem.run( 'out.sam', shards=2, progress=seen.append ) )
+        eq_( 2, len( seen ) )
+        eq_( (10, 10), (seen[-1].reads, seen[-1].expected_reads) )
+
+    def test_run_sharded_bam( self ):
+        ''' Merged shards are piped into samtools sort '''
+        with open( 'samtools', 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\nif [ "$1" == "sort" ]; then\n' \
+                '  while [ $# -gt 0 ]; do [ "$1" == "-o" ] && out=$2; shift; done\n' \
+                '  cat > $out\nfi\n' )
+        os.chmod( 'samtools', 0700 )
+        mem = BWAMem( self.fa, self.reads, bwa_path=self._shardbwa() )
+        ret = mem.run( 'out.bam', output_format='bam', shards=3,
+            samtools_path=os.path.abspath( 'samtools' ) )
+        eq_( 0, ret )
+        eq_( 12, len( self._records( 'out.bam' ) ) )
+
 class TestBWAIndex( BaseBWA ):
     @raises( ValueError )
     def test_nonexistfasta( self ):
@@ -296,6 +734,23 @@ class TestBWAIndex( BaseBWA ):
     def test_nofastaarggiven( self ):
         BWAIndex( bwa_path=BWA_PATH ).run()
 
+    def test_sample_skips_count( self ):
+        ''' Sampled references are not counted when constructed '''
+        shutil.copy( REF_PATH, 'ref.fa' )
+        with mock.patch.object( cache, 'reads_in_file' ) as count:
+            BWAIndex( 'ref.fa', bwa_path=BWA_PATH, validation='sample' )
+            eq_( 0, count.call_count )
+            BWAIndex( 'ref.fa', bwa_path=BWA_PATH )
+            eq_( 1, count.call_count )
+
+    @raises( ValueError )
+    def test_sample_empty_sff( self ):
+        ''' Sampled sff with no reads in its header is rejected '''
+        with open( 'empty.sff', 'wb' ) as fh:
+            fh.write( seqio.SFF_HEADER.pack( '.sff', seqio.SFF_VERSION, 0, 0, 0,
+                seqio.SFF_HEADER.size, 4, 0, 1 ) )
+        BWAIndex( 'empty.sff', bwa_path=BWA_PATH, validation='sample' )
+
     def test_validfasta( self ):
         ref = 'ref.fa'
         # Make copy in tempdir
@@ -306,6 +761,12 @@ class TestBWAIndex( BaseBWA ):
         print indexes
         eq_( len(indexes), 5, "Did not create all index files" )
 
+    def test_run_async( self ):
+        shutil.copy( REF_PATH, 'ref.fa' )
+        job = BWAIndex( 'ref.fa', bwa_path=BWA_PATH ).run_async()
+        eq_( 0, job.result() )
+        eq_( 5, len( glob.glob( 'ref.fa.*' ) ) )
+
     def test_nooutputfile( self ):
         ''' Ensure no output file is created '''
         os.mkdir( 'dir1' )
@@ -402,6 +863,49 @@ class TestCompileReads( BaseBWA ):
         self._isfastq( outfile )
         eq_( expected_readcount, seqio.reads_in_file( outfile ) )
 
+    def test_seedsreadcount( self ):
+        ''' Compiled output read count is cached without reading it '''
+        os.mkdir( 'seeded' )
+        os.symlink( self.sff, os.path.join( 'seeded', 'sff1.sff' ) )
+        os.symlink( self.fastq, os.path.join( 'seeded', 'fq1.fastq' ) )
+        expected_readcount = seqio.reads_in_file( self.sff ) + \
+            cache.reads_in_file( os.path.join( 'seeded', 'fq1.fastq' ) )
+        outfile = bwa.compile_reads( 'seeded' )
+        eq_( expected_readcount, cache.READ_COUNTS.get( outfile ) )
+
+    def test_seedsreadcount_uncounted( self ):
+        ''' Inputs are not read again just to seed the count '''
+        os.mkdir( 'unseeded' )
+        os.symlink( self.fastq, os.path.join( 'unseeded', 'fq1.fastq' ) )
+        with mock.patch.object( cache.READ_COUNTS, 'get', return_value=None ):
+            with mock.patch.object( seqio, 'reads_in_file' ) as count:
+                outfile = bwa.compile_reads( 'unseeded' )
+                eq_( 0, count.call_count )
+        self._isfastq( outfile )
+
+    def test_paramsinglefastqgz( self ):
+        ''' Compressed fastq is handed to bwa as is '''
+        eq_( INPUT_PATH, bwa.compile_reads( INPUT_PATH ) )
+
+    def test_paramdirfastqgz( self ):
+        ''' Compressed fastq in a directory are decompressed into the output '''
+        os.mkdir( 'fastqgz' )
+        os.symlink( INPUT_PATH, os.path.join( 'fastqgz', 'fq1.fastq.gz' ) )
+        os.symlink( self.fastq, os.path.join( 'fastqgz', 'fq2.fastq' ) )
+        outfile = bwa.compile_reads( 'fastqgz' )
+        self._isfastq( outfile )
+        eq_( seqio.reads_in_file( self.fastq ) * 2, seqio.reads_in_file( outfile ) )
+
+    def test_stream( self ):
+        ''' Streaming mode returns a ReadStream and writes nothing '''
+        os.mkdir( 'streamed' )
+        os.symlink( self.sff, os.path.join( 'streamed', 'sff1.sff' ) )
+        os.symlink( self.fastq, os.path.join( 'streamed', 'fq1.fastq' ) )
+        stream = bwa.compile_reads( 'streamed', stream=True )
+        eq_( [os.path.join( 'streamed', 'fq1.fastq' ), os.path.join( 'streamed', 'sff1.sff' )], stream.files )
+        eq_( [], glob.glob( '*.fastq' ) )
+        eq_( [self.sff], bwa.compile_reads( self.sff, stream=True ).files )
+
     def test_targetbug1_1( self ):
         '''
             Targets a bug where compile_reads would generate 2 identical
@@ -440,6 +944,410 @@ class TestCompileReads( BaseBWA ):
 
 from nose.plugins.attrib import attr
 @attr('current')
+class TestIndexStore( BaseBWA ):
+    def setUp( self ):
+        self.store = indexstore.IndexStore( os.path.join( self.tempdir, 'store' ) )
+        # Fake bwa that logs index runs and writes the index files to the -p
+        # prefix
+        self.bwa = self.mkbwa( '"Version: 0.7.15-r1140" 1>&2; ' \
+            'if [ "$1" == "index" ]; then echo "$@" >> index.log; ' \
+            'while [ $# -gt 1 ]; do [ "$1" == "-p" ] && prefix=$2; shift; done; ' \
+            'for e in amb ann bwt pac sa; do touch $prefix.$e; done; fi' )
+        os.mkdir( 'refs' )
+        for i in range( 2 ):
+            util.create_fakefasta( os.path.join( 'refs', 'ref{0}.fa'.format(i) ), i + 1 )
+
+    def tearDown( self ):
+        shutil.rmtree( 'refs' )
+        for f in glob.glob( 'index.log' ) + glob.glob( 'ref.fa*' ) + glob.glob( 'reference.fa*' ):
+            os.unlink( f )
+        for key, meta in self.store.entries():
+            self.store.remove( key )
+
+    def _indexruns( self ):
+        return len( self._indexlog() )
+
+    def _indexlog( self ):
+        if not os.path.exists( 'index.log' ):
+            return []
+        with open( 'index.log' ) as fh:
+            return fh.read().splitlines()
+
+    def test_index_options( self ):
+        ''' is while it fits in memory, then bwtsw with the biggest block that fits '''
+        ref = util.create_fakefasta( 'ref.fa', 1000 )
+        eq_( {'a': 'is'}, bwa.index_options( ref, memory=4000 * 6 ) )
+        eq_( {'a': 'bwtsw', 'b': 4000}, bwa.index_options( ref, memory=4000 * 5 ) )
+        with mock.patch.object( bwa, 'IS_MAX_LENGTH', 100 ):
+            eq_( 'bwtsw', bwa.index_options( ref, memory='1G' )['a'] )
+        with mock.patch.object( bwa, 'DEFAULT_BLOCK_SIZE', 100 ):
+            # Block is as big as the budget allows
+            eq_( {'a': 'bwtsw', 'b': 1000}, bwa.index_options( ref, 'bwtsw', memory=4000 + 8000 ) )
+            # but never smaller than the default
+            eq_( {'a': 'bwtsw', 'b': 100}, bwa.index_options( ref, 'bwtsw', memory=10 ) )
+
+    def test_index_options_max_block( self ):
+        ''' Block size never overflows bwa's int for huge references '''
+        ref = util.create_fakefasta( 'ref.fa', 10 )
+        with mock.patch.object( seqio, 'fasta_length', return_value=3100000000 ):
+            eq_( {'a': 'bwtsw', 'b': 2**31 - 1}, bwa.index_options( ref, memory='64G' ) )
+
+    def test_index_options_overrides( self ):
+        ref = util.create_fakefasta( 'ref.fa', 10 )
+        eq_( {'a': 'bwtsw', 'b': 5}, bwa.index_options( ref, 'bwtsw', 5 ) )
+        eq_( {'a': 'is'}, bwa.index_options( ref, 'is', 5 ) )
+        with mock.patch.object( seqio, 'fasta_length' ) as fl:
+            bwa.index_options( ref, 'bwtsw', 5 )
+            eq_( 0, fl.call_count )
+
+    def test_index_ref_options( self ):
+        ''' Chosen options are passed to bwa index '''
+        ref = util.create_fakefasta( 'ref.fa', 10 )
+        bwa.index_ref( ref, self.bwa, False, algorithm='bwtsw', block_size=7 )
+        args = self._indexlog()[0].split()
+        assert '-a bwtsw' in ' '.join( args ), args
+        assert '-b 7' in ' '.join( args ), args
+        eq_( ref, args[-1] )
+        bwa.clear_index( ref )
+        bwa.index_ref( ref, self.bwa, False )
+        assert '-a is' in self._indexlog()[1]
+
+    def test_bwa_version( self ):
+        eq_( '0.7.15-r1140', bwa.bwa_version( self.bwa ) )
+
+    def test_index_ref_reused( self ):
+        ''' Same reference in another place is not indexed again '''
+        ref1 = util.create_fakefasta( 'ref.fa', 3 )
+        eq_( True, bwa.index_ref( ref1, self.bwa, self.store ) )
+        assert bwa.is_indexed( ref1 )
+        os.mkdir( 'other' )
+        try:
+            ref2 = util.create_fakefasta( os.path.join( 'other', 'ref.fa' ), 3 )
+            eq_( True, bwa.index_ref( ref2, self.bwa, self.store ) )
+            assert bwa.is_indexed( ref2 )
+        finally:
+            shutil.rmtree( 'other' )
+        eq_( 1, self._indexruns() )
+        eq_( 1, len( self.store.entries() ) )
+
+    def test_index_ref_nostore( self ):
+        ''' Indexed in place without a store '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        eq_( True, bwa.index_ref( ref, self.bwa, False ) )
+        eq_( [], self.store.entries() )
+        eq_( 1, self._indexruns() )
+
+    def test_index_ref_stale( self ):
+        ''' Editing the reference after indexing it forces a new index '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        eq_( True, bwa.index_ref( ref, self.bwa, False ) )
+        assert bwa.is_indexed( ref )
+        util.create_fakefasta( ref, 4 )
+        assert not bwa.is_indexed( ref )
+        eq_( True, bwa.index_ref( ref, self.bwa, False ) )
+        assert bwa.is_indexed( ref )
+        eq_( 2, self._indexruns() )
+
+    def test_index_ref_stale_store( self ):
+        ''' Stale links are replaced by the index of the new content '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        bwa.index_ref( ref, self.bwa, self.store )
+        util.create_fakefasta( ref, 4 )
+        eq_( True, bwa.index_ref( ref, self.bwa, self.store ) )
+        assert bwa.is_indexed( ref, verify=True )
+        eq_( 2, len( self.store.entries() ) )
+
+    def test_compile_refs_stored( self ):
+        ''' Directory of refs links the stored index without concatting and
+            the links outlive the entry '''
+        ref = bwa.compile_refs( 'refs', self.bwa, self.store )
+        eq_( 'reference.fa', ref )
+        bwa.index_ref( ref, self.bwa, self.store )
+        for f in glob.glob( 'reference.fa*' ):
+            os.unlink( f )
+        with mock.patch.object( bwa.seqio, 'concat_files' ) as concat:
+            eq_( 'reference.fa', bwa.compile_refs( 'refs', self.bwa, self.store ) )
+            eq_( 0, concat.call_count )
+        key = self.store.entries()[0][0]
+        eq_( os.stat( self.store.ref_path( key ) ).st_ino, os.stat( 'reference.fa' ).st_ino )
+        self.store.remove( key )
+        assert bwa.is_indexed( 'reference.fa', verify=True )
+        # Still up to date with the refs
+        eq_( False, bwa.concat_refs( sorted( glob.glob( 'refs/*' ) ), 'reference.fa' ) )
+
+    def test_compile_refs_unchanged_store( self ):
+        ''' Refs that did not change are not read to look in the store '''
+        eq_( 'reference.fa', bwa.compile_refs( 'refs', self.bwa, self.store ) )
+        with mock.patch.object( cache, 'content_digest' ) as digest:
+            with mock.patch.object( bwa.seqio, 'concat_files' ) as concat:
+                eq_( 'reference.fa', bwa.compile_refs( 'refs', self.bwa, self.store ) )
+                eq_( 0, concat.call_count )
+            eq_( 0, digest.call_count )
+
+    def test_compile_refs_stored_changed( self ):
+        ''' Recompiling after the refs change leaves the checked out entry alone '''
+        ref = bwa.compile_refs( 'refs', self.bwa, self.store )
+        bwa.index_ref( ref, self.bwa, self.store )
+        for f in glob.glob( 'reference.fa*' ):
+            os.unlink( f )
+        bwa.compile_refs( 'refs', self.bwa, self.store )
+        key = self.store.entries()[0][0]
+        with open( self.store.ref_path( key ) ) as fh:
+            stored = fh.read()
+        util.create_fakefasta( os.path.join( 'refs', 'ref2.fa' ), 3 )
+        eq_( 'reference.fa', bwa.compile_refs( 'refs', self.bwa, self.store ) )
+        with open( self.store.ref_path( key ) ) as fh:
+            eq_( stored, fh.read() )
+        eq_( True, indexstore.check_manifest( self.store.ref_path( key ), verify=True ) )
+        with open( 'reference.fa' ) as fh:
+            assert len( fh.read() ) > len( stored )
+
+    def test_index_ref_tempfiles( self ):
+        ''' Index is built under a temporary prefix and renamed into place '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        eq_( True, bwa.index_ref( ref, self.bwa, False ) )
+        args = self._indexlog()[0].split()
+        prefix = args[args.index( '-p' ) + 1]
+        assert os.path.dirname( prefix ) != '', prefix
+        assert not os.path.exists( os.path.dirname( prefix ) )
+        assert bwa.is_indexed( ref )
+        eq_( [], glob.glob( '.pybwa*' ) )
+
+    def test_index_ref_failed_tempfiles( self ):
+        ''' Nothing is left behind when bwa index does not write the index '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        bwa_path = os.path.join( self.tempdir, 'nowritebwa' )
+        with open( bwa_path, 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\necho "Version: 0.7.15-r1140" 1>&2\n' )
+        os.chmod( bwa_path, 0755 )
+        eq_( False, bwa.index_ref( ref, bwa_path, False ) )
+        assert not bwa.is_indexed( ref )
+        eq_( [], glob.glob( '.pybwa*' ) )
+
+    def test_index_ref_waits_for_lock( self ):
+        ''' Index built while waiting for the lock is reused '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        with open( ref + indexstore.LOCK_EXT, 'a' ) as lock:
+            fcntl.flock( lock, fcntl.LOCK_EX )
+            child = os.fork()
+            if child == 0:
+                try:
+                    os._exit( 0 if bwa.index_ref( ref, self.bwa, False ) else 1 )
+                except:
+                    os._exit( 2 )
+            # Another process finishes the index while the child waits
+            time.sleep( 0.5 )
+            for ext in indexstore.INDEX_EXTENSIONS:
+                create( ref + ext )
+            fcntl.flock( lock, fcntl.LOCK_UN )
+            pid, status = os.waitpid( child, 0 )
+        eq_( 0, status )
+        eq_( 0, self._indexruns() )
+
+    def test_index_ref_concurrent( self ):
+        ''' Processes indexing the same reference at once only index it once '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        children = []
+        for i in range( 4 ):
+            child = os.fork()
+            if child == 0:
+                try:
+                    os._exit( 0 if bwa.index_ref( ref, self.bwa, self.store ) else 1 )
+                except:
+                    os._exit( 2 )
+            children.append( child )
+        statuses = [os.waitpid( child, 0 )[1] for child in children]
+        eq_( [0, 0, 0, 0], statuses )
+        eq_( 1, self._indexruns() )
+        eq_( 1, len( self.store.entries() ) )
+        assert bwa.is_indexed( ref )
+
+    def test_compile_refs_nostore( self ):
+        eq_( 'reference.fa', bwa.compile_refs( 'refs', self.bwa, False ) )
+
+    def test_compile_refs_unchanged( self ):
+        ''' reference.fa is only rewritten when the refs change '''
+        def written( ):
+            st = os.stat( 'reference.fa' )
+            return (st.st_ino, st.st_mtime, st.st_size)
+        bwa.compile_refs( 'refs', self.bwa, False )
+        first = written()
+        with mock.patch.object( seqio, 'concat_files' ) as concat:
+            bwa.compile_refs( 'refs', self.bwa, False )
+            eq_( 0, concat.call_count )
+        eq_( first, written() )
+        # Changed ref
+        st = os.stat( 'refs/ref0.fa' )
+        os.utime( 'refs/ref0.fa', (st.st_atime, st.st_mtime + 10) )
+        eq_( True, bwa.concat_refs( sorted( glob.glob( 'refs/*.fa' ) ), 'reference.fa' ) )
+        # New ref
+        util.create_fakefasta( 'refs/ref2.fa', 1 )
+        eq_( True, bwa.concat_refs( sorted( glob.glob( 'refs/*.fa' ) ), 'reference.fa' ) )
+        eq_( False, bwa.concat_refs( sorted( glob.glob( 'refs/*.fa' ) ), 'reference.fa' ) )
+        # reference.fa changed behind its back
+        with open( 'reference.fa', 'a' ) as fh:
+            fh.write( '>extra\nATGC\n' )
+        eq_( True, bwa.concat_refs( sorted( glob.glob( 'refs/*.fa' ) ), 'reference.fa' ) )
+        eq_( 4, seqio.reads_in_file( 'reference.fa' ) )
+
+    def test_index_refs( self ):
+        ''' Indexes each reference once in parallel and skips indexed ones '''
+        refs = [os.path.join( 'refs', 'ref{0}.fa'.format(i) ) for i in range( 2 )]
+        refs.append( util.create_fakefasta( 'ref.fa', 3 ) )
+        bwa.index_ref( refs[2], self.bwa, False )
+        results = bwa.index_refs( refs, self.bwa, workers=2, store=False )
+        eq_( refs, [r.ref for r in results] )
+        eq_( [True, True, True], [r.indexed for r in results] )
+        eq_( [False, False, True], [r.skipped for r in results] )
+        eq_( [None, None, None], [r.error for r in results] )
+        assert all( [r.seconds >= 0 for r in results] )
+        eq_( 3, self._indexruns() )
+        for ref in refs:
+            assert bwa.is_indexed( ref )
+
+    def test_index_refs_failure( self ):
+        ''' Failures are reported without stopping the other references '''
+        ref = util.create_fakefasta( 'ref.fa', 3 )
+        results = bwa.index_refs( ['missing.fa', ref], self.bwa, workers=1, store=False )
+        eq_( [False, True], [r.indexed for r in results] )
+        eq_( 'reference does not exist', results[0].error )
+        eq_( None, results[1].error )
+
+    def test_index_workers( self ):
+        ''' Bounded by cpus, references and how many fit in memory '''
+        refs = [os.path.join( 'refs', 'ref{0}.fa'.format(i) ) for i in range( 2 )]
+        largest = bwa.index_memory_estimate( refs[1] )
+        eq_( 2, bwa.index_workers( refs, 8 ) )
+        eq_( 1, bwa.index_workers( refs, 1 ) )
+        eq_( 1, bwa.index_workers( refs, 8, largest * 2 - 1 ) )
+        eq_( 2, bwa.index_workers( refs, 8, largest * 2 ) )
+        # Always at least one even if nothing fits
+        eq_( 1, bwa.index_workers( refs, 8, 1 ) )
+        with mock.patch( 'multiprocessing.cpu_count', return_value=1 ):
+            eq_( 1, bwa.index_workers( refs ) )
+
+class TestSharedIndex( BaseBWA ):
+    def setUp( self ):
+        # Fake bwa that keeps the names of loaded indexes in shm.state
+        self.bwa = self.mkbwa( '> /dev/null; if [ "$1" == "shm" ]; then echo "$@" >> shm.log; ' \
+            'if [ "$2" == "-l" ]; then cat shm.state 2>/dev/null; ' \
+            'elif [ "$2" == "-d" ]; then rm -f shm.state; ' \
+            'else printf "%s\\t100\\n" "$(basename "${@: -1}")" >> shm.state; fi; fi' )
+        self.ref = util.create_fakefasta( 'ref.fa', 3 )
+        createrefindexes( self.ref )
+
+    def tearDown( self ):
+        for f in glob.glob( 'shm.*' ) + glob.glob( 'ref.fa*' ):
+            os.unlink( f )
+
+    def _shmlog( self ):
+        if not os.path.exists( 'shm.log' ):
+            return []
+        with open( 'shm.log' ) as fh:
+            return fh.read().splitlines()
+
+    def _run_python( self, code ):
+        ''' Run code in a new python that has loaded ref as shm '''
+        pkgdir = os.path.dirname( os.path.dirname( os.path.abspath( bwa.__file__ ) ) )
+        script = 'import os, sys, signal, time\n' \
+            'sys.path.insert( 0, {0!r} )\n' \
+            'from bwa import bwa\n' \
+            'bwa.SharedIndex( {1!r}, {2!r} ).load()\n'.format(pkgdir, self.ref, self.bwa) + code
+        p = subprocess.Popen( [sys.executable, '-c', script], stderr=subprocess.PIPE )
+        p.communicate()
+        return p.returncode
+
+    def test_shm_indexes( self ):
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+        with open( 'shm.state', 'w' ) as fh:
+            fh.write( 'ref.fa\t1345\nother.fa\t20\n' )
+        eq_( {'ref.fa': 1345, 'other.fa': 20}, bwa.shm_indexes( self.bwa ) )
+
+    def test_loads_and_drops( self ):
+        with bwa.SharedIndex( self.ref, self.bwa ) as shm:
+            assert shm.loaded
+            eq_( bwa.cache.DIGESTS.digest( self.ref ) + '.fa', shm.name )
+            eq_( [shm.name], bwa.shm_indexes( self.bwa ).keys() )
+            assert bwa.is_indexed( shm.path )
+        assert not shm.loaded
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+        eq_( ['shm ' + shm.path, 'shm -d'], [l for l in self._shmlog() if '-l' not in l] )
+
+    def test_drops_on_error( self ):
+        try:
+            with bwa.SharedIndex( self.ref, self.bwa ):
+                raise RuntimeError( 'mapping failed' )
+        except RuntimeError:
+            pass
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+
+    def test_already_loaded( self ):
+        ''' Index of the same content someone else loaded is used and left alone '''
+        name = bwa.cache.DIGESTS.digest( self.ref ) + '.fa'
+        with open( 'shm.state', 'w' ) as fh:
+            fh.write( name + '\t100\n' )
+        with bwa.SharedIndex( self.ref, self.bwa ) as shm:
+            assert not shm.loaded
+        eq_( [name], bwa.shm_indexes( self.bwa ).keys() )
+        eq_( [], [l for l in self._shmlog() if '-l' not in l] )
+
+    def test_same_name_not_reused( self ):
+        ''' A different reference loaded under the same file name is not used
+            and is not dropped with ours '''
+        with open( 'shm.state', 'w' ) as fh:
+            fh.write( 'ref.fa\t100\n' )
+        with bwa.SharedIndex( self.ref, self.bwa ) as shm:
+            assert shm.loaded
+        eq_( sorted( ['ref.fa', shm.name] ), sorted( bwa.shm_indexes( self.bwa ).keys() ) )
+        eq_( ['shm ' + shm.path], [l for l in self._shmlog() if '-l' not in l] )
+        shm.load()
+        shm.drop( force=True )
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+
+    def test_last_user_drops( self ):
+        ''' Index is only dropped once nothing uses it '''
+        first = bwa.SharedIndex( self.ref, self.bwa )
+        second = bwa.SharedIndex( self.ref, self.bwa )
+        assert first.load()
+        assert not second.load()
+        first.drop()
+        eq_( [first.name], bwa.shm_indexes( self.bwa ).keys() )
+        second.drop()
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+
+    def test_restores_sigterm( self ):
+        prev = signal.getsignal( signal.SIGTERM )
+        with bwa.SharedIndex( self.ref, self.bwa ) as shm:
+            eq_( shm._sigterm, signal.getsignal( signal.SIGTERM ) )
+        eq_( prev, signal.getsignal( signal.SIGTERM ) )
+
+    @raises( ValueError )
+    def test_notindexed( self ):
+        bwa.clear_index( self.ref )
+        bwa.SharedIndex( self.ref, self.bwa ).load()
+
+    def test_loadfails( self ):
+        ''' A failed load is still dropped '''
+        bwa_path = os.path.join( self.tempdir, 'failshm' )
+        with open( bwa_path, 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\necho "$@" >> shm.log\n[ "$2" == "-l" ] || exit 1\n' )
+        os.chmod( bwa_path, 0755 )
+        try:
+            bwa.SharedIndex( self.ref, bwa_path ).load()
+            assert False, 'load did not raise'
+        except ValueError:
+            pass
+        eq_( 'shm -d', self._shmlog()[-1] )
+
+    def test_drops_on_sigterm( self ):
+        eq_( -signal.SIGTERM, self._run_python(
+            'os.kill( os.getpid(), signal.SIGTERM )\ntime.sleep( 10 )\n' ) )
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+
+    def test_drops_on_exit( self ):
+        eq_( 1, self._run_python( 'raise RuntimeError( "crash" )\n' ) )
+        eq_( {}, bwa.shm_indexes( self.bwa ) )
+
 class TestISIndexed(BaseBWA):
     def setUp(self):
         self.t = tempfile.mkdtemp(prefix='isindex')
@@ -471,3 +1379,65 @@ class TestISIndexed(BaseBWA):
 
     def test_missing_all_indexes( self ):
         eq_( False, self._CII( self.fake_ref ) )
+
+class TestProbe( BaseBWA ):
+    def setUp( self ):
+        self.cwd = tempfile.mkdtemp( prefix='probe', dir=self.tempdir )
+        os.chdir( self.cwd )
+        # Fake bwa that counts how many times it is run
+        self.bwa = os.path.abspath( 'bwa' )
+        with open( self.bwa, 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\necho run >> probe.log\n' \
+                'echo "Version: 0.7.15-r1140" 1>&2\n' \
+                'echo "Command: index         index sequences" 1>&2\n' \
+                'echo "         mem           BWA-MEM algorithm" 1>&2\n' \
+                'echo "Note: To use BWA, you need to first index the genome" 1>&2\n' )
+        os.chmod( self.bwa, 0755 )
+
+    def tearDown( self ):
+        os.chdir( self.tempdir )
+        shutil.rmtree( self.cwd )
+
+    def _runs( self ):
+        with open( 'probe.log' ) as fh:
+            return len( fh.read().splitlines() )
+
+    def test_probe( self ):
+        eq_( {'version': '0.7.15-r1140', 'commands': ['index', 'mem']},
+            bwa.probe_bwa( self.bwa ) )
+        eq_( True, bwa.bwa_supports( 'mem', self.bwa ) )
+        eq_( False, bwa.bwa_supports( 'shm', self.bwa ) )
+
+    def test_probe_cached_on_disk( self ):
+        ''' Another process reuses the probe until bwa changes '''
+        probes = bwa.BWAProbe( os.path.abspath( 'bwa.json' ) )
+        eq_( '0.7.15-r1140', probes.value( self.bwa )['version'] )
+        probes.value( self.bwa )
+        eq_( '0.7.15-r1140', bwa.BWAProbe( probes.path ).value( self.bwa )['version'] )
+        eq_( 1, self._runs() )
+        with open( self.bwa, 'a' ) as fh:
+            fh.write( 'echo rebuilt\n' )
+        bwa.BWAProbe( probes.path ).value( self.bwa )
+        eq_( 2, self._runs() )
+
+    def test_which( self ):
+        os.mkdir( 'bin' )
+        shutil.move( self.bwa, os.path.join( 'bin', 'bwa' ) )
+        path = os.pathsep.join( ['/nonexistant', os.path.abspath( 'bin' )] )
+        with mock.patch.dict( 'os.environ', {'PATH': path} ):
+            eq_( os.path.abspath( 'bin/bwa' ), bwa.which_bwa() )
+            eq_( '', bwa.which( 'notaprogram' ) )
+
+    def test_startup( self ):
+        ''' Importing the package for map_bwa.py takes under half a second '''
+        pkgdir = os.path.dirname( os.path.dirname( os.path.abspath( bwa.__file__ ) ) )
+        script = 'import sys, time\n' \
+            'sys.path.insert( 0, {0!r} )\n' \
+            'start = time.time()\n' \
+            'from bwa import bwa_mem\n' \
+            'print time.time() - start\n' \
+            'print " ".join( [m for m in sys.modules if m.split( "." )[0] in ("Bio", "sh")] )\n'.format(pkgdir)
+        p = subprocess.Popen( [sys.executable, '-c', script], stdout=subprocess.PIPE )
+        seconds, modules = p.communicate()[0].split( '\n' )[:2]
+        eq_( '', modules )
+        assert float( seconds ) < 0.5, seconds
@@ -0,0 +1,205 @@
+from nose.tools import eq_, raises
+
+import json
+import os
+import os.path
+import shutil
+
+import mock
+
+import util
+from bwa import bwa, bwa_batch
+
+FASTQ = '@read{0}\nATGC\n+\nIIII\n'
+
+def write_fastq( path, n ):
+    with open( path, 'w' ) as fh:
+        for i in range( n ):
+            fh.write( FASTQ.format(i) )
+    return path
+
+class TestBatch( util.Base ):
+    def setUp( self ):
+        self.cwd = os.path.join( self.tempdir, 'batch' )
+        os.mkdir( self.cwd )
+        os.chdir( self.cwd )
+        os.environ['PYBWA_INDEX_STORE'] = os.path.join( self.cwd, 'store' )
+        # Fake bwa that logs every call, writes index files to the -p prefix
+        # and reports reading every read of the .fastq files it is given
+        self.bwa = os.path.abspath( 'bwa' )
+        with open( self.bwa, 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\n'
+                'echo "Version: 0.7.15-r1140" 1>&2\n'
+                'echo "$*" >> bwa.log\n'
+                'if [ "$1" == "index" ]; then\n'
+                '  while [ $# -gt 1 ]; do [ "$1" == "-p" ] && prefix=$2; shift; done\n'
+                '  for e in amb ann bwt pac sa; do touch $prefix.$e; done\n'
+                'elif [ "$1" == "mem" ]; then\n'
+                '  n=0\n'
+                '  for f in "$@"; do case $f in *.fastq) n=$((n+$(wc -l < $f)/4));; esac; done\n'
+                '  printf "@SQ\\tSN:seq0\\tLN:4\\n"\n'
+                '  echo "[M::main_mem] read $n sequences (4 bp)..." 1>&2\n'
+                'fi\n'
+            )
+        os.chmod( self.bwa, 0755 )
+        os.mkdir( 'refs' )
+        util.create_fakefasta( 'refs/a.fa', 2 )
+        util.create_fakefasta( 'refs/b.fa', 1 )
+        util.create_fakefasta( 'single.fa', 1 )
+        write_fastq( 's1.fastq', 4 )
+        write_fastq( 's2.fastq', 2 )
+        write_fastq( 's2.mates.fastq', 2 )
+
+    def tearDown( self ):
+        del os.environ['PYBWA_INDEX_STORE']
+        os.chdir( self.tempdir )
+        shutil.rmtree( self.cwd )
+
+    def _manifest( self, samples ):
+        with open( 'samples.json', 'w' ) as fh:
+            json.dump( samples, fh )
+        return 'samples.json'
+
+    def _log( self, command ):
+        with open( 'bwa.log' ) as fh:
+            return [l for l in fh.read().splitlines() if l.startswith( command )]
+
+    def test_load_manifest( self ):
+        ''' Defaults are filled in and paths are relative to the manifest '''
+        os.mkdir( 'sub' )
+        with open( 'sub/samples.json', 'w' ) as fh:
+            json.dump( [
+                {'reads': 's1.fastq', 'reference': 'refs'},
+                {'name': 'two', 'reads': 's2.fastq', 'mates': 's2.mates.fastq',
+                    'reference': '/abs/ref.fa', 'options': {'k': 19}, 'bam': True}
+            ], fh )
+        s1, s2 = bwa_batch.load_manifest( 'sub/samples.json' )
+        sub = os.path.join( self.cwd, 'sub' )
+        eq_( 's1', s1.name )
+        eq_( os.path.join( sub, 's1.fastq' ), s1.reads )
+        eq_( os.path.join( sub, 'refs' ), s1.reference )
+        eq_( (None, {}, None, False), (s1.mates, s1.options, s1.output, s1.bam) )
+        eq_( 'two', s2.name )
+        eq_( os.path.join( sub, 's2.mates.fastq' ), s2.mates )
+        eq_( '/abs/ref.fa', s2.reference )
+        eq_( ({'k': 19}, True), (s2.options, s2.bam) )
+
+    @raises( ValueError )
+    def test_load_manifest_missingkey( self ):
+        bwa_batch.load_manifest( self._manifest( [{'reads': 's1.fastq'}] ) )
+
+    @raises( ValueError )
+    def test_load_manifest_unknownkey( self ):
+        bwa_batch.load_manifest( self._manifest(
+            [{'reads': 's1.fastq', 'reference': 'refs', 'mate': 'x'}] ) )
+
+    @raises( ValueError )
+    def test_load_manifest_duplicatenames( self ):
+        bwa_batch.load_manifest( self._manifest( [
+            {'reads': 's1.fastq', 'reference': 'refs'},
+            {'reads': 'other/s1.fastq', 'reference': 'refs'}
+        ] ) )
+
+    @raises( ValueError )
+    def test_load_manifest_notlist( self ):
+        bwa_batch.load_manifest( self._manifest( {'reads': 's1.fastq'} ) )
+
+    def test_job_threads( self ):
+        eq_( 4, bwa_batch.job_threads( 16, 4 ) )
+        eq_( 2, bwa_batch.job_threads( 7, 3 ) )
+        eq_( 1, bwa_batch.job_threads( 2, 4 ) )
+        eq_( 8, bwa_batch.job_threads( 8, 0 ) )
+
+    def test_run_batch( self ):
+        ''' References are indexed once and the budget is split between jobs '''
+        samples = bwa_batch.load_manifest( self._manifest( [
+            {'reads': 's1.fastq', 'reference': 'refs'},
+            {'reads': 's2.fastq', 'mates': 's2.mates.fastq', 'reference': 'refs',
+                'options': {'t': 16, 'k': 19}},
+            {'name': 's3', 'reads': 's1.fastq', 'reference': 'single.fa'}
+        ] ) )
+        results = bwa_batch.run_batch( samples, threads=8, jobs=2, outdir='out',
+            bwa_path=self.bwa )
+        eq_( ['s1', 's2', 's3'], [r.name for r in results] )
+        eq_( ['mapped'] * 3, [r.status for r in results] )
+        eq_( [4, 4, 4], [r.reads for r in results] )
+        eq_( [4, 4, 4], [r.threads for r in results] )
+        eq_( os.path.join( 'out', 's1.sam' ), results[0].output )
+        assert os.path.exists( os.path.join( 'out', 's3.sam' ) )
+        eq_( 2, len( self._log( 'index' ) ) )
+        mem = self._log( 'mem' )
+        eq_( 3, len( mem ) )
+        for line in mem:
+            assert '-t 4' in line, line
+        assert [l for l in mem if '-k 19' in l]
+
+    def test_run_batch_readdir( self ):
+        ''' Reads compiled from a directory are removed once mapped '''
+        os.mkdir( 'dir1' )
+        write_fastq( 'dir1/a.fastq', 3 )
+        write_fastq( 'dir1/b.fastq', 2 )
+        samples = bwa_batch.load_manifest( self._manifest( [
+            {'reads': 'dir1', 'reference': 'single.fa'}
+        ] ) )
+        results = bwa_batch.run_batch( samples, threads=1, outdir='out', bwa_path=self.bwa )
+        eq_( [('mapped', 5)], [(r.status, r.reads) for r in results] )
+        left = [f for f in os.listdir( 'out' ) if 'dir1' in f]
+        eq_( ['dir1.sam'], left )
+
+    def test_run_batch_failures( self ):
+        ''' A reference that cannot be indexed skips its samples only '''
+        samples = bwa_batch.load_manifest( self._manifest( [
+            {'reads': 's1.fastq', 'reference': 'missing.fa'},
+            {'reads': 's2.fastq', 'reference': 'single.fa'},
+            {'name': 'noreads', 'reads': 'missing.fastq', 'reference': 'single.fa'}
+        ] ) )
+        results = bwa_batch.run_batch( samples, threads=2, outdir='out',
+            bwa_path=self.bwa )
+        eq_( ['skipped', 'mapped', 'failed'], [r.status for r in results] )
+        assert 'missing.fa' in results[0].error
+        assert results[2].error
+
+    def test_run_batch_shm( self ):
+        ''' References are shared for the whole batch and mapped through
+            their shared link '''
+        samples = bwa_batch.load_manifest( self._manifest( [
+            {'reads': 's1.fastq', 'reference': 'single.fa'}
+        ] ) )
+        shared = []
+        def share( refs, bwa_path ):
+            for ref in refs:
+                shared.append( mock.Mock( ref=ref, path=bwa.SharedIndex( ref, bwa_path ).link() ) )
+            return shared
+        with mock.patch.object( bwa_batch, 'share_references', side_effect=share ) as share_refs:
+            results = bwa_batch.run_batch( samples, threads=1, shm=True, outdir='out', bwa_path=self.bwa )
+        eq_( [os.path.join( self.cwd, 'single.fa' )], share_refs.call_args[0][0] )
+        eq_( ['mapped'], [r.status for r in results] )
+        assert shared[0].path in self._log( 'mem' )[0]
+        eq_( 1, shared[0].drop.call_count )
+
+    def test_report( self ):
+        results = [
+            bwa_batch.SampleResult( 's1', 'mapped', 0, 's1.sam', 100, 2.0, 4, None ),
+            bwa_batch.SampleResult( 's2', 'failed', 1, 's2.sam', None, 1.0, 4, 'bwa mem returned 1' )
+        ]
+        lines = bwa_batch.report( results ).splitlines()
+        eq_( 'name\tstatus\treads\tseconds\treads_per_sec\tthreads\terror', lines[0] )
+        eq_( 's1\tmapped\t100\t2.00\t50.0\t4\t', lines[1] )
+        eq_( 's2\tfailed\t\t1.00\t\t4\tbwa mem returned 1', lines[2] )
+
+    def test_main( self ):
+        ''' Exits non zero when any sample did not map and writes a json report '''
+        self._manifest( [
+            {'reads': 's1.fastq', 'reference': 'single.fa'},
+            {'reads': 's2.fastq', 'reference': 'missing.fa'}
+        ] )
+        with mock.patch.object( bwa, 'which_bwa', return_value=self.bwa ):
+            try:
+                bwa_batch.main( ['--threads', '2', '--outdir', 'out',
+                    '--report', 'report.json', 'samples.json'] )
+                assert False, 'did not exit'
+            except SystemExit as e:
+                eq_( 1, e.code )
+        with open( 'report.json' ) as fh:
+            report = json.load( fh )
+        eq_( ['mapped', 'skipped'], [r['status'] for r in report] )
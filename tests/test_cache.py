@@ -0,0 +1,76 @@
+from nose.tools import eq_, raises
+
+import os
+import os.path
+import time
+
+import mock
+
+import util
+from bwa import cache, seqio
+
+class TestCacheDir( util.Base ):
+    def test_env_override( self ):
+        eq_( os.path.join( self.tempdir, '.cache' ), cache.cache_dir() )
+
+    def test_default_home( self ):
+        with mock.patch.dict( 'os.environ', {'PYBWA_CACHE_DIR': ''} ):
+            eq_( os.path.expanduser( '~/.cache/pybwa' ), cache.cache_dir() )
+
+class TestReadCountCache( util.Base ):
+    def setUp( self ):
+        self.cachefile = os.path.join( self.tempdir, 'counts.json' )
+        self.rcc = cache.ReadCountCache( self.cachefile )
+        self.fasta = util.create_fakefasta( 'reads.fa', 5 )
+
+    def tearDown( self ):
+        self.rcc.clear()
+
+    def test_counts_and_caches( self ):
+        ''' Second lookup does not reparse file '''
+        eq_( 5, self.rcc.reads_in_file( self.fasta ) )
+        with mock.patch.object( seqio, 'reads_in_file' ) as rif:
+            eq_( 5, self.rcc.reads_in_file( self.fasta ) )
+            eq_( 0, rif.call_count )
+
+    def test_persists_between_instances( self ):
+        ''' New cache instance reads counts from disk '''
+        self.rcc.reads_in_file( self.fasta )
+        other = cache.ReadCountCache( self.cachefile )
+        with mock.patch.object( seqio, 'reads_in_file' ) as rif:
+            eq_( 5, other.reads_in_file( self.fasta ) )
+            eq_( 0, rif.call_count )
+
+    def test_changed_file_recounted( self ):
+        ''' Modifying the file invalidates its entry '''
+        eq_( 5, self.rcc.reads_in_file( self.fasta ) )
+        util.create_fakefasta( self.fasta, 7 )
+        eq_( None, self.rcc.get( self.fasta ) )
+        eq_( 7, self.rcc.reads_in_file( self.fasta ) )
+
+    def test_memory_only( self ):
+        ''' False path never touches disk '''
+        rcc = cache.ReadCountCache( False )
+        eq_( 5, rcc.reads_in_file( self.fasta ) )
+        assert not os.path.exists( os.path.join( self.tempdir, '.cache' ) )
+
+    def test_eviction( self ):
+        ''' Least recently used entries are dropped '''
+        rcc = cache.ReadCountCache( self.cachefile, max_entries=2 )
+        files = [util.create_fakefasta( 'f{0}.fa'.format(i), i+1 ) for i in range( 3 )]
+        for f in files:
+            rcc.reads_in_file( f )
+            time.sleep( 0.01 )
+        eq_( None, rcc.get( files[0] ) )
+        eq_( 3, rcc.get( files[2] ) )
+        eq_( 2, len( cache.read_json( self.cachefile ) ) )
+
+    def test_unwritable_cache( self ):
+        ''' Cache files that cannot be written are ignored '''
+        rcc = cache.ReadCountCache( '/proc/not/writable.json' )
+        eq_( 5, rcc.reads_in_file( self.fasta ) )
+        eq_( 5, rcc.get( self.fasta ) )
+
+    @raises( OSError )
+    def test_missing_file( self ):
+        self.rcc.get( 'missing.fa' )
@@ -0,0 +1,235 @@
+from nose.tools import eq_, raises
+
+import errno
+import glob
+import os
+import os.path
+import time
+
+import mock
+
+import util
+from bwa import indexstore, cache
+
+class TestParseSize( object ):
+    def test_sizes( self ):
+        eq_( None, indexstore.parse_size( None ) )
+        eq_( None, indexstore.parse_size( '' ) )
+        eq_( 100, indexstore.parse_size( 100 ) )
+        eq_( 100, indexstore.parse_size( '100' ) )
+        eq_( 512 * 1024**2, indexstore.parse_size( '512M' ) )
+        eq_( int( 1.5 * 1024**3 ), indexstore.parse_size( '1.5g' ) )
+        eq_( 2 * 1024**4, indexstore.parse_size( '2TB' ) )
+
+    @raises( ValueError )
+    def test_invalid( self ):
+        indexstore.parse_size( 'lots' )
+
+class TestIndexStore( util.Base ):
+    def setUp( self ):
+        self.root = os.path.join( self.tempdir, 'store' )
+        self.store = indexstore.IndexStore( self.root )
+        self.ref = util.create_fakefasta( 'ref.fa', 2 )
+        self.builds = []
+
+    def tearDown( self ):
+        for key, meta in self.store.entries():
+            self.store.remove( key )
+        # Entry locks are left behind on purpose
+        for lock in glob.glob( os.path.join( self.root, '.*' + indexstore.LOCK_EXT ) ):
+            os.unlink( lock )
+
+    def build( self, ref, size=10 ):
+        ''' Fake bwa index that writes size bytes into each index file '''
+        self.builds.append( ref )
+        for ext in indexstore.INDEX_EXTENSIONS:
+            with open( ref + ext, 'w' ) as fh:
+                fh.write( 'x' * size )
+        return True
+
+    def test_default_root( self ):
+        eq_( os.path.join( self.tempdir, '.cache', 'indexes' ), indexstore.IndexStore().root )
+
+    def test_key( self ):
+        ''' Same content built by another bwa version is a different entry '''
+        eq_( self.store.key( 'abc', '0.7.15' ), self.store.key( 'abc', '0.7.15' ) )
+        assert self.store.key( 'abc', '0.7.15' ) != self.store.key( 'abc', '0.7.17' )
+        assert self.store.key( 'abc', '0.7.15' ) != self.store.key( 'abd', '0.7.15' )
+
+    def test_add_lookup( self ):
+        eq_( None, self.store.lookup( 'k1' ) )
+        path = self.store.add( 'k1', self.ref, self.build, {'bwa_version': 'v'} )
+        eq_( os.path.join( self.root, 'k1', 'ref.fa' ), path )
+        eq_( path, self.store.lookup( 'k1' ) )
+        for ext in indexstore.INDEX_EXTENSIONS:
+            assert os.path.exists( path + ext )
+        meta = dict( self.store.entries() )['k1']
+        eq_( 'v', meta['bwa_version'] )
+        eq_( os.path.abspath( self.ref ), meta['source'] )
+        # Nothing left over from building
+        eq_( ['k1'], os.listdir( self.root ) )
+
+    def test_resolve_builds_once( self ):
+        first = self.store.resolve( 'k1', self.ref, self.build )
+        second = self.store.resolve( 'k1', self.ref, self.build )
+        eq_( first, second )
+        eq_( 1, len( self.builds ) )
+
+    def test_failed_build( self ):
+        ''' Nothing is stored when the build fails '''
+        eq_( None, self.store.add( 'k1', self.ref, lambda path: False ) )
+        eq_( None, self.store.lookup( 'k1' ) )
+        eq_( [], os.listdir( self.root ) )
+
+    def test_incomplete_ignored( self ):
+        ''' Entries without meta.json are not used '''
+        os.makedirs( os.path.join( self.root, 'k1' ) )
+        eq_( None, self.store.lookup( 'k1' ) )
+        eq_( [], self.store.entries() )
+        os.rmdir( os.path.join( self.root, 'k1' ) )
+
+    def test_evicts_lru( self ):
+        ''' Least recently used entries go once the store is over its cap '''
+        build = lambda ref: self.build( ref, 1000 )
+        for key in ('k1', 'k2'):
+            self.store.add( key, self.ref, build )
+            time.sleep( 0.01 )
+        # k1 is now the most recently used
+        self.store.lookup( 'k1' )
+        # Room for 2 entries with some slack for meta.json
+        self.store._max_bytes = self.store.entry_size( 'k1' ) * 2 + 500
+        self.store.add( 'k3', self.ref, build )
+        eq_( ['k1', 'k3'], sorted( dict( self.store.entries() ) ) )
+
+    def test_evict_skips_locked( self ):
+        ''' An entry that is being checked out is not evicted '''
+        build = lambda ref: self.build( ref, 1000 )
+        self.store.add( 'k1', self.ref, build )
+        time.sleep( 0.01 )
+        self.store._max_bytes = self.store.entry_size( 'k1' ) + 500
+        with self.store.key_lock( 'k1' ):
+            pid = os.fork()
+            if pid == 0:
+                self.store.add( 'k2', self.ref, build )
+                os._exit( 0 )
+            os.waitpid( pid, 0 )
+        eq_( ['k1', 'k2'], sorted( dict( self.store.entries() ) ) )
+
+    def test_checkout( self ):
+        ''' Checked out links replace what is there and outlive the entry '''
+        self.store.add( 'k1', self.ref, self.build )
+        indexstore.write_manifest( self.store.ref_path( 'k1' ), 'v' )
+        util.create_fakefasta( 'out.fa', 1 )
+        eq_( 'out.fa', self.store.checkout( 'k1', 'out.fa' ) )
+        self.store.remove( 'k1' )
+        eq_( True, indexstore.check_manifest( 'out.fa', verify=True ) )
+        with open( self.ref ) as a, open( 'out.fa' ) as b:
+            eq_( a.read(), b.read() )
+        eq_( None, self.store.checkout( 'k1', 'other.fa' ) )
+        for f in glob.glob( 'out.fa*' ):
+            os.unlink( f )
+
+    def test_evict_keeps_new( self ):
+        ''' An entry bigger than the cap is still kept '''
+        self.store._max_bytes = 1
+        path = self.store.add( 'k1', self.ref, self.build )
+        eq_( path, self.store.lookup( 'k1' ) )
+
+    def test_size_env( self ):
+        os.environ[indexstore.STORE_SIZE_ENV] = '1K'
+        try:
+            eq_( 1024, indexstore.IndexStore( self.root ).max_bytes )
+        finally:
+            del os.environ[indexstore.STORE_SIZE_ENV]
+        eq_( None, indexstore.IndexStore( self.root ).max_bytes )
+
+    def test_link_index( self ):
+        ''' Links survive the entry being removed '''
+        path = self.store.add( 'k1', self.ref, self.build )
+        other = util.create_fakefasta( 'other.fa', 2 )
+        indexstore.link_index( path, other )
+        self.store.remove( 'k1' )
+        for ext in indexstore.INDEX_EXTENSIONS:
+            with open( other + ext ) as fh:
+                eq_( 'x' * 10, fh.read() )
+            os.unlink( other + ext )
+
+    def test_link_index_copies( self ):
+        ''' Files are copied instead of symlinked into the store when they
+            cannot be hard linked '''
+        path = self.store.add( 'k1', self.ref, self.build )
+        other = util.create_fakefasta( 'other.fa', 2 )
+        with mock.patch.object( os, 'link', side_effect=OSError( errno.EXDEV, 'cross device' ) ):
+            indexstore.link_index( path, other )
+        self.store.remove( 'k1' )
+        for ext in indexstore.INDEX_EXTENSIONS:
+            assert not os.path.islink( other + ext )
+            with open( other + ext ) as fh:
+                eq_( 'x' * 10, fh.read() )
+            os.unlink( other + ext )
+        eq_( [], glob.glob( '.pybwa*' ) )
+
+class TestManifest( util.Base ):
+    def setUp( self ):
+        self.ref = util.create_fakefasta( 'ref.fa', 2 )
+        for ext in indexstore.INDEX_EXTENSIONS:
+            with open( self.ref + ext, 'w' ) as fh:
+                fh.write( 'index' )
+        indexstore.write_manifest( self.ref, '0.7.15' )
+
+    def tearDown( self ):
+        for ext in indexstore.INDEX_EXTENSIONS + (indexstore.MANIFEST_EXT,):
+            if os.path.exists( self.ref + ext ):
+                os.unlink( self.ref + ext )
+
+    def _rewrite( self, content ):
+        with open( self.ref, 'w' ) as fh:
+            fh.write( content )
+
+    def test_current( self ):
+        eq_( True, indexstore.check_manifest( self.ref ) )
+        eq_( True, indexstore.check_manifest( self.ref, verify=True ) )
+        manifest = cache.read_json( indexstore.manifest_path( self.ref ) )
+        eq_( '0.7.15', manifest['bwa_version'] )
+
+    def test_nomanifest( self ):
+        os.unlink( indexstore.manifest_path( self.ref ) )
+        eq_( None, indexstore.check_manifest( self.ref ) )
+
+    def test_size_changed( self ):
+        with open( self.ref, 'a' ) as fh:
+            fh.write( '>seq3\nATGC\n' )
+        eq_( False, indexstore.check_manifest( self.ref ) )
+
+    def test_touched( self ):
+        ''' Same content with a new mtime is still current '''
+        st = os.stat( self.ref )
+        os.utime( self.ref, (st.st_atime, st.st_mtime + 10) )
+        eq_( True, indexstore.check_manifest( self.ref ) )
+
+    def test_same_size_edit( self ):
+        self._rewrite( '>seq0\nATGG\n>seq1\nATGC\n' )
+        os.utime( self.ref, (time.time(), time.time() + 10) )
+        eq_( False, indexstore.check_manifest( self.ref ) )
+
+    def test_verify( self ):
+        ''' Only the full checksum catches an edit that keeps size and mtime '''
+        # Big enough that the middle is not part of the quick digest
+        util.create_fakefasta( self.ref, 300000 )
+        indexstore.write_manifest( self.ref, '0.7.15' )
+        st = os.stat( self.ref )
+        with open( self.ref, 'r+b' ) as fh:
+            fh.seek( st.st_size // 2 )
+            fh.readline()
+            pos = fh.tell()
+            lines = fh.readline() + fh.readline()
+            fh.seek( pos )
+            fh.write( lines.replace( 'ATGC', 'ATGG' ) )
+        os.utime( self.ref, (st.st_atime, st.st_mtime) )
+        eq_( True, indexstore.check_manifest( self.ref ) )
+        eq_( False, indexstore.check_manifest( self.ref, verify=True ) )
+
+    def test_index_changed( self ):
+        with open( self.ref + '.bwt', 'w' ) as fh:
+            fh.write( 'truncated' )
+        eq_( False, indexstore.check_manifest( self.ref ) )
@@ -0,0 +1,139 @@
+from nose.tools import eq_
+
+import json
+import os
+import os.path
+import subprocess
+import threading
+
+import util
+from bwa import bwa, instrument
+
+class TestInstrument( util.Base ):
+    def setUp( self ):
+        self.stages = []
+        instrument.add_hook( self.stages.append )
+
+    def tearDown( self ):
+        instrument.remove_hook( self.stages.append )
+
+    def test_nested_stages( self ):
+        ''' Inner stages finish first and know their parent '''
+        with instrument.stage( 'outer', sample='s1' ):
+            with instrument.stage( 'inner' ):
+                instrument.annotate( reads=4 )
+        eq_( ['inner', 'outer'], [s.name for s in self.stages] )
+        inner, outer = [s.as_dict() for s in self.stages]
+        eq_( ('outer', 1), (inner['parent'], inner['depth']) )
+        eq_( (None, 0), (outer['parent'], outer['depth']) )
+        eq_( {'reads': 4}, inner['info'] )
+        eq_( {'sample': 's1'}, outer['info'] )
+        assert outer['seconds'] >= inner['seconds'] >= 0
+        eq_( None, instrument.current() )
+
+    def test_records_error( self ):
+        try:
+            with instrument.stage( 'failing' ):
+                raise ValueError( 'bad' )
+        except ValueError:
+            pass
+        eq_( 'ValueError: bad', self.stages[0].error )
+
+    def test_timed_same_name( self ):
+        ''' A timed function calling another of the same stage is one stage '''
+        @instrument.timed( 'work' )
+        def inner( ):
+            return 1
+        @instrument.timed( 'work' )
+        def outer( ):
+            return inner() + 1
+        eq_( 2, outer() )
+        eq_( ['work'], [s.name for s in self.stages] )
+
+    def test_wait_records_children( self ):
+        ''' Child rusage is added to every open stage '''
+        with instrument.stage( 'outer' ):
+            with instrument.stage( 'inner' ):
+                p = subprocess.Popen( ['sh', '-c', 'exit 3'] )
+                eq_( 3, instrument.wait( p ) )
+                eq_( 3, p.returncode )
+        for s in self.stages:
+            eq_( 1, s.children['count'] )
+            assert s.children['maxrss'] > 0
+
+    def test_wait_signalled( self ):
+        p = subprocess.Popen( ['sh', '-c', 'kill -9 $$'] )
+        eq_( -9, instrument.wait( p ) )
+        eq_( -9, p.returncode )
+
+    def test_threads_shared( self ):
+        ''' Process wide counters are left out of overlapping stages '''
+        started = threading.Event()
+        finish = threading.Event()
+        def other( ):
+            with instrument.stage( 'other' ):
+                started.set()
+                finish.wait( 5 )
+        with instrument.stage( 'alone' ):
+            pass
+        t = threading.Thread( target=other )
+        t.start()
+        started.wait( 5 )
+        with instrument.stage( 'overlapped' ):
+            pass
+        finish.set()
+        t.join()
+        stages = dict( [(s.name, s.as_dict()) for s in self.stages] )
+        assert stages['alone']['cpu'] is not None
+        for name in ('other', 'overlapped'):
+            eq_( (None, None, None), (stages[name]['cpu'],
+                stages[name]['bytes_read'], stages[name]['bytes_written']) )
+
+    def test_wait_already_reaped( self ):
+        p = subprocess.Popen( ['true'] )
+        p.wait()
+        eq_( 0, instrument.wait( p ) )
+
+    def test_bytes_written( self ):
+        if instrument.process_io() is None:
+            return
+        with instrument.stage( 'write' ):
+            with open( 'bytes', 'wb' ) as fh:
+                fh.write( 'A' * 100000 )
+        assert self.stages[0].as_dict()['bytes_written'] >= 100000
+
+    def test_failing_hook( self ):
+        ''' A broken hook does not break the stage '''
+        def broken( stage ):
+            raise RuntimeError( 'broken' )
+        instrument.add_hook( broken )
+        try:
+            with instrument.stage( 'fine' ):
+                pass
+        finally:
+            instrument.remove_hook( broken )
+        eq_( ['fine'], [s.name for s in self.stages] )
+
+    def test_compile_refs_stages( self ):
+        ''' Library stages show up nested in each other '''
+        os.mkdir( 'refs' )
+        util.create_fakefasta( 'refs/a.fa', 2 )
+        util.create_fakefasta( 'refs/b.fa', 1 )
+        bwa.compile_refs( 'refs', store=False, outputfile='profiled.fa' )
+        stages = dict( [(s.name, s) for s in self.stages] )
+        eq_( 'compile_refs', stages['concat_files'].parent.name )
+
+    def test_profile( self ):
+        profile = instrument.Profile()
+        instrument.add_hook( profile )
+        try:
+            with instrument.stage( 'profiled' ):
+                pass
+        finally:
+            instrument.remove_hook( profile )
+        profile.write( 'profile.json' )
+        with open( 'profile.json' ) as fh:
+            data = json.load( fh )
+        eq_( ['profiled'], [s['stage'] for s in data['stages']] )
+        for key in ('cpu', 'children', 'bytes_read', 'bytes_written', 'seconds'):
+            assert key in data['stages'][0], key
@@ -0,0 +1,57 @@
+from nose.tools import eq_
+
+from StringIO import StringIO
+
+from bwa.monitor import StderrMonitor, Progress
+
+READ_LINE = '[M::main_mem] read {0} sequences ({1} bp)...\n'
+
+class TestStderrMonitor( object ):
+    def test_totals( self ):
+        ''' Read lines are summed as they are fed '''
+        mon = StderrMonitor()
+        mon.feed( READ_LINE.format( 100, 1000 ) )
+        mon.feed( 'something else\n' )
+        mon.feed( READ_LINE.format( 50, 500 ) )
+        eq_( 150, mon.total_reads )
+        eq_( 1500, mon.total_bp )
+
+    def test_tail_bounded( self ):
+        ''' Only the last tail_lines lines are kept but totals are not lost '''
+        mon = StderrMonitor( tail_lines=2 )
+        for i in range( 10 ):
+            mon.feed( READ_LINE.format( 1, 10 ) )
+        mon.feed( '[main] Version: 0.7.4-r385\n' )
+        eq_( READ_LINE.format( 1, 10 ) + '[main] Version: 0.7.4-r385\n', mon.output() )
+        eq_( 10, mon.total_reads )
+
+    def test_follow( self ):
+        ''' Reads lines from file handle until it is exhausted '''
+        fh = StringIO( READ_LINE.format( 2, 20 ) + 'last line' )
+        mon = StderrMonitor().follow( fh )
+        eq_( 2, mon.total_reads )
+        eq_( 'last line', list( mon.tail )[-1] )
+
+    def test_parse( self ):
+        mon = StderrMonitor().parse( READ_LINE.format( 3, 30 ) * 2 )
+        eq_( 6, mon.total_reads )
+
+    def test_callback( self ):
+        ''' Callback gets a Progress for every read line '''
+        seen = []
+        mon = StderrMonitor( callback=seen.append, expected_reads=lambda: 400 )
+        mon.feed( READ_LINE.format( 100, 1000 ) )
+        mon.feed( 'no progress\n' )
+        mon.feed( READ_LINE.format( 100, 1000 ) )
+        eq_( 2, len( seen ) )
+        assert isinstance( seen[0], Progress )
+        eq_( (200, 2000, 400), (seen[1].reads, seen[1].bp, seen[1].expected_reads) )
+        assert seen[1].reads_per_sec > 0
+        assert seen[1].eta is not None and seen[1].eta >= 0
+
+    def test_progress_unknownexpected( self ):
+        ''' No eta without an expected read count '''
+        mon = StderrMonitor( expected_reads=lambda: None )
+        mon.feed( READ_LINE.format( 1, 1 ) )
+        eq_( None, mon.progress().eta )
+        eq_( None, StderrMonitor().progress().expected_reads )
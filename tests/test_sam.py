@@ -0,0 +1,91 @@
+from nose.tools import eq_, raises
+
+from StringIO import StringIO
+import os
+import tempfile
+
+from bwa.sam import SAMHeader, SAMRecord, iter_sam, PrimaryCounter, tee
+
+HEADER = '@SQ\tSN:ref\tLN:100\n@PG\tID:bwa\tPN:bwa\n'
+RECORD = 'read1\t0\tref\t1\t60\t4M\t*\t0\t0\tATGC\tIIII\tNM:i:0\tAS:i:4\n'
+
+class TestSAMRecord( object ):
+    def test_from_line( self ):
+        rec = SAMRecord.from_line( RECORD )
+        eq_( 'read1', rec.qname )
+        eq_( 0, rec.flag )
+        eq_( 1, rec.pos )
+        eq_( 60, rec.mapq )
+        eq_( ['NM:i:0', 'AS:i:4'], rec.tags )
+
+    def test_to_line( self ):
+        eq_( RECORD, SAMRecord.from_line( RECORD ).to_line() )
+
+    def test_is_primary( self ):
+        rec = SAMRecord.from_line( RECORD )
+        assert rec.is_primary
+        assert not rec._replace( flag=0x100 ).is_primary
+        assert not rec._replace( flag=0x800 ).is_primary
+        assert rec._replace( flag=0x4 ).is_primary
+
+    @raises( ValueError )
+    def test_short_line( self ):
+        SAMRecord.from_line( 'read1\t0\tref\n' )
+
+class TestIterSam( object ):
+    def test_header_then_records( self ):
+        items = list( iter_sam( StringIO( HEADER + RECORD + RECORD ) ) )
+        eq_( 3, len( items ) )
+        assert isinstance( items[0], SAMHeader )
+        eq_( HEADER, items[0].to_lines() )
+        eq_( 'read1', items[2].qname )
+
+    def test_header_only( self ):
+        items = list( iter_sam( StringIO( HEADER ) ) )
+        eq_( [HEADER.splitlines()], items )
+
+    def test_empty( self ):
+        eq_( [SAMHeader()], list( iter_sam( StringIO( '' ) ) ) )
+
+def sam_line( qname, flag ):
+    return '{0}\t{1}\tref\t1\t60\t4M\t*\t0\t0\tATGC\tIIII\n'.format(qname, flag)
+
+class TestPrimaryCounter( object ):
+    def test_counts_primary( self ):
+        ''' Secondary, supplementary and repeated records are not counted '''
+        sam = HEADER + sam_line( 'r1', 0 ) + sam_line( 'r1', 0x100 ) + \
+            sam_line( 'r1', 0x800 ) + sam_line( 'r1', 0 ) + sam_line( 'r2', 4 )
+        counter = PrimaryCounter()
+        counter.feed( sam )
+        eq_( 2, counter.close() )
+
+    def test_pairs( self ):
+        ''' Both reads of a pair count '''
+        sam = sam_line( 'p1', 0x41 ) + sam_line( 'p1', 0x81 ) + sam_line( 'p1', 0x141 )
+        counter = PrimaryCounter()
+        counter.feed( sam )
+        eq_( 2, counter.close() )
+
+    def test_split_blocks( self ):
+        ''' Lines split across blocks and a missing last newline '''
+        sam = (HEADER + sam_line( 'r1', 0 ) + sam_line( 'r2', 16 ) + sam_line( 'r3', 4 )).rstrip()
+        counter = PrimaryCounter()
+        for i in range( 0, len( sam ), 7 ):
+            counter.feed( sam[i:i+7] )
+        eq_( 3, counter.close() )
+
+    @raises( ValueError )
+    def test_invalid( self ):
+        PrimaryCounter().feed( 'not sam\n' )
+
+class TestTee( object ):
+    def test_tee( self ):
+        sam = HEADER + ''.join( [sam_line( 'r{0}'.format(i), 0 ) for i in range( 1000 )] )
+        r, w = os.pipe()
+        os.write( w, sam )
+        os.close( w )
+        out = tempfile.TemporaryFile()
+        counter = PrimaryCounter()
+        eq_( 1000, tee( os.fdopen( r ), os.dup( out.fileno() ), counter, blocksize=100 ) )
+        out.seek( 0 )
+        eq_( sam, out.read() )
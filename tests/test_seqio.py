@@ -5,6 +5,13 @@ import shutil
 import os
 import os.path
 import glob
+import gzip
+import struct
+import zlib
+import contextlib
+import errno
+
+import mock
 
 import util
 from bwa import seqio
@@ -84,6 +91,101 @@ class TestReadsInFile( SeqIOBase ):
         fh.close()
         self.readsinfiletest( 'fasta.fastq', 0 )
 
+    def test_readsinfile_sff( self ):
+        ''' sff count comes from header and matches Biopython '''
+        self.readsinfiletest( self.sff_input, reads_in( self.sff_input, 'sff' ) )
+
+    def test_readsinfile_fastqfixture( self ):
+        ''' Real fastq matches Biopython count '''
+        fastq = util.ungzip( util.INPUT_PATH, 'input.fastq' )
+        self.readsinfiletest( fastq, reads_in( fastq, 'fastq' ) )
+
+    def test_readsinfile_fastqwrapped( self ):
+        ''' Multi line fastq records fall back to Biopython '''
+        fh = open( 'wrapped.fastq', 'w' )
+        fh.write( '@seq1\nAB\nCD\n+\nII\nII\n@seq2\nACDE\n+\nIIII\n' )
+        fh.close()
+        self.readsinfiletest( 'wrapped.fastq', 2 )
+
+    def test_readsinfile_fastqtrailingblank( self ):
+        ''' Trailing blank lines and missing last newline are ignored '''
+        fh = open( 'blank.fastq', 'w' )
+        fh.write( '@seq1\nABCD\n+\nIIII\n@seq2\nACDE\n+\nIIII\n\n\n' )
+        fh.close()
+        self.readsinfiletest( 'blank.fastq', 2 )
+        fh = open( 'nonewline.fastq', 'w' )
+        fh.write( '@seq1\nABCD\n+\nIIII\n@seq2\nACDE\n+\nIIII' )
+        fh.close()
+        self.readsinfiletest( 'nonewline.fastq', 2 )
+
+    @raises(ValueError)
+    def test_readsinfile_fastqtruncated( self ):
+        ''' Truncated fastq still raises like Biopython '''
+        fh = open( 'truncated.fastq', 'w' )
+        fh.write( '@seq1\nABCD\n+\nIIII\n@seq2\nACDE\n' )
+        fh.close()
+        seqio.reads_in_file( 'truncated.fastq' )
+
+    def test_countfasta_blockboundary( self ):
+        ''' Records starting right on a block boundary are counted '''
+        with open( 'fasta.fa', 'w' ) as fh:
+            fh.write( '>seq1\nAT\n>seq2\nGC\n' )
+        for blocksize in (1, 3, 9, 100):
+            with open( 'fasta.fa', 'rb' ) as fh:
+                eq_( 2, seqio.count_fasta( fh, blocksize ) )
+
+    def test_fastalength( self ):
+        ''' Headers and line endings are not counted on any block boundary '''
+        data = '>a desc\nATGC\nAT\r\n>b\nGGG\n>c\n\n>d\nA'
+        with open( 'ref.fa', 'w' ) as fh:
+            fh.write( data )
+        for blocksize in range( 1, len( data ) + 2 ):
+            with open( 'ref.fa', 'rb' ) as fh:
+                eq_( 10, seqio.fasta_length( fh, blocksize ) )
+
+    def test_countfastq_smallblocks( self ):
+        ''' Last record split over blocks is still validated '''
+        with open( 'fasta.fastq', 'w' ) as fh:
+            fh.write( '@seq1\nABCD\n+\nIIII\n@seq2\nACDE\n+\nIIII\n' )
+        for blocksize in (3, 7, 100):
+            with open( 'fasta.fastq', 'rb' ) as fh:
+                eq_( 2, seqio.count_fastq( fh, blocksize ) )
+
+    def test_countfastq_wrappedmiddle( self ):
+        ''' A wrapped record between 4 line records is counted like Biopython '''
+        with open( 'wrapped.fastq', 'w' ) as fh:
+            fh.write( '@seq1\nACGT\n+\nIIII\n' )
+            fh.write( '@seq2\nAC\nGT\n+\nII\nII\n' )
+            fh.write( '@seq3\nACGT\n+\nIIII\n@seq4\nACGT\n+\nIIII\n' )
+        for blocksize in (4, 8, 100):
+            with open( 'wrapped.fastq', 'rb' ) as fh:
+                eq_( None, seqio.count_fastq( fh, blocksize ) )
+        eq_( 4, seqio.reads_in_file( 'wrapped.fastq' ) )
+
+    def test_countfastq_trailingblanks( self ):
+        ''' Any number of trailing blank lines on any block boundary are ignored '''
+        with open( 'blanks.fastq', 'w' ) as fh:
+            fh.write( '@seq1\nACGT\n+\nIIII\n@seq2\nACGT\n+\nIIII\n' + '\n' * 12 )
+        for blocksize in (4, 8, 16, 100):
+            with open( 'blanks.fastq', 'rb' ) as fh:
+                eq_( 2, seqio.count_fastq( fh, blocksize ) )
+        eq_( 2, seqio.reads_in_file( 'blanks.fastq' ) )
+
+    def test_countfastq_middleblanks( self ):
+        ''' Blank lines followed by more records are not counted as fastq '''
+        with open( 'blanks.fastq', 'w' ) as fh:
+            fh.write( '@seq1\nACGT\n+\nIIII\n' + '\n' * 5 + '@seq2\nACGT\n+\nIIII\n' )
+        for blocksize in (4, 8, 16, 100):
+            with open( 'blanks.fastq', 'rb' ) as fh:
+                eq_( None, seqio.count_fastq( fh, blocksize ) )
+
+    @raises(ValueError)
+    def test_sffreadcount_invalid( self ):
+        ''' Short sff header is rejected '''
+        with open( 'short.sff', 'w' ) as fh:
+            fh.write( '.sff' )
+        seqio.sff_read_count( 'short.sff' )
+
 
 class TestSffsToFastq( SeqIOBase ):
     @raises( ValueError )
@@ -112,6 +214,13 @@ class TestSffsToFastq( SeqIOBase ):
         ''' Invalid output path given '''
         self.runit( [self.sff_input], '/not/valid/path.fastq' )
 
+    @raises( ValueError )
+    def test_invalidoutput_parallel( self ):
+        ''' Invalid output path raises the same error when converting in parallel '''
+        shutil.copy( self.sff_input, 'input2.sff' )
+        os.mkdir( 'outdir.fastq' )
+        seqio.sffs_to_fastq( ['input2.sff', self.sff_input], 'outdir.fastq', workers=2 )
+
     def test_multiitem( self ):
         ''' Param list len > 1, specify output '''
         shutil.copy( self.sff_input, 'input2.sff' )
@@ -129,12 +238,359 @@ class TestSffsToFastq( SeqIOBase ):
         assert is_fastq( path )
         assert sff_eq_fastq( sff, path )
 
+    def test_parallel_sameasserial( self ):
+        ''' Parallel conversion output is byte identical to serial '''
+        shutil.copy( self.sff_input, 'input2.sff' )
+        shutil.copy( self.sff_input, 'input3.sff' )
+        sff = ['input2.sff', self.sff_input, 'input3.sff']
+        seqio.sffs_to_fastq( sff, 'serial.fastq', workers=1 )
+        seqio.sffs_to_fastq( sff, 'parallel.fastq', workers=3 )
+        with open( 'serial.fastq' ) as fh:
+            serial = fh.read()
+        with open( 'parallel.fastq' ) as fh:
+            eq_( serial, fh.read() )
+        # No part files left behind
+        eq_( ['input2.sff', 'input3.sff', 'parallel.fastq', 'serial.fastq'], sorted( os.listdir( '.' ) ) )
+
+    @raises( ValueError )
+    def test_parallel_invalid_sff( self ):
+        ''' Invalid sff in a worker is still a ValueError '''
+        with open( 'invalid.sff', 'w' ) as fh:
+            fh.write( 'not an sff' )
+        seqio.sffs_to_fastq( [self.sff_input, 'invalid.sff'], 'out.fastq', workers=2 )
+
+    def test_conversion_workers( self ):
+        ''' Worker count bounded by files, requested workers and memory '''
+        eq_( 2, seqio.conversion_workers( 2, 8 ) )
+        eq_( 3, seqio.conversion_workers( 10, 3 ) )
+        eq_( 1, seqio.conversion_workers( 10, 8, 1 ) )
+        eq_( 2, seqio.conversion_workers( 10, 8, seqio.SFF_WORKER_MEMORY * 2 ) )
+
     def test_zeroitem( self ):
         ''' Param list is empty list '''
         path = seqio.sffs_to_fastq( [], output='shouldnotexist.fastq' )
         eq_( None, path )
         eq_( True, not os.path.isfile( 'shouldnotexist.fastq' ) )
 
+class TestSffReader( SeqIOBase ):
+    def _biopython_fastq( self, trim=False ):
+        from Bio.SeqIO.SffIO import SffIterator
+        with open( self.sff_input, 'rb' ) as fh:
+            with open( 'bio.fastq', 'w' ) as out:
+                SeqIO.write( SffIterator( fh, trim=trim ), out, 'fastq' )
+        with open( 'bio.fastq' ) as fh:
+            return fh.read()
+
+    def test_same_as_biopython( self ):
+        ''' Native conversion is byte identical to Biopython '''
+        seqio.sffs_to_fastq( [self.sff_input], 'native.fastq' )
+        with open( 'native.fastq' ) as fh:
+            eq_( self._biopython_fastq(), fh.read() )
+
+    def test_trim_same_as_biopython( self ):
+        ''' Trimming matches Biopython's trimmed sff parsing '''
+        seqio.sffs_to_fastq( [self.sff_input], 'native.fastq', trim=True )
+        with open( 'native.fastq' ) as fh:
+            eq_( self._biopython_fastq( True ), fh.read() )
+
+    def test_iter_sff( self ):
+        ''' Every read in the header is returned with valid clip points '''
+        reads = list( seqio.iter_sff( self.sff_input ) )
+        eq_( seqio.sff_read_count( self.sff_input ), len( reads ) )
+        expected = [r.id for r in SeqIO.parse( self.sff_input, 'sff' )]
+        eq_( expected, [r.name for r in reads] )
+        for read in reads:
+            eq_( len( read.bases ), len( read.quals ) )
+            assert 0 <= read.clip_left <= len( read.bases )
+
+    def test_write_count( self ):
+        ''' write_sff_fastq returns how many reads were written '''
+        with open( 'out.fastq', 'w' ) as fh:
+            count = seqio.write_sff_fastq( self.sff_input, fh )
+        eq_( seqio.sff_read_count( self.sff_input ), count )
+
+    def test_fastq_record_clips( self ):
+        ''' Clipped bases are lower cased or trimmed '''
+        read = seqio.SffRead( 'r1', 'ACGTAC', '\x00\x01\x28\x28\x5d\x64', 1, 4 )
+        eq_( '@r1\naCGTac\n+\n!"II~~\n', seqio.sff_fastq_record( read ) )
+        eq_( '@r1\nCGT\n+\n"II\n', seqio.sff_fastq_record( read, True ) )
+        read = read._replace( clip_left=4, clip_right=2 )
+        eq_( 'acgtac', seqio.sff_fastq_record( read ).split( '\n' )[1] )
+        eq_( '@r1\n\n+\n\n', seqio.sff_fastq_record( read, True ) )
+
+    @raises( ValueError )
+    def test_truncated( self ):
+        ''' Truncated sff raises ValueError '''
+        with open( self.sff_input, 'rb' ) as fh:
+            data = fh.read()
+        with open( 'truncated.sff', 'wb' ) as fh:
+            fh.write( data[:len( data ) // 2] )
+        list( seqio.iter_sff( 'truncated.sff' ) )
+
+    @raises( ValueError )
+    def test_badversion( self ):
+        with open( self.sff_input, 'rb' ) as fh:
+            data = fh.read()
+        with open( 'version.sff', 'wb' ) as fh:
+            fh.write( data[:4] + '\x00\x00\x00\x02' + data[8:] )
+        seqio.sff_read_count( 'version.sff' )
+
+class TestReadStream( SeqIOBase ):
+    def test_write_mixed( self ):
+        ''' Fastq copied as is, sff converted, reads tallied '''
+        fastq = util.ungzip( util.INPUT_PATH, 'input.fastq' )
+        stream = seqio.ReadStream( [fastq, self.sff_input] )
+        with open( 'stream.fastq', 'w' ) as fh:
+            count = stream.write( fh )
+        seqio.sffs_to_fastq( [self.sff_input], 'sff.fastq' )
+        seqio.concat_files( [fastq, 'sff.fastq'], 'expected.fastq' )
+        with open( 'expected.fastq' ) as fh:
+            expected = fh.read()
+        with open( 'stream.fastq' ) as fh:
+            eq_( expected, fh.read() )
+        eq_( seqio.reads_in_file( 'expected.fastq' ), count )
+
+    def test_write_wrappedfastq( self ):
+        ''' Fastq that is not 4 line is still counted correctly '''
+        with open( 'wrapped.fastq', 'w' ) as fh:
+            fh.write( '@seq1\nAB\nCD\n+\nII\nII\n' )
+        with open( 'out.fastq', 'w' ) as fh:
+            eq_( 1, seqio.ReadStream( ['wrapped.fastq'] ).write( fh ) )
+
+class TestIterReadRecords( SeqIOBase ):
+    def test_fastq( self ):
+        ''' Compressed fastq records come out as 4 line text '''
+        records = list( seqio.iter_read_records( util.INPUT_PATH ) )
+        fastq = util.ungzip( util.INPUT_PATH, 'input.fastq' )
+        eq_( seqio.reads_in_file( fastq ), len( records ) )
+        with open( fastq ) as fh:
+            first = ''.join( [fh.readline() for i in range( 4 )] )
+        eq_( first.split( '\n' )[:2], records[0].split( '\n' )[:2] )
+        eq_( first.split( '\n' )[3], records[0].split( '\n' )[3] )
+
+    def test_fasta( self ):
+        with open( 'reads.fa', 'w' ) as fh:
+            fh.write( '>r1 desc\nAT\nGC\n>r2\nA\n' )
+        eq_( ['>r1 desc\nATGC\n', '>r2\nA\n'], list( seqio.iter_read_records( 'reads.fa' ) ) )
+
+    def test_readstream( self ):
+        ''' sff reads come out the same as ReadStream writes them '''
+        stream = seqio.ReadStream( [self.sff_input] )
+        with open( 'stream.fastq', 'w' ) as fh:
+            stream.write( fh )
+        with open( 'stream.fastq' ) as fh:
+            eq_( fh.read(), ''.join( seqio.iter_read_records( stream ) ) )
+
+def write_bgzf( data, path ):
+    ''' Write data as BGZF blocks followed by the empty EOF block '''
+    def block( data ):
+        c = zlib.compressobj( 6, zlib.DEFLATED, -15 )
+        deflated = c.compress( data ) + c.flush()
+        return '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + \
+            struct.pack( '<H', len( deflated ) + 25 ) + deflated + \
+            struct.pack( '<iI', zlib.crc32( data ), len( data ) )
+    with open( path, 'wb' ) as fh:
+        for i in range( 0, len( data ), 60000 ):
+            fh.write( block( data[i:i+60000] ) )
+        fh.write( block( '' ) )
+    return path
+
+class TestCompression( SeqIOBase ):
+    def setUp( self ):
+        super( TestCompression, self ).setUp()
+        self.fastq = util.ungzip( util.INPUT_PATH, 'input.fastq' )
+        with open( self.fastq ) as fh:
+            self.content = fh.read()
+        self.path = os.environ['PATH']
+
+    def tearDown( self ):
+        os.environ['PATH'] = self.path
+        super( TestCompression, self ).tearDown()
+
+    def _fakebin( self, name ):
+        ''' Put an executable named name first in PATH '''
+        if not os.path.isdir( 'bin' ):
+            os.mkdir( 'bin' )
+        path = os.path.join( os.path.abspath( 'bin' ), name )
+        with open( path, 'w' ) as fh:
+            fh.write( '#!/usr/bin/env bash\ngzip -dc "${@: -1}"\n' )
+        os.chmod( path, 0700 )
+        os.environ['PATH'] = os.path.dirname( path ) + os.pathsep + self.path
+        return path
+
+    def test_compression( self ):
+        eq_( 'gzip', seqio.compression( util.INPUT_PATH ) )
+        eq_( 'bgzf', seqio.compression( write_bgzf( self.content, 'in.fastq.gz' ) ) )
+        eq_( None, seqio.compression( self.fastq ) )
+        open( 'empty', 'w' ).close()
+        eq_( None, seqio.compression( 'empty' ) )
+
+    def test_seqfile_type( self ):
+        eq_( 'fastq', seqio.seqfile_type( util.INPUT_PATH ) )
+        eq_( 'fastq', seqio.seqfile_type( write_bgzf( self.content, 'in.fastq.gz' ) ) )
+
+    @raises( ValueError )
+    def test_seqfile_type_compressedsff( self ):
+        ''' sff has to be read from an uncompressed file '''
+        seqio.seqfile_type( util.INPUT_SFF_PATH )
+
+    def test_reads_in_file( self ):
+        expected = seqio.reads_in_file( self.fastq )
+        eq_( expected, seqio.reads_in_file( util.INPUT_PATH ) )
+        eq_( expected, seqio.reads_in_file( write_bgzf( self.content, 'in.fastq.gz' ) ) )
+
+    def test_reads_in_file_wrapped( self ):
+        ''' Biopython fallback can read compressed files too '''
+        with contextlib.closing( gzip.open( 'wrapped.fastq.gz', 'wb' ) ) as fh:
+            fh.write( '@seq1\nAB\nCD\n+\nII\nII\n' )
+        eq_( 1, seqio.reads_in_file( 'wrapped.fastq.gz' ) )
+
+    def test_decompress_command( self ):
+        ''' bgzip is preferred for bgzf and pigz for everything else '''
+        write_bgzf( self.content, 'in.fastq.gz' )
+        os.environ['PATH'] = ''
+        eq_( None, seqio.decompress_command( util.INPUT_PATH ) )
+        pigz = self._fakebin( 'pigz' )
+        eq_( [pigz, '-dc', '-p', '3', util.INPUT_PATH], seqio.decompress_command( util.INPUT_PATH, 3 ) )
+        eq_( [pigz, '-dc', '-p', '3', 'in.fastq.gz'], seqio.decompress_command( 'in.fastq.gz', 3 ) )
+        bgzip = self._fakebin( 'bgzip' )
+        eq_( [bgzip, '-dc', '-@', '3', 'in.fastq.gz'], seqio.decompress_command( 'in.fastq.gz', 3 ) )
+
+    def test_open_seqfile( self ):
+        ''' Same bytes with or without a decompression process '''
+        with contextlib.closing( seqio.open_seqfile( util.INPUT_PATH ) ) as fh:
+            eq_( self.content, fh.read() )
+        self._fakebin( 'pigz' )
+        fh = seqio.open_seqfile( util.INPUT_PATH )
+        assert isinstance( fh, seqio.DecompressedFile )
+        with contextlib.closing( fh ):
+            eq_( self.content, ''.join( seqio.iter_blocks( fh, 1000 ) ) )
+
+    @raises( IOError )
+    def test_decompressedfile_fails( self ):
+        with contextlib.closing( seqio.DecompressedFile( ['gzip', '-dc', self.fastq] ) ) as fh:
+            fh.read()
+
+    def test_decompressedfile_closeearly( self ):
+        ''' Closing before everything is read stops the process '''
+        fh = seqio.DecompressedFile( ['gzip', '-dc', util.INPUT_PATH] )
+        fh.read( 10 )
+        fh.close()
+        assert fh.process.returncode is not None
+
+    def test_concat_files( self ):
+        ''' Compressed and plain files concat into plain text '''
+        seqio.concat_files( [util.INPUT_PATH, self.fastq], 'out.fastq' )
+        with open( 'out.fastq' ) as fh:
+            eq_( self.content * 2, fh.read() )
+
+    def test_readstream( self ):
+        with open( 'out.fastq', 'w' ) as fh:
+            count = seqio.ReadStream( [util.INPUT_PATH] ).write( fh )
+        eq_( seqio.reads_in_file( self.fastq ), count )
+        with open( 'out.fastq' ) as fh:
+            eq_( self.content, fh.read() )
+
+class TestValidateSeqfile( SeqIOBase ):
+    def _fastq( self, path, n, corrupt=None ):
+        with open( path, 'w' ) as fh:
+            for i in range( n ):
+                if i == corrupt:
+                    fh.write( '@read{0}\nACGTACGT\n+\nIII\n'.format(i) )
+                else:
+                    fh.write( '@read{0}\nACGTACGT\n+\nIIIIIIII\n'.format(i) )
+        return path
+
+    def test_level_by_size( self ):
+        self._fastq( 'small.fastq', 10 )
+        eq_( 'full', seqio.validation_level( 'small.fastq' ) )
+        with mock.patch.object( seqio, 'SAMPLE_VALIDATION_SIZE', 10 ):
+            eq_( 'sample', seqio.validation_level( 'small.fastq' ) )
+        eq_( 'none', seqio.validation_level( 'small.fastq', 'none' ) )
+
+    @raises( ValueError )
+    def test_invalid_level( self ):
+        seqio.validation_level( 'small.fastq', 'some' )
+
+    def test_sample_reads_windows_only( self ):
+        ''' Sampling reads the same few windows for any file size '''
+        self._fastq( 'big.fastq', 20000 )
+        reads = []
+        real_open = open
+        def counting_open( *args ):
+            fh = real_open( *args )
+            read = fh.read
+            def counted( size=-1 ):
+                data = read( size )
+                reads.append( len( data ) )
+                return data
+            return mock.Mock( wraps=fh, read=counted, __enter__=lambda s: s,
+                __exit__=lambda s, *a: fh.close() )
+        with mock.patch.object( seqio, 'VALIDATION_WINDOW', 1024 ):
+            with mock.patch( '__builtin__.open', counting_open ):
+                eq_( 'fastq', seqio.validate_seqfile( 'big.fastq', 'sample' ) )
+        assert sum( reads ) <= 11 * 1024, sum( reads )
+
+    @raises( ValueError )
+    def test_sample_finds_corrupt_tail( self ):
+        self._fastq( 'bad.fastq', 2000, corrupt=1999 )
+        with mock.patch.object( seqio, 'VALIDATION_WINDOW', 1024 ):
+            seqio.validate_seqfile( 'bad.fastq', 'sample' )
+
+    @raises( ValueError )
+    def test_sample_finds_corrupt_offset( self ):
+        ''' Every record is checked when the samples cover the file '''
+        self._fastq( 'bad.fastq', 200, corrupt=100 )
+        with mock.patch.object( seqio, 'VALIDATION_WINDOW', 1024 ):
+            seqio.validate_seqfile( 'bad.fastq', 'sample', samples=200 )
+
+    def test_sample_wrapped_fastq( self ):
+        ''' Fastq that is not 4 lines per record is checked in full '''
+        with open( 'wrapped.fastq', 'w' ) as fh:
+            fh.write( '@read1\nACGT\nACGT\n+\nIIII\nIIII\n' )
+        eq_( 'fastq', seqio.validate_seqfile( 'wrapped.fastq', 'sample' ) )
+
+    def test_sample_fasta( self ):
+        with open( 'ref.fa', 'w' ) as fh:
+            fh.write( '>seq1 desc\nACGTN\nacgt-\n\n>seq2\nACGT\n' )
+        eq_( 'fasta', seqio.validate_seqfile( 'ref.fa', 'sample' ) )
+
+    def test_fasta_whitespace( self ):
+        ''' Spaces and tabs in sequence lines are ignored like Biopython does '''
+        with open( 'ref.fa', 'w' ) as fh:
+            fh.write( '>seq1\nACGT \nAC GT\r\n\tACGT\n' )
+        for level in ('sample', 'full'):
+            eq_( 'fasta', seqio.validate_seqfile( 'ref.fa', level ) )
+
+    @raises( ValueError )
+    def test_sample_fasta_invalid( self ):
+        with open( 'ref.fa', 'w' ) as fh:
+            fh.write( '>seq1\nACGT\n@read1\nAC GT\n' )
+        seqio.validate_seqfile( 'ref.fa', 'sample' )
+
+    def test_sample_sff_and_gzip( self ):
+        eq_( 'sff', seqio.validate_seqfile( self.sff_input, 'sample' ) )
+        self._fastq( 'reads.fastq', 10 )
+        with open( 'reads.fastq', 'rb' ) as fi:
+            with contextlib.closing( gzip.open( 'reads.fastq.gz', 'wb' ) ) as fo:
+                fo.write( fi.read() )
+        eq_( 'fastq', seqio.validate_seqfile( 'reads.fastq.gz', 'sample' ) )
+
+    def test_none( self ):
+        ''' none trusts any file that exists '''
+        with open( 'garbage.fastq', 'w' ) as fh:
+            fh.write( 'not reads' )
+        eq_( None, seqio.validate_seqfile( 'garbage.fastq', 'none' ) )
+
+    @raises( ValueError )
+    def test_none_missing( self ):
+        seqio.validate_seqfile( 'missing.fastq', 'none' )
+
+    @raises( ValueError )
+    def test_full( self ):
+        self._fastq( 'bad.fastq', 20, corrupt=10 )
+        seqio.validate_seqfile( 'bad.fastq', 'full' )
+
 class TestGetReads( SeqIOBase ):
     @raises( ValueError )
     def test_invaliddirpath( self ):
@@ -169,6 +625,7 @@ class TestGetReads( SeqIOBase ):
             'hasreads/file2.fastq',
             'hasreads/file3.sff',
             'hasreads/file4.sff',
+            'hasreads/file5.fastq.gz',
         ]
         for read in reads:
             open( read, 'w' ).close()
@@ -231,6 +688,57 @@ class TestConcatFiles( SeqIOBase ):
         with open( 'output' ) as fh:
             eq_( content * 3, fh.read() )
 
+    def test_missingnewline( self ):
+        ''' Files without a final newline do not run into the next file '''
+        filelist = self.writesomefiles( '>seq\nATGC', 2 )
+        seqio.concat_files( sorted( filelist ), 'output' )
+        with open( 'output' ) as fh:
+            eq_( '>seq\nATGC\n>seq\nATGC\n', fh.read() )
+
+    def test_missingnewline_compressed( self ):
+        with contextlib.closing( gzip.open( 'ref.fa.gz', 'wb' ) ) as fh:
+            fh.write( '>seq1\nATGC' )
+        filelist = self.writesomefiles( '>seq2\nATGC\n', 1 )
+        seqio.concat_files( ['ref.fa.gz'] + filelist, 'output' )
+        with open( 'output' ) as fh:
+            eq_( '>seq1\nATGC\n>seq2\nATGC\n', fh.read() )
+
+    def test_copy_fd( self ):
+        ''' Copies from the start of src to the position of dst '''
+        filelist = self.writesomefiles( 'ABCDEFGH', 1 )
+        with open( filelist[0] ) as src, open( 'output', 'w' ) as dst:
+            src.read( 3 )
+            dst.write( 'xy' )
+            dst.flush()
+            eq_( 5, seqio.copy_fd( src.fileno(), dst.fileno(), 5 ) )
+            # Stops at the end of src
+            eq_( 8, seqio.copy_fd( src.fileno(), dst.fileno(), 100 ) )
+        with open( 'output' ) as fh:
+            eq_( 'xyABCDEABCDEFGH', fh.read() )
+
+    def test_copy_fd_zerocopyunsupported( self ):
+        ''' Falls back to a buffered copy when zero copy is not supported '''
+        filelist = self.writesomefiles( 'ABCDEFGH', 1 )
+        unsupported = mock.Mock( side_effect=OSError( errno.ENOSYS, 'nope' ) )
+        with mock.patch.object( os, 'sendfile', unsupported, create=True ):
+            with open( filelist[0] ) as src, open( 'output', 'w' ) as dst:
+                eq_( 8, seqio.copy_fd( src.fileno(), dst.fileno(), 8 ) )
+        eq_( 1, unsupported.call_count )
+        with open( 'output' ) as fh:
+            eq_( 'ABCDEFGH', fh.read() )
+
+    def test_copy_fd_zerocopy( self ):
+        ''' Zero copy is used until count bytes are copied '''
+        filelist = self.writesomefiles( 'ABCDEFGH', 1 )
+        def sendfile( out, in_, offset, count ):
+            os.lseek( in_, offset, os.SEEK_SET )
+            return os.write( out, os.read( in_, min( count, 3 ) ) )
+        with mock.patch.object( os, 'sendfile', sendfile, create=True ):
+            with open( filelist[0] ) as src, open( 'output', 'w' ) as dst:
+                eq_( 8, seqio.copy_fd( src.fileno(), dst.fileno(), 8 ) )
+        with open( 'output' ) as fh:
+            eq_( 'ABCDEFGH', fh.read() )
+
     @raises(ValueError)
     def test_inputsameoutput( self ):
         '''
@@ -49,6 +49,8 @@ class Base( object ):
     def setUpClass( self ):
         self.tempdir = tempfile.mkdtemp(prefix='bwatest')
         os.chdir( self.tempdir )
+        # Keep persistent caches out of the home directory
+        os.environ['PYBWA_CACHE_DIR'] = os.path.join( self.tempdir, '.cache' )
 
     @classmethod
     def tearDownClass( self ):